@@ -0,0 +1,58 @@
+"""Microbenchmark of encoding validator manager calls
+
+Compares `ContractTranslator.encode_function_call` and `decode` with the
+calldata conversion `call_msg` did before, to the pre-bound `BoundCall`.
+
+    python benchmarks/abi_calls.py
+"""
+import timeit
+
+import rlp
+from ethereum import (
+    utils,
+    vm,
+)
+
+from sharding.contract_utils import get_bound_call
+from sharding.tools import tester
+from sharding.used_receipt_store_utils import get_urs_ct
+from sharding.validator_manager_utils import get_valmgr_ct
+
+HEADER = rlp.encode([0, b'\x11' * 32, 1, b'\x22' * 32, tester.a1, b'', b'', b''])
+RESULT = utils.zpad(tester.a1, 32)
+
+
+def legacy_call(ct, func, args):
+    vm.CallData([utils.safe_ord(x) for x in ct.encode_function_call(func, args)])
+    return ct.decode(func, RESULT)
+
+
+def bound_call(ct, func, args):
+    call = get_bound_call(ct, func)
+    call.encode_calldata(args)
+    return call.decode(RESULT)
+
+
+def bench(fn, ct, func, args, number):
+    timer = timeit.Timer(lambda: fn(ct, func, args))
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e9
+
+
+def main(number=20000):
+    calls = [
+        (get_valmgr_ct(), 'add_header', [HEADER]),
+        (get_valmgr_ct(), 'sample', [0]),
+        (get_valmgr_ct(), 'get_receipts__value', [0]),
+        (get_urs_ct(0), 'get_used_receipts', [0]),
+    ]
+    print('%-28s %12s %12s' % ('function', 'legacy ns', 'bound ns'))
+    for ct, func, args in calls:
+        print('%-28s %12.1f %12.1f' % (
+            func,
+            bench(legacy_call, ct, func, args, number),
+            bench(bound_call, ct, func, args, number),
+        ))
+
+
+if __name__ == '__main__':
+    main()
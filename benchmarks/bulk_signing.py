@@ -0,0 +1,51 @@
+"""Throughput of signing txs and recovering their senders, serially and in
+a process pool
+
+    python benchmarks/bulk_signing.py [count] [processes]
+"""
+import sys
+import time
+
+import rlp
+from ethereum.transactions import Transaction
+
+from sharding import batch_crypto_utils
+from sharding.tools import tester
+
+
+def mk_tx_params(count):
+    keys = tester.keys[:4]
+    return [(keys[i % len(keys)], tester.a9, i, b'', 21000, 1) for i in range(count)]
+
+
+def throughput(func, count):
+    start = time.time()
+    func()
+    return count / (time.time() - start)
+
+
+def main(count=2000, processes=None):
+    state = tester.Chain(env='sharding').head_state
+    tx_params = mk_tx_params(count)
+    txs = batch_crypto_utils.mk_signed_txs(state, tx_params, processes=1)
+    encoded = [rlp.encode(tx) for tx in txs]
+
+    def sign(processes):
+        return lambda: batch_crypto_utils.mk_signed_txs(state, tx_params, processes=processes)
+
+    def recover(processes):
+        return lambda: batch_crypto_utils.recover_tx_senders(
+            [rlp.decode(data, Transaction) for data in encoded], processes=processes
+        )
+
+    print('%-24s %14s %14s' % ('%d txs' % count, 'serial tx/s', 'pool tx/s'))
+    for name, mk_func in (('sign', sign), ('recover senders', recover)):
+        print('%-24s %14.1f %14.1f' % (
+            name,
+            throughput(mk_func(1), count),
+            throughput(mk_func(processes), count),
+        ))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,82 @@
+"""Microbenchmark of attribute access on Collation and CollationHeader
+
+Compares the slotted header and the forwarding properties of `Collation`
+with the previous `__getattribute__` override, which resolved header fields
+of a collation through an exception handler.
+
+    python benchmarks/collation_attribute_access.py
+"""
+import timeit
+
+import rlp
+from rlp.sedes import CountableList
+from ethereum.transactions import Transaction
+
+from sharding.collation import (
+    Collation,
+    CollationHeader,
+)
+
+
+class LegacyCollationHeader(rlp.Serializable):
+    fields = CollationHeader.fields
+
+    def __init__(self, **kwargs):
+        values = CollationHeader(**kwargs)
+        super(LegacyCollationHeader, self).__init__(
+            **{field: getattr(values, field) for field, _ in self.fields}
+        )
+
+    def __getattribute__(self, name):
+        try:
+            return rlp.Serializable.__getattribute__(self, name)
+        except AttributeError:
+            return getattr(self.header, name)
+
+
+class LegacyCollation(rlp.Serializable):
+    fields = [
+        ('header', LegacyCollationHeader),
+        ('transactions', CountableList(Transaction))
+    ]
+
+    def __init__(self, header, transactions=None):
+        self.header = header
+        self.transactions = transactions or []
+
+    def __getattribute__(self, name):
+        try:
+            return rlp.Serializable.__getattribute__(self, name)
+        except AttributeError:
+            return getattr(self.header, name)
+
+
+STATEMENTS = [
+    'collation.header.number',
+    'collation.number',
+    'collation.parent_collation_hash',
+    'collation.transactions',
+]
+
+
+def bench(stmt, collation, number):
+    timer = timeit.Timer(stmt, globals={'collation': collation})
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e9
+
+
+def main(number=200000):
+    legacy = LegacyCollation(LegacyCollationHeader(number=1))
+    collation = Collation(CollationHeader(number=1))
+    assert rlp.encode(legacy) == rlp.encode(collation)
+
+    print('%-36s %12s %12s' % ('attribute', 'legacy ns', 'slotted ns'))
+    for stmt in STATEMENTS:
+        print('%-36s %12.1f %12.1f' % (
+            stmt,
+            bench(stmt, legacy, number),
+            bench(stmt, collation, number),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Import-time regression benchmark of `sharding.tools.tester`
+
+Runs `python -X importtime` in fresh processes, reports the cumulative
+import time of the slowest modules, and fails if the median total exceeds
+the budget or if a lazily loaded dependency is imported eagerly.
+`-X importtime` needs Python 3.7 or later.
+
+    python benchmarks/import_time.py [budget_ms]
+"""
+import re
+import subprocess
+import sys
+
+MODULE = 'sharding.tools.tester'
+BUDGET_MS = 1500
+# Loaded on first use only
+LAZY_MODULES = ('viper', 'graphviz', 'ethereum.tools._solidity')
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+
+def measure(module=MODULE):
+    """Import `module` in a fresh interpreter, and return a dict of module
+    name -> cumulative import time in microseconds
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        stderr=subprocess.STDOUT,
+    ).decode()
+    times = {}
+    for line in output.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+
+def main(budget_ms=BUDGET_MS, repeat=5):
+    runs = [measure() for _ in range(repeat)]
+    totals = sorted(run[MODULE.split('.')[0]] for run in runs)
+    median_ms = totals[len(totals) // 2] / 1000.0
+
+    print('%-48s %12s' % ('module', 'cumul ms'))
+    slowest = sorted(runs[-1].items(), key=lambda item: -item[1])[:15]
+    for name, usec in slowest:
+        print('%-48s %12.1f' % (name, usec / 1000.0))
+    print('median total of %d runs: %.1f ms (budget %d ms)' % (repeat, median_ms, budget_ms))
+
+    eager = [name for name in LAZY_MODULES if any(name in run for run in runs)]
+    if eager:
+        print('imported eagerly: %s' % ', '.join(eager))
+    return median_ms <= budget_ms and not eager
+
+
+if __name__ == '__main__':
+    if sys.version_info < (3, 7):
+        sys.exit('python -X importtime needs Python 3.7 or later, this is %d.%d' % sys.version_info[:2])
+    sys.exit(0 if main(*[int(arg) for arg in sys.argv[1:2]]) else 1)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import re
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 
 
 # requirements
@@ -32,9 +34,25 @@ if os.environ.get("USE_PYETHEREUM_DEVELOP"):
 viper_ref = '12847483f571505cef72fcb725e6557db15bce29'  # Sep 12, 2017
 DEPENDENCY_LINKS.append('http://github.com/ethereum/viper/tarball/%s#egg=viper-9.99.9' % viper_ref)
 
-# *IMPORTANT*: Don't manually change the version here. Use the 'bumpversion' utility.
+# *IMPORTANT*: The version is the static `__version__` of sharding/__init__.py.
+# Don't manually change it. Use the 'bumpversion' utility.
 # see: https://github.com/ethereum/pyethapp/wiki/Development:-Versions-and-Releases
-version = '0.0.1'
+with open(os.path.join('sharding', '__init__.py')) as init_file:
+    version = re.search(r"^__version__ = '([^']+)'", init_file.read(), re.M).group(1)
+
+
+
+class BuildPyWithArtifacts(build_py):
+    """Compile the contract artifacts into sharding/contracts/artifacts
+    first when SHARDING_BUILD_ARTIFACTS is set, so they ship with the package
+    """
+
+    def run(self):
+        if os.environ.get('SHARDING_BUILD_ARTIFACTS'):
+            from sharding.contract_artifact_utils import build_artifacts
+            build_artifacts()
+        build_py.run(self)
+
 
 setup(
     name='sharding',
@@ -42,7 +60,8 @@ setup(
     description='Ethereum Sharding PoC utilities',
     url='https://github.com/ethereum/sharding',
     packages=find_packages("."),
-    package_data={},
+    package_data={'sharding': ['contracts/*.v.py', 'contracts/artifacts/*.json']},
+    cmdclass={'build_py': BuildPyWithArtifacts},
     zip_safe=False,
     classifiers=[
         'Intended Audience :: Developers',
@@ -0,0 +1,189 @@
+import multiprocessing
+
+from ethereum import utils
+from ethereum.transactions import (
+    Transaction,
+    secpk1n,
+)
+
+from sharding.contract_utils import (
+    get_tx_rawhash,
+    sign,
+)
+from sharding.receipt_consuming_tx_utils import is_receipt_consuming_tx
+
+# Below this many signatures the pool start-up costs more than it saves
+MIN_POOL_BATCH_SIZE = 64
+
+
+def _recover_address(signature):
+    """Recover the signer address of `(msg_hash, v, r, s)`
+
+    Return None if the signature is invalid.
+    """
+    msg_hash, v, r, s = signature
+    if v not in (27, 28) or not 0 < r < secpk1n or not 0 < s < secpk1n:
+        return None
+    try:
+        pub = utils.ecrecover_to_pub(msg_hash, v, r, s)
+    except Exception:
+        return None
+    if pub == b'\x00' * 64:
+        return None
+    return utils.sha3(pub)[-20:]
+
+
+def _sign(job):
+    msg_hash, privkey = job
+    return sign(msg_hash, privkey)
+
+
+def _sign_tx(job):
+    rawhash, privkey = job
+    v, r, s = utils.ecsign(rawhash, privkey)
+    return v, r, s, utils.privtoaddr(privkey)
+
+
+def pool_map(func, jobs, processes=None):
+    """Map `func` over `jobs` in a process pool, keeping the order of `jobs`
+
+    Small batches, or `processes=1`, are run in this process.
+    """
+    jobs = list(jobs)
+    if processes == 1 or len(jobs) < MIN_POOL_BATCH_SIZE:
+        return [func(job) for job in jobs]
+    pool = multiprocessing.Pool(processes)
+    try:
+        chunksize = max(1, len(jobs) // (4 * (processes or multiprocessing.cpu_count())))
+        return pool.map(func, jobs, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_tx_signature(tx):
+    """Get `(rawhash, v, r, s)` of a tx whose sender has to be recovered
+
+    Return None if the sender is known already or does not come from ecrecover,
+    i.e. receipt-consuming txs and unsigned txs.
+    """
+    if tx._sender or is_receipt_consuming_tx(tx) or (tx.r == 0 and tx.s == 0):
+        return None
+    if tx.v in (27, 28):
+        return (get_tx_rawhash(tx), tx.v, tx.r, tx.s)
+    elif tx.v >= 37:
+        # EIP-155
+        network_id = tx.network_id
+        return (get_tx_rawhash(tx, network_id), tx.v - network_id * 2 - 8, tx.r, tx.s)
+    return None
+
+
+def get_header_signature(header):
+    """Get `(signing_hash, v, r, s)` of a collation header signed with
+    `contract_utils.sign`, or None if `header.sig` is malformed
+    """
+    if len(header.sig) != 96:
+        return None
+    return (
+        header.signing_hash,
+        utils.big_endian_to_int(header.sig[:32]),
+        utils.big_endian_to_int(header.sig[32:64]),
+        utils.big_endian_to_int(header.sig[64:]),
+    )
+
+
+def recover_addresses(signatures, processes=None):
+    """Recover the signer address of each `(msg_hash, v, r, s)` in a process
+    pool. None entries, and invalid signatures, give None.
+    """
+    signatures = list(signatures)
+    jobs = [signature for signature in signatures if signature is not None]
+    recovered = iter(pool_map(_recover_address, jobs, processes))
+    return [None if signature is None else next(recovered) for signature in signatures]
+
+
+def recover_tx_senders(txs, processes=None):
+    """Recover the senders of `txs` in a process pool and cache them on the txs,
+    so that applying the txs afterwards doesn't run ecrecover.
+
+    Txs whose signature is invalid are left alone; applying them raises the
+    same error as before.
+    Return the list of senders, with None for the txs left alone.
+    """
+    txs = list(txs)
+    senders = recover_addresses([get_tx_signature(tx) for tx in txs], processes)
+    for tx, sender in zip(txs, senders):
+        if sender is not None:
+            tx.sender = sender
+    return [tx._sender for tx in txs]
+
+
+def recover_collation_senders(collations, processes=None):
+    """Recover all tx senders and header signers of `collations` in one batch
+
+    The collations may belong to different shards. The tx senders are cached
+    on the txs, so `apply_collation` on these collations never runs
+    ecrecover.
+    Return the list of header signer addresses, with None for a header whose
+    signature is invalid.
+    """
+    collations = list(collations)
+    txs = [tx for collation in collations for tx in collation.transactions]
+    tx_signatures = [get_tx_signature(tx) for tx in txs]
+    header_signatures = [get_header_signature(collation.header) for collation in collations]
+
+    addresses = recover_addresses(tx_signatures + header_signatures, processes)
+    for tx, sender in zip(txs, addresses[:len(txs)]):
+        if sender is not None:
+            tx.sender = sender
+    return addresses[len(txs):]
+
+
+def sign_collations(collations, privkeys, processes=None):
+    """Sign the headers of `collations` with the respective `privkeys` in a
+    process pool
+    """
+    collations = list(collations)
+    jobs = [
+        (collation.header.signing_hash, privkey)
+        for collation, privkey in zip(collations, privkeys)
+    ]
+    for collation, sig in zip(collations, pool_map(_sign, jobs, processes)):
+        collation.header.sig = sig
+    return collations
+
+
+def sign_txs(txs, privkeys, network_id=None, processes=None):
+    """Sign `txs` with the respective `privkeys` in a process pool, like
+    `Transaction.sign` does, and cache the senders on the txs
+    """
+    txs = list(txs)
+    jobs = [
+        (get_tx_rawhash(tx, network_id), utils.normalize_key(privkey))
+        for tx, privkey in zip(txs, privkeys)
+    ]
+    for tx, (v, r, s, sender) in zip(txs, pool_map(_sign_tx, jobs, processes)):
+        if network_id is not None:
+            v += 8 + network_id * 2
+        tx.v, tx.r, tx.s = v, r, s
+        tx._sender = sender
+    return txs
+
+
+def mk_signed_txs(state, tx_params, network_id=None, processes=None):
+    """Make and sign a tx for each `(privkey, to, value, data, startgas, gasprice)`
+    of `tx_params`, in order
+
+    The txs of a sender get consecutive nonces from its nonce in `state`, in
+    the order of `tx_params`.
+    """
+    nonces = {}
+    txs = []
+    privkeys = []
+    for privkey, to, value, data, startgas, gasprice in tx_params:
+        if privkey not in nonces:
+            nonces[privkey] = state.get_nonce(utils.privtoaddr(privkey))
+        txs.append(Transaction(nonces[privkey], gasprice, startgas, to, value, data))
+        privkeys.append(privkey)
+        nonces[privkey] += 1
+    return sign_txs(txs, privkeys, network_id, processes)
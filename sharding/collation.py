@@ -1,5 +1,17 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+from operator import attrgetter
+try:
+    from collections.abc import MutableSequence, Sequence
+except ImportError:
+    from collections import MutableSequence, Sequence
+
 import rlp
+from rlp.codec import (
+    consume_item,
+    consume_length_prefix,
+)
+from rlp.exceptions import DecodingError
 from rlp.sedes import (
     binary,
     CountableList,
@@ -17,6 +29,9 @@ from ethereum import trie
 from ethereum.transactions import Transaction
 from sharding.config import sharding_config
 
+# The default budget of `CollationCache`, in bytes of collation RLP
+COLLATION_CACHE_BYTES = 16 * 1024 * 1024
+
 
 class CollationHeader(rlp.Serializable):
 
@@ -48,6 +63,23 @@ class CollationHeader(rlp.Serializable):
         ('sig', binary)
     ]
 
+    # Field values and memoized digests live in slots, so reading a header
+    # attribute is a plain slot load
+    __slots__ = [
+        'shard_id',
+        'expected_period_number',
+        'period_start_prevhash',
+        'parent_collation_hash',
+        'tx_list_root',
+        'coinbase',
+        'post_state_root',
+        'receipts_root',
+        'number',
+        'sig',
+        '_hash_cache',
+        '_signing_hash_cache',
+    ]
+
     def __init__(self,
                  shard_id=0,
                  expected_period_number=0,
@@ -65,16 +97,19 @@ class CollationHeader(rlp.Serializable):
         assert len(fields['coinbase']) == 20
         super(CollationHeader, self).__init__(**fields)
 
-    def __getattribute__(self, name):
-        try:
-            return rlp.Serializable.__getattribute__(self, name)
-        except AttributeError:
-            return getattr(self.header, name)
+    def __setattr__(self, name, value):
+        super(CollationHeader, self).__setattr__(name, value)
+        # Any field write invalidates the memoized digests
+        if name in _header_field_names:
+            self._hash_cache = None
+            self._signing_hash_cache = None
 
     @property
     def hash(self):
         """The binary collation hash"""
-        return utils.sha3(rlp.encode(self))
+        if self._hash_cache is None:
+            self._hash_cache = utils.sha3(rlp.encode(self))
+        return self._hash_cache
 
     @property
     def hex_hash(self):
@@ -82,7 +117,9 @@ class CollationHeader(rlp.Serializable):
 
     @property
     def signing_hash(self):
-        return utils.sha3(rlp.encode(self, CollationHeader.exclude(['sig'])))
+        if self._signing_hash_cache is None:
+            self._signing_hash_cache = utils.sha3(rlp.encode(self, _unsigned_header_sedes))
+        return self._signing_hash_cache
 
     def to_dict(self):
         """Serialize the header to a readable dictionary."""
@@ -114,6 +151,15 @@ class CollationHeader(rlp.Serializable):
         return not self.__eq__(other)
 
 
+_header_field_names = frozenset(field for field, _ in CollationHeader.fields)
+_unsigned_header_sedes = CollationHeader.exclude(['sig'])
+
+
+def _header_property(name):
+    """Read-only attribute of a collation that forwards to its header"""
+    return property(attrgetter('header.' + name), doc='collation.header.' + name)
+
+
 class Collation(rlp.Serializable):
     """A collation.
 
@@ -129,16 +175,201 @@ class Collation(rlp.Serializable):
         ('transactions', CountableList(Transaction))
     ]
 
+    __slots__ = ['header', 'transactions']
+
     def __init__(self, header, transactions=None):
         self.header = header
         self.transactions = transactions or []
 
-    def __getattribute__(self, name):
-        try:
-            return rlp.Serializable.__getattribute__(self, name)
-        except AttributeError:
-            return getattr(self.header, name)
+    shard_id = _header_property('shard_id')
+    expected_period_number = _header_property('expected_period_number')
+    period_start_prevhash = _header_property('period_start_prevhash')
+    parent_collation_hash = _header_property('parent_collation_hash')
+    tx_list_root = _header_property('tx_list_root')
+    coinbase = _header_property('coinbase')
+    post_state_root = _header_property('post_state_root')
+    receipts_root = _header_property('receipts_root')
+    number = _header_property('number')
+    sig = _header_property('sig')
+    hash = _header_property('hash')
+    hex_hash = _header_property('hex_hash')
+    signing_hash = _header_property('signing_hash')
+
+    def to_dict(self):
+        """Serialize the header to a readable dictionary."""
+        return self.header.to_dict()
 
     @property
     def transaction_count(self):
         return len(self.transactions)
+
+
+class LazyTransactionList(MutableSequence):
+    """The transaction list of an RLP encoded collation
+
+    Only the item boundaries are scanned, on first use; each transaction is
+    deserialized from the original RLP bytes when it is first accessed. It
+    compares equal to a list of the same transactions. The first mutation
+    decodes every transaction into a plain list and drops the cached RLP of
+    `collation`.
+
+    :param rlpdata: the RLP encoded collation
+    :param start: the position of the first payload byte of the list
+    :param end: the position after the last payload byte of the list
+    :param collation: the collation whose transactions these are
+    """
+
+    __hash__ = None
+
+    def __init__(self, rlpdata, start, end, collation=None):
+        self.rlpdata = rlpdata
+        self.start = start
+        self.end = end
+        self.collation = collation
+        self._offsets = None
+        self._transactions = {}
+        # The transactions, once the list was mutated
+        self._list = None
+
+    def _item_offsets(self):
+        if self._offsets is None:
+            offsets = []
+            pos = self.start
+            while pos < self.end:
+                _, length, payload_start = consume_length_prefix(self.rlpdata, pos)
+                offsets.append((pos, payload_start + length))
+                pos = payload_start + length
+            if pos != self.end:
+                raise DecodingError('List length prefix announced a too small length', self.rlpdata)
+            self._offsets = offsets
+        return self._offsets
+
+    def _get_transaction(self, index):
+        if index not in self._transactions:
+            start, end = self._item_offsets()[index]
+            item, _ = consume_item(self.rlpdata, start)
+            tx = Transaction.deserialize(item)
+            tx._cached_rlp = self.rlpdata[start:end]
+            self._transactions[index] = tx
+        return self._transactions[index]
+
+    def _materialize(self):
+        if self._list is None:
+            self._list = [self._get_transaction(i) for i in range(len(self))]
+            if self.collation is not None:
+                self.collation._cached_rlp = None
+        return self._list
+
+    def __getitem__(self, index):
+        if self._list is not None:
+            return self._list[index]
+        if isinstance(index, slice):
+            return [self._get_transaction(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Transaction index %d out of range' % index)
+        return self._get_transaction(index)
+
+    def __len__(self):
+        if self._list is not None:
+            return len(self._list)
+        return len(self._item_offsets())
+
+    def __setitem__(self, index, value):
+        self._materialize()[index] = value
+
+    def __delitem__(self, index):
+        del self._materialize()[index]
+
+    def insert(self, index, value):
+        self._materialize().insert(index, value)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or isinstance(other, (bytes, str)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return 'LazyTransactionList(%r)' % list(self)
+
+
+def decode_collation_lazy(collation_rlp):
+    """Decode a collation, deferring its transactions
+
+    The header is decoded eagerly while `transactions` is a
+    `LazyTransactionList` over `collation_rlp`. The returned collation is
+    immutable and `rlp.encode` returns `collation_rlp` itself until its
+    transactions are mutated.
+    """
+    _, length, payload_start = consume_length_prefix(collation_rlp, 0)
+    if payload_start + length != len(collation_rlp):
+        raise DecodingError('RLP length prefix announced wrong length', collation_rlp)
+    header_item, txs_start = consume_item(collation_rlp, payload_start)
+    _, txs_length, txs_payload_start = consume_length_prefix(collation_rlp, txs_start)
+
+    collation = Collation(CollationHeader.deserialize(header_item))
+    collation.transactions = LazyTransactionList(
+        collation_rlp, txs_payload_start, txs_payload_start + txs_length, collation
+    )
+    collation._cached_rlp = collation_rlp
+    collation._mutable = False
+    return collation
+
+
+class CollationCache(object):
+    """A bounded LRU cache of collations decoded with `decode_collation_lazy`,
+    keyed by collation hash
+
+    The cache is sized by the RLP length of its collations rather than by
+    their count. Lazily decoded collations are immutable, so they can be
+    handed out to several readers.
+    """
+
+    def __init__(self, max_bytes=COLLATION_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.collations = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.collations)
+
+    def __contains__(self, collation_hash):
+        return collation_hash in self.collations
+
+    def get(self, collation_hash):
+        """Get the collation `collation_hash`, or None if it isn't cached"""
+        if collation_hash not in self.collations:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry = self.collations.pop(collation_hash)
+        self.collations[collation_hash] = entry
+        return entry[0]
+
+    def add(self, collation_hash, collation_rlp):
+        """Decode `collation_rlp` lazily, cache and return it"""
+        collation = decode_collation_lazy(collation_rlp)
+        self.invalidate(collation_hash)
+        if len(collation_rlp) <= self.max_bytes:
+            self.collations[collation_hash] = (collation, len(collation_rlp))
+            self.nbytes += len(collation_rlp)
+            while self.nbytes > self.max_bytes:
+                _, (_, size) = self.collations.popitem(last=False)
+                self.nbytes -= size
+        return collation
+
+    def invalidate(self, collation_hash):
+        entry = self.collations.pop(collation_hash, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def clear(self):
+        self.collations.clear()
+        self.nbytes = 0
@@ -4,7 +4,11 @@ from ethereum.slogging import get_logger
 from ethereum.consensus_strategy import get_consensus_strategy
 from ethereum.common import mk_block_from_prevstate
 
-from sharding import state_transition
+from sharding import (
+    speculative_apply_utils,
+    state_transition,
+)
+from sharding.batch_crypto_utils import recover_tx_senders
 from sharding.contract_utils import sign
 from sharding.validator_manager_utils import call_valmgr
 from sharding.receipt_consuming_tx_utils import apply_shard_transaction
@@ -12,8 +16,20 @@ from sharding.receipt_consuming_tx_utils import apply_shard_transaction
 log = get_logger('sharding.collator')
 
 
-def apply_collation(state, collation, period_start_prevblock, mainchain_state=None, shard_id=None):
+def apply_collation(state, collation, period_start_prevblock, mainchain_state=None, shard_id=None, speculative=False,
+                    receipt_cache=None, processes=None):
     """Apply collation
+
+    receipt_cache: an optional ReceiptCache of the main chain of
+                   `mainchain_state`
+
+    speculative: execute the transactions speculatively in parallel worker
+                 processes (see speculative_apply_utils.apply_transactions);
+                 the results are the same as the serial execution
+    processes: the number of worker processes of the speculative execution
+
+    The tx senders are recovered in one batch before the txs are executed,
+    unless the caller did already, e.g. in a process pool.
     """
     snapshot = state.snapshot()
     cs = get_consensus_strategy(state.config)
@@ -23,14 +39,24 @@ def apply_collation(state, collation, period_start_prevblock, mainchain_state=No
         cs.initialize(state, period_start_prevblock)
         # assert cs.check_seal(state, period_start_prevblock.header)
         # Validate tx_list_root in collation first
-        assert state_transition.validate_transaction_tree(collation)
-        for tx in collation.transactions:
-            apply_shard_transaction(
-                mainchain_state, state, shard_id, tx
+        roots = state_transition.CollationRootsBuilder(collation.transactions)
+        assert state_transition.validate_transaction_tree(collation, roots.tx_list.root_hash)
+        recover_tx_senders(collation.transactions, processes=1)
+        if speculative:
+            speculative_apply_utils.apply_transactions(
+                mainchain_state, state, shard_id, collation.transactions,
+                processes=processes, receipt_cache=receipt_cache
             )
+            roots.receipts.sync(state.receipts)
+        else:
+            for tx in collation.transactions:
+                apply_shard_transaction(
+                    mainchain_state, state, shard_id, tx, receipt_cache
+                )
+                roots.receipts.sync(state.receipts)
         # Set state root, receipt root, etc
         state_transition.finalize(state, collation.header.coinbase)
-        assert state_transition.verify_execution_results(state, collation)
+        assert state_transition.verify_execution_results(state, collation, roots)
     except (ValueError, AssertionError) as e:
         state.revert(snapshot)
         raise e
@@ -45,7 +71,8 @@ def create_collation(
         coinbase,
         key,
         txqueue=None,
-        period_start_prevhash=None):
+        period_start_prevhash=None,
+        schedule=None):
     """Create a collation
 
     chain: MainChain
@@ -55,6 +82,10 @@ def create_collation(
     coinbase: coinbase
     key: key for sig
     txqueue: transaction queue
+    schedule: an optional tx_scheduler_utils.TxSchedule; the pending txs are
+              packed by conflict group, and the dependency DAG of the
+              included txs is recorded in it. The txs which aren't included
+              stay in `txqueue`
     """
     log.info('Creating a collation')
 
@@ -72,18 +103,30 @@ def create_collation(
     cs.initialize(temp_state, period_start_prevblock)
     # Initialize a collation with the given previous state and current coinbase
     collation = state_transition.mk_collation_from_prevstate(chain.shards[shard_id], temp_state, coinbase)
+    roots = state_transition.CollationRootsBuilder(collation.transactions, temp_state.receipts)
+    pending_txqueue = txqueue
+    if schedule is not None and txqueue:
+        txqueue = schedule.schedule(temp_state, txqueue, shard_id)
     # Add transactions
-    state_transition.add_transactions(temp_state, collation, txqueue, shard_id, mainchain_state=chain.state)
+    used_receipts = chain.shards[shard_id].used_receipt_index.get_bitmap(parent_collation_hash)
+    state_transition.add_transactions(
+        temp_state, collation, txqueue, shard_id, mainchain_state=chain.state, roots=roots,
+        used_receipts=used_receipts, receipt_cache=chain.receipt_cache
+    )
+    if schedule is not None:
+        schedule.set_transactions(temp_state, collation.transactions, shard_id)
+        if pending_txqueue is not None:
+            schedule.requeue(pending_txqueue)
     # Call the finalize state transition function
     state_transition.finalize(temp_state, collation.header.coinbase)
     # Set state root, receipt root, etc
-    state_transition.set_execution_results(temp_state, collation)
+    state_transition.set_execution_results(temp_state, collation, roots)
 
     collation.header.shard_id = shard_id
     collation.header.parent_collation_hash = parent_collation_hash
     collation.header.expected_period_number = expected_period_number
     collation.header.period_start_prevhash = period_start_prevhash
-    collation.header.number = chain.shards[shard_id].get_collation(parent_collation_hash).number + 1
+    collation.header.number = chain.shards[shard_id].get_collation_header(parent_collation_hash).number + 1
 
     try:
         sig = sign(collation.signing_hash, key)
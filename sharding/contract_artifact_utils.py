@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from ethereum import utils
+
+CONTRACTS_DIR = os.path.join(os.path.dirname(__file__), 'contracts')
+# Precompiled artifacts shipped with the package, see `build_artifacts`
+PACKAGED_ARTIFACTS_DIR = os.path.join(CONTRACTS_DIR, 'artifacts')
+# Artifacts compiled at runtime; SHARDING_ARTIFACTS_DIR overrides it, and
+# an empty value disables the on-disk cache
+DEFAULT_ARTIFACTS_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'sharding', 'artifacts')
+
+CONTRACTS = {
+    'validator_manager': 'validator_manager.v.py',
+    'used_receipt_store': 'used_receipt_store.v.py',
+}
+
+_artifacts = {}
+_compiler_version = None
+
+
+def get_artifacts_dir():
+    return os.environ.get('SHARDING_ARTIFACTS_DIR', DEFAULT_ARTIFACTS_DIR)
+
+
+def get_contract_code(name):
+    with open(os.path.join(CONTRACTS_DIR, CONTRACTS[name])) as f:
+        return f.read()
+
+
+def get_distribution_version(name):
+    """The version of the installed distribution `name`, from its metadata"""
+    try:
+        from importlib import metadata
+    except ImportError:
+        # Python < 3.8: the importlib_metadata backport, or pkg_resources
+        try:
+            import importlib_metadata as metadata
+        except ImportError:
+            metadata = None
+    if metadata is not None:
+        try:
+            return metadata.version(name)
+        except metadata.PackageNotFoundError:
+            raise RuntimeError('The {} distribution is not installed'.format(name))
+    import pkg_resources
+    try:
+        return pkg_resources.get_distribution(name).version
+    except pkg_resources.DistributionNotFound:
+        raise RuntimeError('The {} distribution is not installed'.format(name))
+
+
+def get_compiler_source_hash():
+    """A hash of the Python sources of the installed viper package"""
+    import viper
+    root = os.path.dirname(os.path.abspath(viper.__file__))
+    digest = hashlib.sha256()
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.py'):
+                path = os.path.join(directory, filename)
+                digest.update(utils.to_string(os.path.relpath(path, root)) + b'\x00')
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()
+
+
+def get_compiler_version():
+    """The version of the installed viper distribution and a hash of its
+    sources; viper installed from git keeps its version across commits
+    """
+    global _compiler_version
+    if _compiler_version is None:
+        _compiler_version = get_distribution_version('viper') + '-' + get_compiler_source_hash()
+    return _compiler_version
+
+
+def get_source_hash(code, compiler_version=''):
+    """The key of the artifact of `code`; the compiler version is part of it,
+    since another compiler may produce another bytecode
+    """
+    return utils.encode_hex(utils.sha3(utils.to_string(compiler_version) + b'\x00' + utils.to_string(code)))
+
+
+def get_artifact_path(artifacts_dir, name, source_hash):
+    return os.path.join(artifacts_dir, '%s-%s.json' % (name, source_hash))
+
+
+def compile_artifact(code):
+    """Compile a Viper contract into `{'bytecode': bytes, 'abi': list}`"""
+    from viper import compiler
+    return {
+        'bytecode': compiler.compile(code),
+        'abi': compiler.mk_full_signature(code),
+    }
+
+
+def load_artifact(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        return {'bytecode': utils.decode_hex(data['bytecode']), 'abi': data['abi']}
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_artifact(path, artifact):
+    """Write `artifact` to `path` atomically; a read-only or missing cache
+    directory only means the next process compiles again
+    """
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'bytecode': utils.encode_hex(artifact['bytecode']), 'abi': artifact['abi']}, f)
+        os.rename(temp_path, path)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def get_artifact(name):
+    """Get the bytecode and the ABI of the contract `name` of CONTRACTS
+
+    Look up the artifact by the hash of its source in this process, in the
+    packaged artifacts, in the on-disk cache, and compile it only if it is
+    in none of them.
+    """
+    if name in _artifacts:
+        return _artifacts[name]
+    code = get_contract_code(name)
+    # The packaged artifacts are built with the pinned compiler, so they
+    # are keyed by the source only
+    artifact = load_artifact(get_artifact_path(PACKAGED_ARTIFACTS_DIR, name, get_source_hash(code)))
+    if artifact is None:
+        source_hash = get_source_hash(code, get_compiler_version())
+        artifacts_dir = get_artifacts_dir()
+        path = get_artifact_path(artifacts_dir, name, source_hash) if artifacts_dir else None
+        artifact = load_artifact(path) if path else None
+        if artifact is None:
+            artifact = compile_artifact(code)
+            if path:
+                save_artifact(path, artifact)
+    _artifacts[name] = artifact
+    return artifact
+
+
+def build_artifacts(artifacts_dir=PACKAGED_ARTIFACTS_DIR):
+    """Compile all CONTRACTS into `artifacts_dir`, to be shipped with the
+    package: `python -m sharding.contract_artifact_utils`, or
+    `SHARDING_BUILD_ARTIFACTS=1 python setup.py build`
+    """
+    paths = []
+    for name in sorted(CONTRACTS):
+        code = get_contract_code(name)
+        path = get_artifact_path(artifacts_dir, name, get_source_hash(code))
+        if not save_artifact(path, compile_artifact(code)):
+            raise IOError('Failed to write the artifact {}'.format(path))
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    for path in build_artifacts():
+        print(path)
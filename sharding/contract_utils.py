@@ -1,6 +1,9 @@
+import weakref
+
 import rlp
 
 from ethereum import (
+    abi,
     utils,
     vm,
 )
@@ -42,9 +45,58 @@ def extract_sender_from_tx(tx):
     )[-20:]
 
 
+class BoundCall(object):
+    """A function of a `ContractTranslator` with its selector and ABI types
+    resolved once, instead of on every `encode_function_call` and `decode`
+
+    The arguments of a function with only static types are encoded one by
+    one, without the head/tail layout of `abi.encode_abi`.
+    """
+
+    def __init__(self, ct, func):
+        description = ct.function_data[func]
+        self.func = func
+        self.selector = utils.zpad(utils.encode_int(description['prefix']), 4)
+        self.encode_types = description['encode_types']
+        self.decode_types = description['decode_types']
+        self.proc_types = [abi.process_type(typ) for typ in self.encode_types]
+        self.is_static = all(
+            not arrlist and not (base in ('bytes', 'string') and sub == '')
+            for base, sub, arrlist in self.proc_types
+        )
+
+    def encode(self, args):
+        if self.is_static and len(args) == len(self.proc_types):
+            return self.selector + b''.join(
+                abi.encode_single(typ, arg) for typ, arg in zip(self.proc_types, args)
+            )
+        return self.selector + abi.encode_abi(self.encode_types, args)
+
+    def encode_calldata(self, args):
+        return vm.CallData(list(bytearray(self.encode(args))))
+
+    def decode(self, data):
+        return abi.decode_abi(self.decode_types, data)
+
+
+_bound_calls = weakref.WeakKeyDictionary()
+
+
+def get_bound_call(ct, func):
+    """The `BoundCall` of `func` of `ct`, cached as long as `ct` lives"""
+    try:
+        return _bound_calls[ct][func]
+    except KeyError:
+        if func not in ct.function_data:
+            raise ValueError('Unknown function {}'.format(func))
+        bound_call = BoundCall(ct, func)
+        _bound_calls.setdefault(ct, {})[func] = bound_call
+        return bound_call
+
+
 def call_msg(state, ct, func, args, sender_addr, to, value=0, startgas=STARTGAS):
-    abidata = vm.CallData([utils.safe_ord(x) for x in ct.encode_function_call(func, args)])
-    msg = vm.Message(sender_addr, to, value, startgas, abidata)
+    bound_call = get_bound_call(ct, func)
+    msg = vm.Message(sender_addr, to, value, startgas, bound_call.encode_calldata(args))
     result = apply_message(state, msg)
     if result is None:
         raise MessageFailed("Msg failed")
@@ -52,7 +104,7 @@ def call_msg(state, ct, func, args, sender_addr, to, value=0, startgas=STARTGAS)
         return result
     if result == b'':
         return None
-    o = ct.decode(func, result)
+    o = bound_call.decode(result)
     return o[0] if len(o) == 1 else o
 
 
@@ -63,6 +115,28 @@ def call_contract_constantly(state, ct, contract_addr, func, args, value=0, star
     )
 
 
+def multicall(state, calls, value=0, startgas=200000, sender_addr=b'\x00' * 20):
+    """Make the constant calls `[(ct, contract_addr, func, args), ...]` on a
+    single ephemeral clone of `state`, and return their decoded results
+
+    Each call is reverted to a snapshot before the next one, so the results
+    are the same as of one `call_contract_constantly` per call, without
+    cloning the state for each of them.
+    """
+    temp_state = state.ephemeral_clone()
+    results = []
+    for ct, contract_addr, func, args in calls:
+        snapshot = temp_state.snapshot()
+        try:
+            results.append(call_msg(
+                temp_state, ct, func, args,
+                sender_addr, contract_addr, value, startgas
+            ))
+        finally:
+            temp_state.revert(snapshot)
+    return results
+
+
 def call_contract_inconstantly(state, ct, contract_addr, func, args, value=0, startgas=200000, sender_addr=b'\x00' * 20):
     result = call_msg(
         state, ct, func, args, sender_addr, contract_addr, value, startgas
@@ -76,7 +150,7 @@ def call_tx(state, ct, func, args, sender, to, value=0, startgas=STARTGAS, gaspr
     tx = Transaction(
         state.get_nonce(utils.privtoaddr(sender)) if nonce is None else nonce,
         gasprice, startgas, to, value,
-        ct.encode_function_call(func, args)
+        get_bound_call(ct, func).encode(args)
     ).sign(sender)
     return tx
 
@@ -90,3 +164,25 @@ def create_contract_tx(state, sender_privkey, bytecode, startgas=STARTGAS):
         data=bytecode
     ).sign(sender_privkey)
     return tx
+
+
+def get_storage_slot(slot, key=0):
+    """Get the storage slot of the item `key` of the Viper mapping, struct or
+    byte array at `slot`
+
+    Viper keeps the item `key` of a mapping, and the member `key` of a struct
+    (members sorted by name), at sha3(slot) + key. A byte array keeps its
+    length at sha3(slot) and its data words from sha3(slot) + 1.
+    """
+    return (utils.big_endian_to_int(utils.sha3(utils.encode_int32(slot))) + key) % 2 ** 256
+
+
+def read_storage_bytes(state, contract_addr, slot, maxlen):
+    """Read the Viper byte array at `slot` from the storage of a contract
+    """
+    length = min(state.get_storage_data(contract_addr, get_storage_slot(slot)), maxlen)
+    words = [
+        state.get_storage_data(contract_addr, get_storage_slot(slot, i + 1))
+        for i in range((length + 31) // 32)
+    ]
+    return b''.join(utils.encode_int32(word) for word in words)[:length]
@@ -349,4 +349,10 @@ def tx_to_shard(to: address, shard_id: num, tx_startgas: num, tx_gasprice: num,
 def update_gasprice(receipt_id: num, tx_gasprice: num) -> bool:
     assert self.receipts[receipt_id].sender == msg.sender
     self.receipts[receipt_id].tx_gasprice = tx_gasprice
+
+    raw_log(
+        [sha3("update_gasprice()")],
+        concat('', as_bytes32(receipt_id))
+    )
+
     return True
@@ -20,8 +20,15 @@ from ethereum.exceptions import (
 )
 from ethereum.db import RefcountDB
 
+from sharding import parallel_apply_utils
+from sharding.receipt_consuming_tx_utils import ReceiptCache
 from sharding.shard_chain import ShardChain
 from sharding.validator_manager_utils import ADD_HEADER_TOPIC
+from sharding.validator_set_utils import (
+    ValidatorSetIndex,
+    encode_validator_events,
+    get_validator_events,
+)
 
 log = get_logger('eth.chain')
 
@@ -47,6 +54,9 @@ class MainChain(Chain):
         self.add_header_logs = []
         # used for watcher functions to see which block the event happens in
         self.processing_block = None
+        self.receipt_cache = ReceiptCache()
+        self.attach_receipt_cache()
+        self.validator_set_index = ValidatorSetIndex(self)
 
     # Call upon receiving a block
     @set_processing_block
@@ -86,6 +96,7 @@ class MainChain(Chain):
                 block.header.number) == block.header.hash
             deletes = self.state.deletes
             changed = self.state.changed
+            validator_events = get_validator_events(self.state, self.state.receipts)
         # Or is the block being added to a chain that is not currently the
         # head?
         elif block.header.prevhash in self.env.db:
@@ -103,6 +114,7 @@ class MainChain(Chain):
             deletes = temp_state.deletes
             block_score = self.get_score(block)
             changed = temp_state.changed
+            validator_events = get_validator_events(temp_state, temp_state.receipts)
             # If the block should be the new head, replace the head
             if block_score > self.get_score(self.head):
                 b = block
@@ -187,6 +199,9 @@ class MainChain(Chain):
                             pass
                 self.head_hash = block.header.hash
                 self.state = temp_state
+                # The receipts of the old head may not exist on the new one
+                self.receipt_cache.clear()
+                self.attach_receipt_cache()
                 self.state.executing_on_head = True
         # Block has no parent yet
         else:
@@ -204,6 +219,7 @@ class MainChain(Chain):
                                                        str) else k for k in list(changed.keys())]))
         # print('Saved %d address change logs' % len(changed.keys()))
         self.db.put(b'deletes:' + block.hash, b''.join(deletes))
+        self.db.put(b'validator_events:' + block.hash, encode_validator_events(validator_events))
         log.debug('Saved %d trie node deletes for block %d (%s)' %
                   (len(deletes), block.number, utils.encode_hex(block.hash)))
         # Delete old junk data
@@ -235,7 +251,8 @@ class MainChain(Chain):
         # If so, process them.
         if block.header.hash in self.parent_queue:
             for _blk in self.parent_queue[block.header.hash]:
-                if len(self.state.log_listeners) == 0:
+                # Only the receipt cache listens to a replaced state
+                if self.state.log_listeners == [self.receipt_cache.handle_log]:
                     self.append_log_listener()
 
                 self.add_block(_blk)
@@ -308,8 +325,8 @@ class MainChain(Chain):
             blockhash_list = self.shards[shard_id].collation_blockhash_lists[collhash]
             while blockhash_list:
                 blockhash = blockhash_list.pop(0)
-                given_collation_score = self.shards[shard_id].get_score(collation)
-                head_collation_score = self.shards[shard_id].get_score(self.shards[shard_id].head)
+                given_collation_score = self.shards[shard_id].get_score(collation.header)
+                head_collation_score = self.shards[shard_id].get_score(self.shards[shard_id].head_header)
                 if given_collation_score > head_collation_score:
                     self.shards[shard_id].head_collation_of_block[blockhash] = collhash
                     block = self.get_block(blockhash)
@@ -341,7 +358,7 @@ class MainChain(Chain):
                 shard.head_collation_of_block[blockhash] = shard.head_collation_of_block[block.header.prevhash]
             # Set head
             shard.head_hash = shard.head_collation_of_block[self.head_hash]
-            shard.state = shard.mk_poststate_of_collation_hash(shard.head_hash)
+            shard.update_head_state()
             # shard.state.log_listeners = log_listeners
         else:
             # The given block doesn't contain a collation
@@ -363,7 +380,7 @@ class MainChain(Chain):
                 # The shard was just initialized
                 self.shards[k].head_collation_of_block[blockhash] = self.shards[k].head_hash
             log_listeners = self.shards[k].state.log_listeners
-            self.shards[k].state = self.shards[k].mk_poststate_of_collation_hash(self.shards[k].head_hash)
+            self.shards[k].update_head_state()
             self.shards[k].state.log_listeners = log_listeners
 
     def handle_ignored_collation(self, collation):
@@ -377,6 +394,25 @@ class MainChain(Chain):
                 self.shards[collation.shard_id].add_collation(_collation, _period_start_prevblock)
                 del self.shards[collation.shard_id].parent_queue[collation.header.hash]
 
+    def add_collations(self, collations, processes=None):
+        """Add collations of different shards, applying them in parallel worker
+        processes (see parallel_apply_utils.add_collations)
+
+        Return a list of bools, in the order of `collations`.
+        """
+        jobs = [
+            (collation, self.get_block(collation.header.period_start_prevhash))
+            for collation in collations
+        ]
+        return parallel_apply_utils.add_collations(self.shards, jobs, processes)
+
+    def attach_receipt_cache(self):
+        """Let `self.receipt_cache` follow the logs of `self.state`; called
+        whenever `self.state` is replaced
+        """
+        if self.receipt_cache.handle_log not in self.state.log_listeners:
+            self.state.log_listeners.append(self.receipt_cache.handle_log)
+
     def append_log_listener(self):
         """ Append log_listeners
         """
@@ -0,0 +1,204 @@
+from ethereum.config import Env
+from ethereum.db import OverlayDB
+from ethereum.exceptions import (
+    InvalidTransaction,
+    VerificationFailed,
+)
+from ethereum.messages import Log
+from ethereum.slogging import get_logger
+from ethereum.utils import (
+    big_endian_to_int,
+    encode_hex,
+    sha3,
+    zpad,
+    encode_int,
+)
+
+from sharding.batch_crypto_utils import recover_tx_senders
+from sharding.collator import apply_collation
+from sharding.process_pool_utils import fork_map
+from sharding.used_receipt_store_utils import get_used_receipt_ids
+
+log = get_logger('sharding.parallel_apply')
+
+# The jobs of the current round; set before the pool forks, so that the
+# workers inherit the shard chains instead of unpickling them
+_jobs = []
+
+
+def _get_refcount_node(key, value):
+    """Return `(refcount, node)` if `value` is a RefcountDB entry of `key`,
+    i.e. a 4-byte refcount followed by the trie node hashed to `key`
+    """
+    if value is None or len(value) < 4 or sha3(value[4:]) != key:
+        return None
+    return big_endian_to_int(value[:4]), value[4:]
+
+
+def get_overlay_diff(overlay_db):
+    """Split the writes in `overlay_db` into RefcountDB node deltas and raw writes
+
+    Return `(node_deltas, raw_writes)`:
+        node_deltas: list of `(key, refcount_delta, node)`, relative to the
+                     underlying db
+        raw_writes: list of `(key, value)`, with None for a delete
+    Refcount deltas, unlike the new refcounts, can be applied on top of the
+    writes of other shards that share the same trie nodes.
+    """
+    node_deltas = []
+    raw_writes = []
+    for key, value in overlay_db.overlay.items():
+        try:
+            base_value = overlay_db.db.get(key)
+        except KeyError:
+            base_value = None
+        new_entry = _get_refcount_node(key, value)
+        base_entry = _get_refcount_node(key, base_value)
+        if new_entry is not None and (base_value is None or base_entry is not None):
+            base_count = base_entry[0] if base_entry else 0
+            node_deltas.append((key, new_entry[0] - base_count, new_entry[1]))
+        elif value is None and base_entry is not None:
+            node_deltas.append((key, -base_entry[0], base_entry[1]))
+        else:
+            raw_writes.append((key, value))
+    return node_deltas, raw_writes
+
+
+def apply_overlay_diff(db, node_deltas, raw_writes):
+    """Apply the result of `get_overlay_diff` on `db`
+    """
+    for key, value in raw_writes:
+        if value is None:
+            if key in db:
+                db.delete(key)
+        else:
+            db.put(key, value)
+    for key, delta, node in node_deltas:
+        try:
+            count = big_endian_to_int(db.get(key)[:4])
+        except KeyError:
+            count = 0
+        count += delta
+        if count > 0:
+            db.put(key, zpad(encode_int(count), 4) + node)
+        elif key in db:
+            db.delete(key)
+
+
+def _apply_job(index):
+    """Apply the collation of `_jobs[index]` on an overlay of its shard db
+
+    Run in a worker process. Return a picklable result dict.
+    """
+    shard, collation, period_start_prevblock = _jobs[index]
+    env = Env(OverlayDB(shard.db), shard.env.config, shard.env.global_config)
+    state = shard.mk_poststate_of_collation_hash(collation.header.parent_collation_hash, env)
+    receipt_count = len(state.receipts)
+    logs = []
+    state.log_listeners = [logs.append]
+    try:
+        apply_collation(
+            state, collation, period_start_prevblock,
+            None if shard.main_chain is None else shard.main_chain.state,
+            shard.shard_id,
+            receipt_cache=None if shard.main_chain is None else shard.main_chain.receipt_cache
+        )
+    except (AssertionError, KeyError, ValueError, InvalidTransaction, VerificationFailed) as e:
+        return {'valid': False, 'error': str(e)}
+    node_deltas, raw_writes = get_overlay_diff(env.db)
+    return {
+        'valid': True,
+        'node_deltas': node_deltas,
+        'raw_writes': raw_writes,
+        'changed': list(state.changed),
+        'deletes': list(state.deletes),
+        'logs': [(l.address, l.topics, l.data) for l in logs],
+        'used_receipt_ids': get_used_receipt_ids(
+            shard.shard_id, [l for r in state.receipts[receipt_count:] for l in r.logs]
+        ),
+    }
+
+
+def _commit_result(shard, collation, result):
+    """Commit the result of `_apply_job` to `shard`, the same way
+    `ShardChain.add_collation` does
+    """
+    shard.processing_collation = collation
+    try:
+        shard.call_add_collation_listeners(collation=collation)
+        if not result['valid']:
+            shard.call_invalid_collation_listeners(collation=collation)
+            log.info('Collation %s with parent %s invalid, reason: %s' %
+                     (encode_hex(collation.header.hash), encode_hex(collation.header.parent_collation_hash), result['error']))
+            return False
+        apply_overlay_diff(shard.db, result['node_deltas'], result['raw_writes'])
+        for address, topics, data in result['logs']:
+            _log = Log(address, topics, data)
+            for listener in shard.state.log_listeners:
+                listener(_log)
+        return shard.store_collation(
+            collation, result['changed'], result['deletes'], result['used_receipt_ids']
+        )
+    finally:
+        shard.processing_collation = None
+
+
+def get_rounds(jobs):
+    """Split the indices of `jobs` into rounds with at most one collation per
+    shard, keeping the order of the collations within a shard
+    """
+    rounds = []
+    shard_rounds = {}
+    for i, (collation, _) in enumerate(jobs):
+        round_index = shard_rounds.get(collation.header.shard_id, 0)
+        shard_rounds[collation.header.shard_id] = round_index + 1
+        if round_index == len(rounds):
+            rounds.append([])
+        rounds[round_index].append(i)
+    return rounds
+
+
+def add_collations(shards, jobs, processes=None):
+    """Add collations of different shards, applying them in parallel
+
+    shards: dict of shard_id -> ShardChain
+    jobs: list of `(collation, period_start_prevblock)`
+    processes: the number of worker processes, defaults to the number of
+               cores; 1 applies the collations in this process
+
+    The tx senders are recovered in one batch first. Each worker applies one
+    collation on an OverlayDB of the shard db.
+    The results are committed in shard_id order, so the db and the callbacks
+    end up the same as adding the collations one by one with
+    `ShardChain.add_collation`. Collations whose parent is not in the db
+    are passed to `ShardChain.add_collation` and get queued there.
+    Return a list of bools, in the order of `jobs`.
+    """
+    global _jobs
+    jobs = list(jobs)
+    results = [False] * len(jobs)
+    # Recover the tx senders of all collations in one batch before the pool
+    # forks, so no worker runs ecrecover
+    recover_tx_senders([tx for collation, _ in jobs for tx in collation.transactions], processes)
+    for round_indices in get_rounds(jobs):
+        applicable = []
+        for i in sorted(round_indices, key=lambda i: jobs[i][0].header.shard_id):
+            collation, period_start_prevblock = jobs[i]
+            shard = shards[collation.header.shard_id]
+            if collation.header.parent_collation_hash in shard.db:
+                applicable.append(i)
+            else:
+                results[i] = shard.add_collation(collation, period_start_prevblock)
+
+        _jobs = [
+            (shards[jobs[i][0].header.shard_id], jobs[i][0], jobs[i][1])
+            for i in applicable
+        ]
+        try:
+            round_results = fork_map(_apply_job, len(_jobs), processes)
+        finally:
+            _jobs = []
+        for i, result in zip(applicable, round_results):
+            collation = jobs[i][0]
+            results[i] = _commit_result(shards[collation.header.shard_id], collation, result)
+    return results
@@ -0,0 +1,27 @@
+import multiprocessing
+
+
+def fork_map(func, count, processes=None):
+    """Return `[func(i) for i in range(count)]`, computed in forked worker
+    processes
+
+    The workers inherit the memory of this process, so `func` can read
+    unpicklable module globals set up beforehand (e.g. states and chains);
+    only the indices and the results are pickled.
+    `processes=1`, or a platform without fork, runs `func` in this process.
+    """
+    if processes == 1 or count < 2:
+        return [func(i) for i in range(count)]
+    try:
+        context = multiprocessing.get_context('fork')
+    except AttributeError:
+        # Python 2 always forks
+        context = multiprocessing
+    except ValueError:
+        return [func(i) for i in range(count)]
+    pool = context.Pool(min(count, processes or multiprocessing.cpu_count()))
+    try:
+        return pool.map(func, range(count), 1)
+    finally:
+        pool.close()
+        pool.join()
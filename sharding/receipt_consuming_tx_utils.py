@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 from ethereum import (
     opcodes,
     utils,
@@ -20,16 +22,74 @@ from ethereum.exceptions import (
 
 from sharding.contract_utils import call_contract_inconstantly
 from sharding.used_receipt_store_utils import (
-    call_urs,
     get_urs_ct,
     get_urs_contract,
+    is_receipt_used,
 )
 from sharding.validator_manager_utils import (
-    call_valmgr,
+    TX_TO_SHARD_TOPIC,
+    UPDATE_GASPRICE_TOPIC,
+    get_receipt,
 )
 
 log_rctx = get_logger('sharding.rctx')
 
+RECEIPT_CACHE_SIZE = 1024
+
+
+class ReceiptCache(object):
+    """A bounded LRU cache of the receipts of the validator manager
+
+    A receipt is only written by `tx_to_shard`, which creates it, and by
+    `update_gasprice`; both log its receipt id. The whole receipt is cached,
+    and `handle_log` drops the receipt id of those logs. The entries follow
+    the state the cache listens to: every MainChain keeps its own cache
+    (`MainChain.receipt_cache`) on the logs of `MainChain.state`, and clears
+    it on a reorg. Look up only that state through the cache.
+    """
+
+    def __init__(self, max_size=RECEIPT_CACHE_SIZE):
+        self.max_size = max_size
+        self.receipts = OrderedDict()
+
+    def __len__(self):
+        return len(self.receipts)
+
+    def __contains__(self, receipt_id):
+        return receipt_id in self.receipts
+
+    def get(self, mainchain_state, receipt_id):
+        """Get the receipt `receipt_id` like `get_receipt` does"""
+        if receipt_id in self.receipts:
+            self.receipts[receipt_id] = self.receipts.pop(receipt_id)
+            return dict(self.receipts[receipt_id])
+        receipt = get_receipt(mainchain_state, receipt_id)
+        # Don't cache a receipt which doesn't exist yet
+        if receipt['value'] > 0:
+            self.add(receipt_id, receipt)
+        return receipt
+
+    def add(self, receipt_id, receipt):
+        self.receipts.pop(receipt_id, None)
+        self.receipts[receipt_id] = dict(receipt)
+        while len(self.receipts) > self.max_size:
+            self.receipts.popitem(last=False)
+
+    def invalidate(self, receipt_id):
+        self.receipts.pop(receipt_id, None)
+
+    def clear(self):
+        self.receipts.clear()
+
+    def handle_log(self, log):
+        """A log listener of the main chain state for the `tx_to_shard()`
+        and `update_gasprice()` logs
+        """
+        if log.topics and log.topics[0] in (
+                utils.big_endian_to_int(TX_TO_SHARD_TOPIC),
+                utils.big_endian_to_int(UPDATE_GASPRICE_TOPIC)):
+            self.invalidate(utils.big_endian_to_int(log.data))
+
 
 def simplified_validate_transaction(state, tx):
     '''A simplified and modified one from
@@ -53,33 +113,50 @@ def is_receipt_consuming_tx(tx):
     )
 
 
-def validate_receipt_consuming_tx(mainchain_state, shard_state, shard_id, tx):
+def get_valid_receipt(mainchain_state, shard_state, shard_id, tx, used_receipts=None, receipt_cache=None):
+    """Validate a receipt-consuming tx against its receipt, fetched in one
+    pass from the validator manager storage, and return the receipt
+
+    used_receipts: an optional used_receipt_store_utils.UsedReceiptBitmap of
+                   `shard_state`, checked instead of the URS storage
+    receipt_cache: an optional ReceiptCache of the main chain of
+                   `mainchain_state`
+    """
     if not tx.to or tx.to == CREATE_CONTRACT_ADDRESS:
         raise InvalidTransaction('tx.to is invalid: {}'.format(utils.encode_hex(tx.to)))
 
     simplified_validate_transaction(shard_state, tx)
 
     receipt_id = tx.r
-    receipt_shard_id = call_valmgr(mainchain_state, 'get_receipts__shard_id', [receipt_id])
-    receipt_startgas = call_valmgr(mainchain_state, 'get_receipts__tx_startgas', [receipt_id])
-    receipt_gasprice = call_valmgr(mainchain_state, 'get_receipts__tx_gasprice', [receipt_id])
-    receipt_value = call_valmgr(mainchain_state, 'get_receipts__value', [receipt_id])
-    if receipt_value <= 0:
+    if receipt_cache is None:
+        receipt = get_receipt(mainchain_state, receipt_id)
+    else:
+        receipt = receipt_cache.get(mainchain_state, receipt_id)
+    if receipt['value'] <= 0:
         raise InvalidTransaction('receipt_value <= 0')
-    receipt_to = call_valmgr(mainchain_state, 'get_receipts__to', [receipt_id])
-    if receipt_shard_id != shard_id:
-        raise InvalidTransaction('receipt_shard_id({}) != shard_id({})'.format(receipt_shard_id, shard_id))
-    if receipt_startgas != tx.startgas:
-        raise InvalidTransaction('receipt_startgas({}) != tx.startgas({})'.format(receipt_startgas, tx.startgas))
-    if receipt_gasprice != tx.gasprice:
-        raise InvalidTransaction('receipt_gasprice({}) != tx.gasprice({})'.format(receipt_gasprice, tx.gasprice))
-    if receipt_value != tx.value:
-        raise InvalidTransaction('receipt_value({}) != tx.value({})'.format(receipt_value, tx.value))
-    if receipt_to != hex(utils.big_endian_to_int((tx.to))):
-        raise InvalidTransaction('receipt_to({}) != tx.to({})'.format(receipt_to, hex(utils.big_endian_to_int((tx.to)))))
-    if call_urs(shard_state, shard_id, 'get_used_receipts', [receipt_id]):
+    if receipt['shard_id'] != shard_id:
+        raise InvalidTransaction('receipt_shard_id({}) != shard_id({})'.format(receipt['shard_id'], shard_id))
+    if receipt['tx_startgas'] != tx.startgas:
+        raise InvalidTransaction('receipt_startgas({}) != tx.startgas({})'.format(receipt['tx_startgas'], tx.startgas))
+    if receipt['tx_gasprice'] != tx.gasprice:
+        raise InvalidTransaction('receipt_gasprice({}) != tx.gasprice({})'.format(receipt['tx_gasprice'], tx.gasprice))
+    if receipt['value'] != tx.value:
+        raise InvalidTransaction('receipt_value({}) != tx.value({})'.format(receipt['value'], tx.value))
+    if receipt['to'] != utils.normalize_address(tx.to):
+        raise InvalidTransaction('receipt_to({}) != tx.to({})'.format(utils.encode_hex(receipt['to']), utils.encode_hex(tx.to)))
+    if used_receipts is not None:
+        is_used = used_receipts.is_used(receipt_id)
+    else:
+        is_used = is_receipt_used(shard_state, shard_id, receipt_id)
+    if is_used:
         raise InvalidTransaction('The receipt_id {} of shard {} has been used'.format(receipt_id, shard_id))
 
+    return receipt
+
+
+def validate_receipt_consuming_tx(mainchain_state, shard_state, shard_id, tx, used_receipts=None,
+                                  receipt_cache=None):
+    get_valid_receipt(mainchain_state, shard_state, shard_id, tx, used_receipts, receipt_cache)
     return True
 
 
@@ -92,8 +169,8 @@ def send_msg_add_used_receipt(state, shard_id, receipt_id):
     )
 
 
-def send_msg_transfer_value(mainchain_state, shard_state, shard_id, tx):
-    validate_receipt_consuming_tx(mainchain_state, shard_state, shard_id, tx)
+def send_msg_transfer_value(mainchain_state, shard_state, shard_id, tx, receipt_cache=None):
+    receipt = get_valid_receipt(mainchain_state, shard_state, shard_id, tx, receipt_cache=receipt_cache)
 
     urs_addr = get_urs_contract(shard_id)['addr']
     log_rctx.debug("Begin: urs.balance={}, tx.to.balance={}".format(shard_state.get_balance(urs_addr), shard_state.get_balance(tx.to)))
@@ -110,9 +187,7 @@ def send_msg_transfer_value(mainchain_state, shard_state, shard_id, tx):
     if not send_msg_add_used_receipt(shard_state, shard_id, receipt_id):
         return False, None
 
-    receipt_sender_hex = call_valmgr(mainchain_state, 'get_receipts__sender', [receipt_id])
-    receipt_data = call_valmgr(mainchain_state, 'get_receipts__data', [receipt_id])
-    msg_data = (b'00' * 12) + utils.parse_as_bin(receipt_sender_hex) + receipt_data
+    msg_data = (b'00' * 12) + receipt['sender'] + receipt['data']
     msg = vm.Message(urs_addr, tx.to, value, tx.startgas - tx.intrinsic_gas_used, msg_data)
     env_tx = Transaction(0, tx.gasprice, tx.startgas, b'', 0, b'')
     env_tx._sender = urs_addr
@@ -178,15 +253,18 @@ def send_msg_transfer_value(mainchain_state, shard_state, shard_id, tx):
     return success, output
 
 
-def apply_shard_transaction(mainchain_state, shard_state, shard_id, tx):
+def apply_shard_transaction(mainchain_state, shard_state, shard_id, tx, receipt_cache=None):
     """Apply shard transactions, including both receipt-consuming and normal
     transactions.
+
+    receipt_cache: an optional ReceiptCache of the main chain of
+                   `mainchain_state`
     """
     if (mainchain_state is not None and
             shard_id is not None and
             is_receipt_consuming_tx(tx)):
         success, output = send_msg_transfer_value(
-            mainchain_state, shard_state, shard_id, tx
+            mainchain_state, shard_state, shard_id, tx, receipt_cache
         )
     else:
         success, output = apply_transaction(shard_state, tx)
@@ -10,6 +10,7 @@ from ethereum.exceptions import (
 )
 from ethereum.slogging import get_logger
 from ethereum.config import Env
+from ethereum.db import RefcountDB
 from ethereum.state import State
 from ethereum.pow.consensus import initialize
 from ethereum.utils import (
@@ -18,11 +19,29 @@ from ethereum.utils import (
 )
 
 from sharding.collation import (
+    COLLATION_CACHE_BYTES,
+    CollationCache,
     CollationHeader,
     Collation,
+    decode_collation_lazy,
 )
+from sharding.batch_crypto_utils import recover_tx_senders
 from sharding.collator import apply_collation
+from sharding.state_cache_utils import (
+    POST_STATE_CACHE_SIZE,
+    PostStateCache,
+)
 from sharding.state_transition import update_collation_env_variables
+from sharding.used_receipt_store_utils import (
+    UsedReceiptIndex,
+    encode_receipt_ids,
+    get_used_receipt_ids,
+)
+
+# The version of the `score:` index; dbs below it are migrated on start
+SCORE_INDEX_VERSION = 1
+# The most collations `ShardChain.prune` retires per call
+PRUNE_BATCH_SIZE = 64
 
 log = get_logger('sharding.shard_chain')
 log.setLevel(logging.DEBUG)
@@ -55,8 +74,17 @@ def set_processing_collation(func):
 class ShardChain(object):
     def __init__(self, shard_id, env=None,
                  new_head_cb=None, reset_genesis=False, localtime=None, max_history=1000,
-                 initial_state=None, main_chain=None, **kwargs):
+                 initial_state=None, main_chain=None, collation_cache_bytes=COLLATION_CACHE_BYTES,
+                 post_state_cache_size=POST_STATE_CACHE_SIZE, crypto_processes=1, **kwargs):
         self.env = env or Env()
+        # The processes `add_collation` recovers the tx senders in; a pool
+        # only pays off for big collations, so callers opt in
+        self.crypto_processes = crypto_processes
+        self.collation_cache = CollationCache(collation_cache_bytes)
+        self.post_state_cache = PostStateCache(post_state_cache_size)
+        # The collation whose post-state `self.state` was made of by
+        # `update_head_state`
+        self.head_state_hash = None
         self.shard_id = shard_id
         self.active = False
         self.is_syncing = True
@@ -111,6 +139,10 @@ class ShardChain(object):
         self.parent_queue = {}
         self.localtime = time.time() if localtime is None else localtime
         self.max_history = max_history
+        # The bytes of trie nodes and logs retired by `prune` so far
+        self.pruned_bytes = 0
+        self.used_receipt_index = UsedReceiptIndex(self)
+        self.migrate_score_index()
 
     @property
     def db(self):
@@ -121,14 +153,13 @@ class ShardChain(object):
         """head collation
         """
         try:
-            collation_rlp = self.db.get(self.head_hash)
+            collation = self.load_collation(self.head_hash)
             # [TODO] no genesis collation
-            if collation_rlp == 'GENESIS':
+            if collation is None:
                 return Collation(CollationHeader())
                 # return self.genesis
             else:
-                return rlp.decode(collation_rlp, Collation)
-            return rlp.decode(collation_rlp, Collation)
+                return collation
         except Exception as e:
             log.info(str(e))
             return None
@@ -144,13 +175,17 @@ class ShardChain(object):
             if self.is_first_collation(collation):
                 log.debug('It is the first collation of shard {}'.format(self.shard_id))
             temp_state = self.mk_poststate_of_collation_hash(collation.header.parent_collation_hash)
+            receipt_count = len(temp_state.receipts)
             self.call_add_collation_listeners(collation=collation)
             print("!@# add_collation: len(temp_state.log_listeners)={}".format(len(temp_state.log_listeners)))
+            # Run ecrecover for all the txs at once, not in the apply loop
+            recover_tx_senders(collation.transactions, self.crypto_processes)
             try:
                 apply_collation(
                     temp_state, collation, period_start_prevblock,
                     None if self.main_chain is None else self.main_chain.state,
-                    self.shard_id
+                    self.shard_id,
+                    receipt_cache=None if self.main_chain is None else self.main_chain.receipt_cache
                 )
             except (AssertionError, KeyError, ValueError, InvalidTransaction, VerificationFailed) as e:
                 print("!@# invalid_collation: in add_collation")
@@ -160,6 +195,9 @@ class ShardChain(object):
                 return False
             deletes = temp_state.deletes
             changed = temp_state.changed
+            used_receipt_ids = get_used_receipt_ids(
+                self.shard_id, [l for r in temp_state.receipts[receipt_count:] for l in r.logs]
+            )
             collation_score = self.get_score(collation)
             log.info('collation_score of {} is {}'.format(encode_hex(collation.header.hash), collation_score))
         # Collation has no parent yet
@@ -174,17 +212,37 @@ class ShardChain(object):
             self.parent_queue[collation.header.parent_collation_hash].append(collation)
             log.info('No parent found. Delaying for now')
             return False
-        self.db.put(collation.header.hash, rlp.encode(collation))
+        return self.store_collation(collation, changed, deletes, used_receipt_ids)
 
-        self.db.put(b'changed:'+collation.hash, b''.join(list(changed.keys())))
+    def store_collation(self, collation, changed, deletes, used_receipt_ids=()):
+        """Store an applied collation and run the post-add callbacks
+
+        changed: the accounts changed by the collation
+        deletes: the trie nodes deleted by the collation
+        used_receipt_ids: the receipt ids used by the collation
+        """
+        collation_rlp = rlp.encode(collation)
+        self.db.put(collation.header.hash, collation_rlp)
+        self.db.put(b'header:' + collation.header.hash, rlp.encode(collation.header))
+        # Committed with the collation, so `get_score` never walks stored ones
+        self.db.put(b'score:' + collation.header.hash, str(self.get_score(collation.header)))
+        self.db.put(
+            b'skip:' + collation.header.hash,
+            rlp.encode(self.mk_skip_pointers(collation.header.parent_collation_hash))
+        )
+        # The new collation is likely the next head
+        self.collation_cache.add(collation.header.hash, collation_rlp)
+
+        self.db.put(b'changed:'+collation.hash, b''.join(list(changed)))
         # log.debug('Saved %d address change logs' % len(changed.keys()))
         self.db.put(b'deletes:'+collation.hash, b''.join(deletes))
         # log.debug('Saved %d trie node deletes for collation (%s)' % (len(deletes), encode_hex(collation.hash)))
-
-        # TODO: Delete old junk data
-        # deletes, changed
+        self.db.put(b'used_receipts:' + collation.hash, encode_receipt_ids(used_receipt_ids))
+        self.index_collation_depth(collation.header.hash)
 
         self.db.commit()
+        # Delete old junk data
+        self.prune()
         log.info(
             'Added collation (%s) with %d txs' %
             (encode_hex(collation.header.hash)[:8],
@@ -208,31 +266,65 @@ class ShardChain(object):
 
         return True
 
-    def mk_poststate_of_collation_hash(self, collation_hash):
+    def mk_poststate_of_collation_hash(self, collation_hash, env=None):
         """Return the post-state of the collation
+
+        env: the Env of the returned state, e.g. one over an OverlayDB of
+             `self.db`; defaults to `self.env`
         """
-        if collation_hash not in self.db:
-            raise Exception("Collation hash %s not found" % encode_hex(collation_hash))
-
-        collation_rlp = self.db.get(collation_hash)
-        if collation_rlp == 'GENESIS':
-            return State.from_snapshot(json.loads(self.db.get('SHARD_' + str(self.shard_id) + '_GENESIS_STATE')), self.env)
-        collation = rlp.decode(collation_rlp, Collation)
-
-        state = State(env=self.env)
-        state.trie.root_hash = collation.header.post_state_root
-
-        update_collation_env_variables(state, collation)
-        state.gas_used = 0
-        state.txindex = len(collation.transactions)
-        state.recent_uncles = {}
-        state.prev_headers = []
+        env = env or self.env
+        state = self.post_state_cache.get(collation_hash, env)
+        if state is None:
+            if collation_hash not in self.collation_cache and collation_hash not in self.db:
+                raise Exception("Collation hash %s not found" % encode_hex(collation_hash))
+
+            collation = self.load_collation(collation_hash)
+            if collation is None:
+                return State.from_snapshot(json.loads(self.db.get('SHARD_' + str(self.shard_id) + '_GENESIS_STATE')), env)
+
+            state = State(env=env)
+            state.trie.root_hash = collation.header.post_state_root
+
+            update_collation_env_variables(state, collation)
+            state.gas_used = 0
+            state.txindex = len(collation.transactions)
+            state.recent_uncles = {}
+            state.prev_headers = []
+            self.post_state_cache.add(collation_hash, state)
         # TODO: any better solution to handle `log_listeners`?
         state.log_listeners = self.state.log_listeners
 
         assert len(state.journal) == 0, state.journal
         return state
 
+    def update_head_state(self):
+        """Set `self.state` to the post-state of `self.head_hash`
+
+        The current state is kept if it is the untouched post-state of the
+        head already, which is the case of most shards on most main chain
+        blocks.
+        """
+        root = self.post_state_cache.get_root(self.head_hash)
+        if (self.head_state_hash == self.head_hash and root is not None and
+                len(self.state.journal) == 0 and self.state.trie.root_hash == root):
+            return
+        self.state = self.mk_poststate_of_collation_hash(self.head_hash)
+        self.head_state_hash = self.head_hash
+
+    def load_collation(self, collation_hash):
+        """Get the lazily decoded collation `collation_hash` from
+        `self.collation_cache`, or from the db on a miss
+
+        Return None for the genesis placeholder.
+        """
+        collation = self.collation_cache.get(collation_hash)
+        if collation is None:
+            collation_rlp = self.db.get(collation_hash)
+            if collation_rlp == 'GENESIS':
+                return None
+            collation = self.collation_cache.add(collation_hash, collation_rlp)
+        return collation
+
     def get_parent(self, collation):
         """Get the parent collation of a given collation
         """
@@ -244,49 +336,319 @@ class ShardChain(object):
         """Get the collation with a given collation hash
         """
         try:
-            collation_rlp = self.db.get(collation_hash)
-            if collation_rlp == 'GENESIS':
+            collation = self.load_collation(collation_hash)
+            if collation is None:
                 return Collation(CollationHeader())
                 # if not hasattr(self, 'genesis'):
                 #     self.genesis = rlp.decode(self.db.get('GENESIS_RLP'), sedes=Block)
                 # return self.genesis
             else:
-                return rlp.decode(collation_rlp, Collation)
+                return collation
         except Exception as e:
             log.debug("Failed to get collation", hash=encode_hex(collation_hash), error=str(e))
             return None
 
-    def get_score(self, collation):
-        """Get the score of a given collation
+    def get_collation_header(self, collation_hash):
+        """Get the collation header with a given collation hash
+
+        Headers are read from their own `header:` records, so no collation
+        body is loaded. Collations stored without a header record fall back
+        to decoding the header out of the collation RLP.
         """
-        score = 0
+        try:
+            header_key = b'header:' + collation_hash
+            if header_key in self.db:
+                return rlp.decode(self.db.get(header_key), CollationHeader)
+            collation_rlp = self.db.get(collation_hash)
+            if collation_rlp == 'GENESIS':
+                return CollationHeader()
+            else:
+                return decode_collation_lazy(collation_rlp).header
+        except Exception as e:
+            log.debug("Failed to get collation header", hash=encode_hex(collation_hash), error=str(e))
+            return None
 
+    def get_parent_header(self, header):
+        """Get the parent collation header of a given collation header
+        """
+        if header.parent_collation_hash == self.env.config['GENESIS_PREVHASH']:
+            return None
+        return self.get_collation_header(header.parent_collation_hash)
+
+    @property
+    def head_header(self):
+        """head collation header
+        """
+        return self.get_collation_header(self.head_hash)
+
+    def get_score(self, collation):
+        """Get the score of a given collation or collation header
+
+        The score of a stored collation is indexed under `score:<hash>` by
+        `store_collation`, so it is a single lookup. Other collations get the
+        score of their parent plus one.
+        """
         if not collation:
             return 0
-        key = b'score:' + collation.header.hash
-
+        header = collation.header if isinstance(collation, Collation) else collation
+        key = b'score:' + header.hash
+        if key in self.db:
+            return int(self.db.get(key))
+        return self.fill_scores(header)
+
+    def fill_scores(self, header):
+        """Index the scores of `header` and of its ancestors without one,
+        walking back to the closest indexed ancestor
+        """
+        key = b'score:' + header.hash
         fills = []
 
-        while key not in self.db and collation is not None:
-            fills.insert(0, collation.header.hash)
-            key = b'score:' + collation.header.parent_collation_hash
-            collation = self.get_parent(collation)
+        while key not in self.db and header is not None:
+            fills.append(header.hash)
+            key = b'score:' + header.parent_collation_hash
+            header = self.get_parent_header(header)
 
         score = int(self.db.get(key))
-        log.debug('int(self.db.get(key)):{}'.format(int(self.db.get(key))))
+        log.debug('int(self.db.get(key)):{}'.format(score))
 
-        for h in fills:
-            key = b'score:' + h
+        for h in reversed(fills):
             score += 1
-            self.db.put(key, str(score))
+            self.db.put(b'score:' + h, str(score))
 
         return score
 
+    def migrate_score_index(self):
+        """Index the scores of the collations of a db written before
+        `store_collation` indexed them
+
+        The stored collations are walked from the head back through their
+        parent hashes to the closest indexed one, and indexed once; the db is
+        then marked as migrated. Collations off the chain of the head are
+        indexed by `get_score` when they are first looked up.
+        Return whether anything was done.
+        """
+        version_key = 'shard_' + str(self.shard_id) + '_score_index_version'
+        if version_key in self.db and int(self.db.get(version_key)) >= SCORE_INDEX_VERSION:
+            return False
+        genesis_hash = self.env.config['GENESIS_PREVHASH']
+        collation_hashes = []
+        collation_hash = self.head_hash
+        while collation_hash != genesis_hash and b'score:' + collation_hash not in self.db:
+            header = self.get_collation_header(collation_hash)
+            if header is None:
+                log.info('Collation %s is not stored, the score index is not migrated' %
+                         encode_hex(collation_hash))
+                return False
+            collation_hashes.append(collation_hash)
+            collation_hash = header.parent_collation_hash
+        score = 0 if collation_hash == genesis_hash else int(self.db.get(b'score:' + collation_hash))
+        for collation_hash in reversed(collation_hashes):
+            score += 1
+            self.db.put(b'score:' + collation_hash, str(score))
+        self.db.put(version_key, str(SCORE_INDEX_VERSION))
+        self.db.commit()
+        return True
+
+    def get_depth(self, collation_hash):
+        """The number of collations from the genesis to `collation_hash`"""
+        if collation_hash == self.env.config['GENESIS_PREVHASH']:
+            return 0
+        key = b'score:' + collation_hash
+        if key in self.db:
+            return int(self.db.get(key))
+        return self.get_score(self.get_collation_header(collation_hash))
+
+    def mk_skip_pointers(self, parent_collation_hash):
+        """The skip pointers of a child of `parent_collation_hash`: its
+        ancestors at distance 1, 2, 4, ..., as far as the genesis
+        """
+        genesis_hash = self.env.config['GENESIS_PREVHASH']
+        pointers = []
+        collation_hash = parent_collation_hash
+        while collation_hash != genesis_hash:
+            pointers.append(collation_hash)
+            # The pointer `i` of the ancestor at distance 2**i is at 2**(i+1)
+            ancestor_pointers = self.get_skip_pointers(collation_hash)
+            if len(pointers) > len(ancestor_pointers):
+                break
+            collation_hash = ancestor_pointers[len(pointers) - 1]
+        return pointers
+
+    def get_skip_pointers(self, collation_hash):
+        """Get the skip pointers of `collation_hash` stored under `skip:`
+
+        Collations stored before the index existed get theirs built from
+        the closest ancestor which has them.
+        """
+        if collation_hash == self.env.config['GENESIS_PREVHASH']:
+            return []
+        key = b'skip:' + collation_hash
+        if key not in self.db:
+            missing = []
+            header = self.get_collation_header(collation_hash)
+            while header is not None and (b'skip:' + header.hash) not in self.db:
+                missing.append(header)
+                header = self.get_parent_header(header)
+            for header in reversed(missing):
+                self.db.put(b'skip:' + header.hash, rlp.encode(self.mk_skip_pointers(header.parent_collation_hash)))
+        return rlp.decode(self.db.get(key))
+
+    def get_ancestor(self, collation_hash, distance):
+        """Get the hash of the ancestor of `collation_hash` at `distance` in
+        O(log(distance)) lookups; GENESIS_PREVHASH at the full depth, None
+        beyond it
+        """
+        depth = self.get_depth(collation_hash)
+        if distance > depth:
+            return None
+        if distance == depth:
+            return self.env.config['GENESIS_PREVHASH']
+        i = 0
+        while distance:
+            if distance & 1:
+                collation_hash = self.get_skip_pointers(collation_hash)[i]
+            distance >>= 1
+            i += 1
+        return collation_hash
+
+    def get_common_ancestor(self, collation_hash1, collation_hash2):
+        """Get the hash of the closest common ancestor of two collations,
+        which can be one of them
+        """
+        depth1 = self.get_depth(collation_hash1)
+        depth2 = self.get_depth(collation_hash2)
+        if depth1 > depth2:
+            collation_hash1 = self.get_ancestor(collation_hash1, depth1 - depth2)
+        elif depth2 > depth1:
+            collation_hash2 = self.get_ancestor(collation_hash2, depth2 - depth1)
+        if collation_hash1 == collation_hash2:
+            return collation_hash1
+        # Jump as far as the ancestors differ, the parents are then common
+        pointers1 = self.get_skip_pointers(collation_hash1)
+        pointers2 = self.get_skip_pointers(collation_hash2)
+        for i in reversed(range(len(pointers1))):
+            if i < len(pointers1) and pointers1[i] != pointers2[i]:
+                collation_hash1, collation_hash2 = pointers1[i], pointers2[i]
+                pointers1 = self.get_skip_pointers(collation_hash1)
+                pointers2 = self.get_skip_pointers(collation_hash2)
+        return pointers1[0] if pointers1 else self.env.config['GENESIS_PREVHASH']
+
+    def get_ancestor_distance(self, collation_hash, ancestor_hash):
+        """Get the distance from `collation_hash` back to `ancestor_hash`, or
+        None if it isn't an ancestor
+        """
+        distance = self.get_depth(collation_hash) - self.get_depth(ancestor_hash)
+        if distance < 0 or self.get_ancestor(collation_hash, distance) != ancestor_hash:
+            return None
+        return distance
+
+    def get_pruned_depth(self):
+        pruned_depth_key = 'shard_' + str(self.shard_id) + '_pruned_depth'
+        return int(self.db.get(pruned_depth_key)) if pruned_depth_key in self.db else 0
+
+    def get_depth_key(self, depth):
+        return b'shard_%d_depth:%d' % (self.shard_id, depth)
+
+    def get_collations_at_depth(self, depth):
+        """The hashes of the stored collations at `depth`, of every branch"""
+        key = self.get_depth_key(depth)
+        if key not in self.db:
+            return []
+        data = self.db.get(key)
+        return [data[i: i + 32] for i in range(0, len(data), 32)]
+
+    def index_collation_depth(self, collation_hash):
+        """Record `collation_hash` under its depth, so `prune` finds the
+        collations of the other branches too
+
+        A collation forking off below the pruned depth has its logs dropped
+        right away.
+        """
+        depth = self.get_depth(collation_hash)
+        if depth <= self.get_pruned_depth():
+            self.prune_collation(collation_hash, None)
+            return
+        collation_hashes = self.get_collations_at_depth(depth)
+        if collation_hash not in collation_hashes:
+            self.db.put(self.get_depth_key(depth), b''.join(collation_hashes + [collation_hash]))
+
+    def prune(self, limit=PRUNE_BATCH_SIZE):
+        """Retire the trie nodes deleted by the canonical collations more than
+        `max_history` below the head, and their change logs, the way
+        `MainChain.add_block` does for blocks
+
+        The change logs of the collations of other branches at those depths
+        are dropped too. Their deleted nodes are kept: they belong to the
+        state of a parent which the canonical chain may still reference.
+        At most `limit` depths are pruned per call; the next call resumes
+        from the depth stored under `shard_<id>_pruned_depth`. Collations,
+        headers and their score and skip index entries are kept.
+        Return the number of bytes retired.
+        """
+        pruned_depth_key = 'shard_' + str(self.shard_id) + '_pruned_depth'
+        pruned_depth = self.get_pruned_depth()
+        head_depth = self.get_depth(self.head_hash)
+        target_depth = head_depth - self.max_history
+        if limit is not None:
+            target_depth = min(target_depth, pruned_depth + limit)
+        if target_depth <= pruned_depth:
+            return 0
+
+        rdb = RefcountDB(self.db)
+        retired = 0
+        for depth in range(pruned_depth + 1, target_depth + 1):
+            collation_hash = self.get_ancestor(self.head_hash, head_depth - depth)
+            retired += self.prune_collation(collation_hash, rdb)
+            for fork_hash in self.get_collations_at_depth(depth):
+                if fork_hash != collation_hash:
+                    retired += self.prune_collation(fork_hash, None)
+            depth_key = self.get_depth_key(depth)
+            if depth_key in self.db:
+                self.db.delete(depth_key)
+        self.db.put(pruned_depth_key, str(target_depth))
+        self.db.commit()
+        self.pruned_bytes += retired
+        log.debug('Pruned shard {} to depth {}, {} bytes'.format(self.shard_id, target_depth, retired))
+        return retired
+
+    def prune_collation(self, collation_hash, rdb):
+        """Retire the trie deletes and the change log of one collation
+
+        rdb: the RefcountDB to release the deleted nodes in, or None to only
+             drop the logs
+        """
+        try:
+            deletes = self.db.get(b'deletes:' + collation_hash)
+            changed = self.db.get(b'changed:' + collation_hash)
+        except KeyError:
+            return 0
+        retired = len(deletes) + len(changed)
+        self.db.delete(b'deletes:' + collation_hash)
+        self.db.delete(b'changed:' + collation_hash)
+        if rdb is None:
+            return retired
+        for i in range(0, len(deletes), 32):
+            node = deletes[i: i + 32]
+            if node not in self.db:
+                continue
+            size = len(self.db.get(node))
+            rdb.delete(node)
+            # Only counted once its last reference is gone
+            if node not in self.db:
+                retired += size
+        # The deleted nodes belong to the post-state of the parent, which may
+        # not be complete any more
+        header = self.get_collation_header(collation_hash)
+        if header is not None:
+            self.post_state_cache.invalidate(header.parent_collation_hash)
+        self.post_state_cache.invalidate(collation_hash)
+        return retired
+
     def get_head_coll_score(self, blockhash):
         if blockhash in self.head_collation_of_block:
             prev_head_coll_hash = self.head_collation_of_block[blockhash]
-            prev_head_coll = self.get_collation(prev_head_coll_hash)
-            prev_head_coll_score = self.get_score(prev_head_coll)
+            prev_head_coll_header = self.get_collation_header(prev_head_coll_hash)
+            prev_head_coll_score = self.get_score(prev_head_coll_header)
         else:
             prev_head_coll_score = 0
         return prev_head_coll_score
@@ -307,7 +669,12 @@ class ShardChain(object):
         """ A lazy sync for simulation
         """
         self.head_hash = collation.hash
+        # The db is written over by the synced data
+        self.collation_cache.clear()
+        self.post_state_cache.clear()
+        self.head_state_hash = None
         self.db.put(collation.header.hash, rlp.encode(collation))
+        self.db.put(b'header:' + collation.header.hash, rlp.encode(collation.header))
         self.db.put(b'score:' + collation.header.hash, score)
         # self.collation_blockhash_lists = self.collation_blockhash_lists_from_dict(collation_blockhash_lists)
         for collhash, b_list in collation_blockhash_lists.items():
@@ -0,0 +1,286 @@
+import copy
+
+from ethereum import utils
+from ethereum.config import Env
+from ethereum.db import OverlayDB
+from ethereum.messages import (
+    SKIP_MEDSTATES,
+    Log,
+    mk_receipt,
+)
+from ethereum.slogging import get_logger
+from ethereum.state import (
+    STATE_DEFAULTS,
+    State,
+)
+
+from sharding.process_pool_utils import fork_map
+from sharding.receipt_consuming_tx_utils import apply_shard_transaction
+
+log = get_logger('sharding.speculative_apply')
+
+# The pre-state and the txs being speculated; set before the pool forks
+_speculation = None
+
+
+class TrackingState(State):
+    """A throwaway State that records what a transaction reads and writes
+
+    Keys of the read and write sets:
+        ('account', address): nonce, balance, code and existence
+        ('storage', address, key): a storage slot
+        ('reset', address): all the storage of an account
+    `delta_balance` without any other access to the account is a blind
+    write: it is recorded as a balance delta rather than as a read, so that
+    e.g. the fees paid to the coinbase don't make every tx conflict.
+    `commit` is a no-op, the writes stay in the cache to be collected.
+    """
+
+    def __init__(self, *args, **kwargs):
+        State.__init__(self, *args, **kwargs)
+        self.reads = set()
+        self.writes = set()
+        self.account_writes = set()
+        self.code_writes = set()
+        self.storage_writes = set()
+        self.initial_balances = {}
+        self.needs_serial = False
+        self.fired_logs = []
+        self.log_listeners = [self.fired_logs.append]
+        self._blind = False
+
+    @classmethod
+    def from_state(cls, state):
+        """Clone a state whose cache is committed, on an OverlayDB of its db
+        (refer to ethereum.state.State.ephemeral_clone)
+        """
+        env = Env(OverlayDB(state.env.db), state.env.config, state.env.global_config)
+        s = cls(state.trie.root_hash, env)
+        for param in STATE_DEFAULTS:
+            setattr(s, param, copy.copy(getattr(state, param)))
+        s.recent_uncles = state.recent_uncles
+        s.prev_headers = state.prev_headers
+        return s
+
+    def get_and_cache_account(self, address):
+        if not self._blind:
+            self.reads.add(('account', address))
+        return State.get_and_cache_account(self, address)
+
+    def set_and_journal(self, acct, param, val):
+        if param in ('nonce', 'balance', 'code') and not self._blind:
+            self.account_writes.add(acct.address)
+            self.writes.add(('account', acct.address))
+            if param == 'code':
+                self.code_writes.add(acct.address)
+        State.set_and_journal(self, acct, param, val)
+
+    def delta_balance(self, address, value):
+        address = utils.normalize_address(address)
+        self._blind = True
+        try:
+            if address not in self.initial_balances:
+                self.initial_balances[address] = self.get_and_cache_account(address).balance
+            State.delta_balance(self, address, value)
+        finally:
+            self._blind = False
+        self.writes.add(('account', address))
+
+    def get_storage_data(self, address, key):
+        address = utils.normalize_address(address)
+        self.reads.add(('storage', address, key))
+        self._blind = True
+        try:
+            return State.get_storage_data(self, address, key)
+        finally:
+            self._blind = False
+
+    def set_storage_data(self, address, key, value):
+        address = utils.normalize_address(address)
+        self.writes.add(('storage', address, key))
+        self.storage_writes.add((address, key))
+        self._blind = True
+        try:
+            State.set_storage_data(self, address, key, value)
+        finally:
+            self._blind = False
+
+    def reset_storage(self, address):
+        address = utils.normalize_address(address)
+        self.writes.add(('reset', address))
+        self.needs_serial = True
+        State.reset_storage(self, address)
+
+    def del_account(self, address):
+        address = utils.normalize_address(address)
+        self.writes.add(('account', address))
+        self.needs_serial = True
+        State.del_account(self, address)
+
+    def commit(self, allow_empties=False):
+        pass
+
+    def get_result(self, success, gas_used, receipt):
+        """Collect the picklable result of the executed tx"""
+        accounts = {}
+        balance_deltas = {}
+        storage = []
+        for address, acct in self.cache.items():
+            if not acct.touched:
+                continue
+            if address in self.account_writes:
+                code = acct.code if address in self.code_writes else None
+                accounts[address] = (acct.nonce, acct.balance, code)
+            elif address in self.initial_balances:
+                balance_deltas[address] = acct.balance - self.initial_balances[address]
+        for address, key in sorted(self.storage_writes):
+            if address in self.cache and self.cache[address].touched:
+                storage.append((address, key, self.cache[address].get_storage_data(key)))
+        return {
+            'error': None,
+            'needs_serial': self.needs_serial,
+            'reads': self.reads,
+            'writes': self.writes,
+            'accounts': accounts,
+            'balance_deltas': balance_deltas,
+            'storage': storage,
+            'success': success,
+            'gas_used': gas_used,
+            'logs': [(l.address, l.topics, l.data) for l in receipt.logs] if receipt else [],
+            'fired_logs': [(l.address, l.topics, l.data) for l in self.fired_logs],
+        }
+
+
+def execute_tracked(mainchain_state, state, shard_id, tx, receipt_cache=None):
+    """Execute `tx` on a TrackingState clone of `state`, leaving `state` as is
+
+    Return the result dict of `TrackingState.get_result`, or one with an
+    'error' if the tx raised.
+    """
+    tracking_state = TrackingState.from_state(state)
+    gas_used = tracking_state.gas_used
+    receipt_count = len(tracking_state.receipts)
+    try:
+        success, _ = apply_shard_transaction(mainchain_state, tracking_state, shard_id, tx, receipt_cache)
+    except Exception as e:
+        return {'error': str(e), 'writes': tracking_state.writes}
+    if len(tracking_state.receipts) == receipt_count:
+        # A receipt-consuming tx which was dropped halfway
+        tracking_state.needs_serial = True
+        receipt = None
+    else:
+        receipt = tracking_state.receipts[-1]
+    return tracking_state.get_result(success, tracking_state.gas_used - gas_used, receipt)
+
+
+def _execute_job(index):
+    mainchain_state, state, shard_id, txs, receipt_cache = _speculation
+    return execute_tracked(mainchain_state, state, shard_id, txs[index], receipt_cache)
+
+
+def is_conflicting(result, written):
+    """Whether the speculative `result` read anything in `written`, the keys
+    written by the txs committed after its pre-state
+    """
+    for key in result['reads']:
+        if key in written:
+            return True
+        if key[0] == 'storage' and ('reset', key[1]) in written:
+            return True
+    return False
+
+
+def commit_result(state, tx, result):
+    """Apply the writes of a speculative result on `state` and finish the tx
+    the way `ethereum.messages.apply_transaction` does
+    """
+    for address in sorted(result['accounts']):
+        nonce, balance, code = result['accounts'][address]
+        state.set_nonce(address, nonce)
+        state.set_balance(address, balance)
+        if code is not None:
+            state.set_code(address, code)
+    for address in sorted(result['balance_deltas']):
+        state.delta_balance(address, result['balance_deltas'][address])
+    for address, key, value in result['storage']:
+        state.set_storage_data(address, key, value)
+    state.gas_used += result['gas_used']
+
+    for address, topics, data in result['fired_logs']:
+        _log = Log(address, topics, data)
+        for listener in state.log_listeners:
+            listener(_log)
+    state.logs = [Log(address, topics, data) for address, topics, data in result['logs']]
+
+    # Pre-Metropolis: commit state after every tx
+    state.commit()
+
+    # Construct a receipt
+    r = mk_receipt(state, result['success'], state.logs)
+    state.logs = []
+    state.add_receipt(r)
+    state.set_param('bloom', state.bloom | r.bloom)
+    state.set_param('txindex', state.txindex + 1)
+
+
+def can_speculate(state):
+    """Speculation needs the state to be committed after every tx, so that
+    each tx can be re-executed on a clone of the current trie
+    """
+    return (
+        not state.is_METROPOLIS() and not SKIP_MEDSTATES and
+        not any(acct.touched or acct.deleted for acct in state.cache.values())
+    )
+
+
+def apply_transactions(mainchain_state, state, shard_id, txs, processes=None, access_sets=None,
+                       receipt_cache=None):
+    """Apply `txs` on `state` with optimistic concurrency
+
+    All txs are first executed in parallel worker processes against the
+    pre-state, recording their read and write sets. They are then committed
+    in order; a tx that read something written by an earlier tx of `txs`, or
+    that failed, is re-executed against the current state. Txs that delete
+    accounts or reset storage are applied with `apply_shard_transaction`.
+    The resulting state, receipts and roots are the same as applying `txs`
+    one by one, and so are the exceptions raised.
+
+    access_sets: an optional dict, filled with tx hash -> (reads, writes) of
+                 the applied txs (see tx_scheduler_utils)
+    receipt_cache: an optional ReceiptCache of the main chain of
+                   `mainchain_state`
+    """
+    global _speculation
+    txs = list(txs)
+    if not can_speculate(state):
+        for tx in txs:
+            apply_shard_transaction(mainchain_state, state, shard_id, tx, receipt_cache)
+        return
+
+    _speculation = (mainchain_state, state, shard_id, txs, receipt_cache)
+    try:
+        results = fork_map(_execute_job, len(txs), processes)
+    finally:
+        _speculation = None
+
+    # None once the writes of an applied tx are unknown; the remaining
+    # speculative results can't be validated then
+    written = set()
+    reexecuted = 0
+    for tx, result in zip(txs, results):
+        if written is None or result['error'] is not None or is_conflicting(result, written):
+            reexecuted += 1
+            result = execute_tracked(mainchain_state, state, shard_id, tx, receipt_cache)
+        if (result['error'] is not None or result['needs_serial'] or
+                state.gas_used + tx.startgas > state.gas_limit):
+            # Raises the same exception as the serial path, if any
+            apply_shard_transaction(mainchain_state, state, shard_id, tx, receipt_cache)
+            if result['error'] is not None:
+                written = None
+        else:
+            commit_result(state, tx, result)
+        if written is not None:
+            written |= result['writes']
+        if access_sets is not None and result['error'] is None:
+            access_sets[tx.hash] = (result['reads'], result['writes'])
+    log.debug('Applied %d txs speculatively, %d re-executed' % (len(txs), reexecuted))
@@ -0,0 +1,77 @@
+import copy
+from collections import OrderedDict
+
+from ethereum.state import (
+    State,
+    STATE_DEFAULTS,
+)
+
+POST_STATE_CACHE_SIZE = 64
+
+
+def clone_state(state, env=None):
+    """A State on the committed trie of `state`, with a copy of its block
+    and execution parameters
+
+    Nothing mutable is shared: changes to the clone go to its own journal
+    and account cache, and its trie nodes are written to `env.db` only on
+    commit. `env` defaults to the one of `state`.
+    """
+    assert len(state.journal) == 0, state.journal
+    clone = State(state.trie.root_hash, env or state.env)
+    for param in STATE_DEFAULTS:
+        setattr(clone, param, copy.copy(getattr(state, param)))
+    return clone
+
+
+class PostStateCache(object):
+    """A bounded LRU cache of the post-states of collations, keyed by
+    collation hash
+
+    The cached states are templates which are never handed out: `get`
+    returns a fresh `clone_state` of one. A post-state never changes for a
+    given collation hash, so entries only have to be dropped when the trie
+    nodes of the state are deleted from the db.
+    """
+
+    def __init__(self, max_size=POST_STATE_CACHE_SIZE):
+        self.max_size = max_size
+        self.states = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, collation_hash):
+        return collation_hash in self.states
+
+    def get_root(self, collation_hash):
+        """The state root of the cached post-state, or None"""
+        state = self.states.get(collation_hash)
+        return None if state is None else state.trie.root_hash
+
+    def get(self, collation_hash, env=None):
+        """A clone of the post-state of `collation_hash` on `env`, or None if
+        it isn't cached
+        """
+        if collation_hash not in self.states:
+            self.misses += 1
+            return None
+        self.hits += 1
+        state = self.states.pop(collation_hash)
+        self.states[collation_hash] = state
+        return clone_state(state, env)
+
+    def add(self, collation_hash, state):
+        """Cache a clone of `state`, so later changes to `state` don't leak in"""
+        self.states.pop(collation_hash, None)
+        self.states[collation_hash] = clone_state(state)
+        while len(self.states) > self.max_size:
+            self.states.popitem(last=False)
+
+    def invalidate(self, collation_hash):
+        self.states.pop(collation_hash, None)
+
+    def clear(self):
+        self.states.clear()
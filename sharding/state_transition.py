@@ -1,4 +1,8 @@
+import rlp
+
+from ethereum import trie
 from ethereum.common import mk_transaction_sha, mk_receipt_sha
+from ethereum.db import EphemDB
 from ethereum.exceptions import (
     InsufficientBalance,
     BlockGasLimitReached,
@@ -19,10 +23,73 @@ from sharding.collation import (
     Collation,
     CollationHeader,
 )
+from sharding.used_receipt_store_utils import get_used_receipt_ids
 
 log = get_logger('sharding.shard_state_transition')
 
 
+class TrieRootBuilder(object):
+    """Incrementally build the root of an index-keyed list trie
+    (refer to ethereum.common.mk_receipt_sha)
+
+    Items are inserted as they are appended, so reading `root_hash` after the
+    last append is O(1) instead of rebuilding the whole trie.
+    """
+
+    def __init__(self, items=()):
+        self.trie = trie.Trie(EphemDB())
+        self.count = 0
+        self.extend(items)
+
+    def append(self, item):
+        self.trie.update(rlp.encode(self.count), rlp.encode(item))
+        self.count += 1
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def sync(self, items):
+        """Catch up with `items`, a list this builder has been following
+
+        Only the items appended since the last call are inserted. If the list
+        shrank (e.g. a state revert popped receipts), the trie is rebuilt.
+        """
+        if len(items) < self.count:
+            self.trie = trie.Trie(EphemDB())
+            self.count = 0
+        self.extend(items[self.count:])
+        return self.root_hash
+
+    @property
+    def root_hash(self):
+        return self.trie.root_hash
+
+
+class CollationRootsBuilder(object):
+    """Incremental tx_list_root and receipts_root of a collation in assembly
+
+    `add_transactions` feeds it as each transaction and receipt is appended,
+    and `set_execution_results` / `verify_execution_results` read the final
+    roots from it.
+    """
+
+    def __init__(self, transactions=(), receipts=()):
+        self.tx_list = TrieRootBuilder(transactions)
+        self.receipts = TrieRootBuilder(receipts)
+
+    def add(self, tx, receipts):
+        """Record an applied transaction and sync the receipt list"""
+        self.tx_list.append(tx)
+        self.receipts.sync(receipts)
+
+    def tx_list_root(self, transactions):
+        return self.tx_list.sync(transactions)
+
+    def receipts_root(self, receipts):
+        return self.receipts.sync(receipts)
+
+
 def mk_collation_from_prevstate(shard_chain, state, coinbase):
     """Make collation from previous state
     (refer to ethereum.common.mk_block_from_prevstate)
@@ -36,9 +103,18 @@ def mk_collation_from_prevstate(shard_chain, state, coinbase):
     return collation
 
 
-def add_transactions(shard_state, collation, txqueue, shard_id, min_gasprice=0, mainchain_state=None):
+def add_transactions(shard_state, collation, txqueue, shard_id, min_gasprice=0, mainchain_state=None, roots=None,
+                     used_receipts=None, receipt_cache=None):
     """Add transactions to a collation
     (refer to ethereum.common.add_transactions)
+
+    roots: an optional CollationRootsBuilder, fed with every included
+           transaction and its receipt
+    used_receipts: an optional UsedReceiptBitmap of `shard_state`, which
+                   screens the receipt-consuming txs in memory; the receipts
+                   used by the included txs are added to it
+    receipt_cache: an optional ReceiptCache of the main chain of
+                   `mainchain_state`
     """
     if not txqueue:
         return
@@ -55,14 +131,23 @@ def add_transactions(shard_state, collation, txqueue, shard_id, min_gasprice=0,
         # Discard invalid receipt-consuming-tx
         if is_receipt_consuming_tx(tx):
             try:
-                validate_receipt_consuming_tx(mainchain_state, shard_state, shard_id, tx)
+                validate_receipt_consuming_tx(
+                    mainchain_state, shard_state, shard_id, tx, used_receipts, receipt_cache
+                )
             except (InvalidTransaction, InsufficientStartGas) as e:
                 log.info(str(e))
                 continue
 
+        receipt_count = len(shard_state.receipts)
         try:
-            apply_shard_transaction(mainchain_state, shard_state, shard_id, tx)
+            apply_shard_transaction(mainchain_state, shard_state, shard_id, tx, receipt_cache)
             collation.transactions.append(tx)
+            if roots is not None:
+                roots.add(tx, shard_state.receipts)
+            if used_receipts is not None:
+                for r in shard_state.receipts[receipt_count:]:
+                    for receipt_id in get_used_receipt_ids(shard_id, r.logs):
+                        used_receipts.add(receipt_id)
         except (InsufficientBalance, BlockGasLimitReached, InsufficientStartGas,
                 InvalidNonce, UnsignedTransaction) as e:
             log.info(str(e))
@@ -77,12 +162,18 @@ def update_collation_env_variables(state, collation):
     state.block_coinbase = collation.header.coinbase
 
 
-def set_execution_results(state, collation):
+def set_execution_results(state, collation, roots=None):
     """Set state root, receipt root, etc
     (ethereum.pow.common.set_execution_results)
+
+    roots: an optional CollationRootsBuilder which followed the assembly
     """
-    collation.header.receipts_root = mk_receipt_sha(state.receipts)
-    collation.header.tx_list_root = mk_transaction_sha(collation.transactions)
+    if roots is None:
+        collation.header.receipts_root = mk_receipt_sha(state.receipts)
+        collation.header.tx_list_root = mk_transaction_sha(collation.transactions)
+    else:
+        collation.header.receipts_root = roots.receipts_root(state.receipts)
+        collation.header.tx_list_root = roots.tx_list_root(collation.transactions)
 
     # Notice: commit state before assigning
     state.commit()
@@ -95,31 +186,42 @@ def set_execution_results(state, collation):
     log.info('Collation pre-sealed, %d gas used' % state.gas_used)
 
 
-def validate_transaction_tree(collation):
+def validate_transaction_tree(collation, tx_list_root=None):
     """Validate that the transaction list root is correct
     (refer to ethereum.common.validate_transaction_tree)
+
+    tx_list_root: the computed root, if it is already known
     """
-    if collation.header.tx_list_root != mk_transaction_sha(collation.transactions):
+    if tx_list_root is None:
+        tx_list_root = mk_transaction_sha(collation.transactions)
+    if collation.header.tx_list_root != tx_list_root:
         raise ValueError("Transaction root mismatch: header %s computed %s, %d transactions" %
-                         (encode_hex(collation.header.tx_list_root), encode_hex(mk_transaction_sha(collation.transactions)),
+                         (encode_hex(collation.header.tx_list_root), encode_hex(tx_list_root),
                           len(collation.transactions)))
     return True
 
 
-def verify_execution_results(state, collation):
+def verify_execution_results(state, collation, roots=None):
     """Verify the results by Merkle Proof
     (refer to ethereum.common.verify_execution_results)
+
+    roots: an optional CollationRootsBuilder which followed the execution;
+           with it the transaction tree is not validated again
     """
     state.commit()
 
-    validate_transaction_tree(collation)
+    if roots is None:
+        validate_transaction_tree(collation)
+        receipts_root = mk_receipt_sha(state.receipts)
+    else:
+        receipts_root = roots.receipts_root(state.receipts)
 
     if collation.header.post_state_root != state.trie.root_hash:
         raise ValueError('State root mismatch: header %s computed %s' %
                          (encode_hex(collation.header.post_state_root), encode_hex(state.trie.root_hash)))
-    if collation.header.receipts_root != mk_receipt_sha(state.receipts):
+    if collation.header.receipts_root != receipts_root:
         raise ValueError('Receipt root mismatch: header %s computed %s, computed %d, %d receipts' %
-                         (encode_hex(collation.header.receipts_root), encode_hex(mk_receipt_sha(state.receipts)),
+                         (encode_hex(collation.header.receipts_root), encode_hex(receipts_root),
                           state.gas_used, len(state.receipts)))
 
     return True
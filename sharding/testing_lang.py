@@ -85,7 +85,10 @@ class TestingLang(object):
 
 
     def get_current_collator_privkey(self, shard_id):
-        collator_valcode_addr = utils.parse_as_bin(self.valmgr.sample(shard_id))
+        state = self.valmgr.get_constant_call_state(self.c, tester.k0)
+        collator_valcode_addr = validator_manager_utils.sample(
+            state, shard_id, self.c.chain.validator_set_index
+        )
         if collator_valcode_addr == (b'\x00' * 20):
             print("No collator in this period in shard {}".format(shard_id))
             return
@@ -0,0 +1,102 @@
+import rlp
+
+from ethereum import transactions
+from ethereum.transaction_queue import TransactionQueue
+from ethereum.transactions import Transaction
+
+from sharding import batch_crypto_utils
+from sharding.collation import (
+    Collation,
+    CollationHeader,
+)
+from sharding.contract_utils import sign
+from sharding.tools import tester
+
+
+def mk_txs(count, key=tester.k1):
+    txs = [Transaction(i, 1, 21000, tester.a2, 1, b'').sign(key) for i in range(count)]
+    # Decode again to drop the cached senders
+    return [rlp.decode(rlp.encode(tx), Transaction) for tx in txs]
+
+
+def test_recover_tx_senders():
+    txs = mk_txs(3)
+    assert all(tx._sender is None for tx in txs)
+    assert batch_crypto_utils.recover_tx_senders(txs, processes=1) == [tester.a1] * 3
+    assert all(tx._sender == tester.a1 for tx in txs)
+
+
+def test_recover_tx_senders_in_pool():
+    txs = mk_txs(batch_crypto_utils.MIN_POOL_BATCH_SIZE)
+    senders = batch_crypto_utils.recover_tx_senders(txs, processes=2)
+    assert senders == [tester.a1] * len(txs)
+
+
+def test_recover_collation_senders():
+    collation1 = Collation(CollationHeader(shard_id=1, coinbase=tester.a1), mk_txs(2, tester.k2))
+    collation1.header.sig = sign(collation1.header.signing_hash, tester.k1)
+    collation2 = Collation(CollationHeader(shard_id=2, coinbase=tester.a3), mk_txs(1, tester.k4))
+    collation2.header.sig = b'\x00' * 96
+
+    signers = batch_crypto_utils.recover_collation_senders([collation1, collation2], processes=1)
+    assert signers == [tester.a1, None]
+    assert [tx._sender for tx in collation1.transactions] == [tester.a2] * 2
+    assert collation2.transactions[0]._sender == tester.a4
+
+
+def test_sign_collations():
+    collations = [Collation(CollationHeader(shard_id=i, coinbase=tester.a0)) for i in range(3)]
+    batch_crypto_utils.sign_collations(collations, [tester.k1, tester.k2, tester.k3], processes=1)
+    assert batch_crypto_utils.recover_collation_senders(collations, processes=1) == \
+        [tester.a1, tester.a2, tester.a3]
+
+
+def test_sign_txs():
+    txs = [Transaction(i, 1, 21000, tester.a2, 1, b'') for i in range(3)]
+    expected = [
+        rlp.encode(Transaction(i, 1, 21000, tester.a2, 1, b'').sign(key))
+        for i, key in enumerate([tester.k1, tester.k3, tester.k1])
+    ]
+    signed = batch_crypto_utils.sign_txs(txs, [tester.k1, tester.k3, tester.k1], processes=1)
+    assert [rlp.encode(tx) for tx in signed] == expected
+    assert [tx.sender for tx in signed] == [tester.a1, tester.a3, tester.a1]
+
+    tx = batch_crypto_utils.sign_txs([Transaction(0, 1, 21000, tester.a2, 1, b'')], [tester.k1], network_id=1)[0]
+    assert rlp.encode(tx) == rlp.encode(Transaction(0, 1, 21000, tester.a2, 1, b'').sign(tester.k1, network_id=1))
+
+
+def test_mk_signed_txs_in_pool():
+    state = tester.Chain(env='sharding').head_state
+    keys = [tester.k1, tester.k2]
+    tx_params = [(keys[i % 2], tester.a3, i, b'', 21000, 1) for i in range(batch_crypto_utils.MIN_POOL_BATCH_SIZE)]
+    txs = batch_crypto_utils.mk_signed_txs(state, tx_params, processes=2)
+    assert [tx.value for tx in txs] == list(range(len(tx_params)))
+    assert [tx.nonce for tx in txs[:4]] == [0, 0, 1, 1]
+    # The recovered senders match the signing keys
+    decoded = [rlp.decode(rlp.encode(tx), Transaction) for tx in txs]
+    assert batch_crypto_utils.recover_tx_senders(decoded, processes=2) == [tester.a1, tester.a2] * (len(txs) // 2)
+
+
+def test_add_collation_recovers_senders_before_apply(monkeypatch):
+    shard_id = 1
+    t = tester.Chain(env='sharding', deploy_sharding_contracts=True)
+    t.mine(5)
+    t.add_test_shard(shard_id)
+    shard = t.chain.shards[shard_id]
+
+    txqueue = TransactionQueue()
+    txqueue.add_transaction(t.generate_shard_tx(shard_id, tester.k2, tester.a3, 1))
+    txqueue.add_transaction(t.generate_shard_tx(shard_id, tester.k4, tester.a5, 1))
+    collation = t.generate_collation(shard_id, coinbase=tester.a1, key=tester.k1, txqueue=txqueue)
+    # Decode again to drop the cached senders
+    collation = rlp.decode(rlp.encode(collation), Collation)
+    assert [tx._sender for tx in collation.transactions] == [None, None]
+
+    # Transaction.sender must not run ecrecover while the collation is applied
+    def fail(*args):
+        raise AssertionError('ecrecover in the apply loop')
+    monkeypatch.setattr(transactions, 'ecrecover_to_pub', fail)
+
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    assert shard.add_collation(collation, period_start_prevblock)
+    assert [tx._sender for tx in collation.transactions] == [tester.a2, tester.a4]
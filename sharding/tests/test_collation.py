@@ -1,8 +1,15 @@
+import rlp
+
+from ethereum.transactions import Transaction
 from ethereum.utils import encode_hex
 from sharding.collation import (
+    CollationCache,
     CollationHeader,
     Collation,
+    LazyTransactionList,
+    decode_collation_lazy,
 )
+from sharding.tools import tester
 
 
 def test_collation_init():
@@ -17,3 +24,117 @@ def test_collation_init():
 
     assert collation.transaction_count == 0
     assert collation_header_dict['coinbase'] == encode_hex(coinbase)
+
+
+def test_collation_header_hash_cache():
+    """Test the memoized hash and signing_hash are dropped on field writes
+    """
+    collation_header = CollationHeader(coinbase='\x35' * 20)
+    header_hash = collation_header.hash
+    signing_hash = collation_header.signing_hash
+    assert collation_header.hash == header_hash
+    assert collation_header.signing_hash == signing_hash
+
+    collation_header.number = 1
+    assert collation_header.hash != header_hash
+    assert collation_header.signing_hash != signing_hash
+    assert collation_header.hash == CollationHeader(coinbase='\x35' * 20, number=1).hash
+
+    # sig is not a part of the signing hash
+    signing_hash = collation_header.signing_hash
+    header_hash = collation_header.hash
+    collation_header.sig = b'\x01' * 96
+    assert collation_header.signing_hash == signing_hash
+    assert collation_header.hash != header_hash
+
+
+def test_collation_forwards_header_fields():
+    """Test Collation exposes the header fields and keeps RLP compatibility
+    """
+    collation_header = CollationHeader(shard_id=2, number=3, coinbase='\x35' * 20)
+    collation = Collation(collation_header)
+
+    for field, _ in CollationHeader.fields:
+        assert getattr(collation, field) == getattr(collation_header, field)
+    assert collation.hash == collation_header.hash
+    assert collation.signing_hash == collation_header.signing_hash
+    assert collation.to_dict() == collation_header.to_dict()
+
+    decoded = rlp.decode(rlp.encode(collation), Collation)
+    assert decoded.header == collation_header
+    assert decoded.number == 3
+    assert rlp.encode(decoded) == rlp.encode(collation)
+
+
+def test_decode_collation_lazy():
+    """Test the lazy collation view over the stored RLP
+    """
+    txs = [
+        Transaction(i, 1, 21000, tester.a1, 10, b'').sign(tester.k0)
+        for i in range(3)
+    ]
+    collation = Collation(CollationHeader(number=5, coinbase=tester.a0), txs)
+    collation_rlp = rlp.encode(collation)
+
+    lazy_collation = decode_collation_lazy(collation_rlp)
+    assert isinstance(lazy_collation.transactions, LazyTransactionList)
+    assert lazy_collation.header == collation.header
+    assert lazy_collation.number == 5
+    # No transaction is decoded to get the count
+    assert lazy_collation.transaction_count == 3
+    assert not lazy_collation.transactions._transactions
+
+    assert lazy_collation.transactions[1].hash == txs[1].hash
+    assert list(lazy_collation.transactions._transactions) == [1]
+    assert [tx.hash for tx in lazy_collation.transactions] == [tx.hash for tx in txs]
+    assert lazy_collation.transactions[-1].sender == tester.a0
+    assert rlp.encode(lazy_collation) is collation_rlp
+    assert lazy_collation == rlp.decode(collation_rlp, Collation)
+
+    empty_collation_rlp = rlp.encode(Collation(CollationHeader()))
+    assert decode_collation_lazy(empty_collation_rlp).transaction_count == 0
+
+
+def test_lazy_transaction_list_compare_and_mutate():
+    txs = [
+        Transaction(i, 1, 21000, tester.a1, 10, b'').sign(tester.k0)
+        for i in range(3)
+    ]
+    collation_rlp = rlp.encode(Collation(CollationHeader(number=5), txs))
+    lazy_collation = decode_collation_lazy(collation_rlp)
+    assert lazy_collation.transactions == txs
+    assert not lazy_collation.transactions != txs
+    assert lazy_collation.transactions != txs[:2]
+    assert lazy_collation.transactions == tuple(txs)
+
+    new_tx = Transaction(3, 1, 21000, tester.a1, 10, b'').sign(tester.k0)
+    lazy_collation.transactions.append(new_tx)
+    assert lazy_collation.transactions == txs + [new_tx]
+    assert lazy_collation.transaction_count == 4
+    # The RLP is encoded again from the mutated list
+    assert rlp.encode(lazy_collation) == rlp.encode(Collation(CollationHeader(number=5), txs + [new_tx]))
+    del lazy_collation.transactions[0]
+    assert lazy_collation.transactions == txs[1:] + [new_tx]
+
+
+def test_collation_cache():
+    collations_rlp = [rlp.encode(Collation(CollationHeader(number=i))) for i in range(3)]
+    size = len(collations_rlp[0])
+    cache = CollationCache(max_bytes=2 * size)
+    for i, collation_rlp in enumerate(collations_rlp[:2]):
+        assert cache.add(i, collation_rlp).number == i
+    assert cache.nbytes == 2 * size
+
+    # 0 becomes the most recently used one, so 1 is evicted
+    assert cache.get(0).number == 0
+    cache.add(2, collations_rlp[2])
+    assert 1 not in cache
+    assert cache.get(1) is None
+    assert cache.get(2) is cache.get(2)
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert cache.nbytes == 2 * size
+
+    cache.invalidate(0)
+    assert len(cache) == 1 and cache.nbytes == size
+    cache.clear()
+    assert len(cache) == 0 and cache.nbytes == 0
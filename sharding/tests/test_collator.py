@@ -1,7 +1,9 @@
 import pytest
 import logging
 
+from ethereum.common import mk_receipt_sha
 from ethereum.slogging import get_logger
+from ethereum.transactions import Transaction
 from ethereum.transaction_queue import TransactionQueue
 from ethereum import utils
 from ethereum import trie
@@ -9,6 +11,11 @@ from ethereum import trie
 from sharding import collator
 from sharding.tools import tester
 from sharding.config import sharding_config
+from sharding.used_receipt_store_utils import get_used_receipt_ids
+from sharding.validator_manager_utils import (
+    get_valmgr_addr,
+    get_valmgr_ct,
+)
 
 log = get_logger('test.collator')
 log.setLevel(logging.DEBUG)
@@ -211,3 +218,72 @@ def test_verify_collation_header():
     collation.header.sig = utils.sha3('hello')
     with pytest.raises(ValueError):
         collator.verify_collation_header(t.chain, collation.header)
+
+
+def test_apply_collation_speculative():
+    """Apply collation with the speculative execution
+    """
+    shard_id = 1
+    t = chain(shard_id)
+
+    txqueue = TransactionQueue()
+    # Both txs pay a4, and the coinbase gets the fees of both
+    tx1 = t.generate_shard_tx(shard_id, tester.k2, tester.a4, int(0.03 * utils.denoms.ether))
+    tx2 = t.generate_shard_tx(shard_id, tester.k3, tester.a4, int(0.03 * utils.denoms.ether))
+    txqueue.add_transaction(tx1)
+    txqueue.add_transaction(tx2)
+
+    state = t.chain.shards[shard_id].state
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=txqueue)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+
+    collator.apply_collation(state, collation, period_start_prevblock, speculative=True)
+    assert collation.header.post_state_root == state.trie.root_hash
+
+
+def test_apply_collation_speculative_in_processes():
+    """Apply a collation with receipt-consuming txs speculatively in several
+    worker processes, and compare it with the serial execution
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    valmgr = tester.ABIContract(t, get_valmgr_ct(), get_valmgr_addr())
+    startgas, gasprice, value = 100000, 1, 500000
+    receipt_ids = [
+        valmgr.tx_to_shard(to_addr, shard_id, startgas, gasprice, b'', sender=tester.k0, value=value)
+        for to_addr in (tester.a5, tester.a6)
+    ]
+    t.mine(1)
+
+    txqueue = TransactionQueue()
+    for receipt_id, to_addr in zip(receipt_ids, (tester.a5, tester.a6)):
+        rctx = Transaction(0, gasprice, startgas, to_addr, value, b'')
+        rctx.v, rctx.r, rctx.s = 1, receipt_id, 0
+        txqueue.add_transaction(rctx)
+    # Both pay a4, and a5 pays the receiver of a receipt
+    txqueue.add_transaction(t.generate_shard_tx(shard_id, tester.k2, tester.a4, int(0.03 * utils.denoms.ether)))
+    txqueue.add_transaction(t.generate_shard_tx(shard_id, tester.k3, tester.a4, int(0.03 * utils.denoms.ether)))
+    txqueue.add_transaction(t.generate_shard_tx(shard_id, tester.k5, tester.a6, int(0.03 * utils.denoms.ether)))
+    collation = t.generate_collation(shard_id=shard_id, coinbase=tester.a1, key=tester.k1, txqueue=txqueue)
+    assert collation.transaction_count == 5
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+
+    shard = t.chain.shards[shard_id]
+    serial_state = shard.mk_poststate_of_collation_hash(collation.header.parent_collation_hash)
+    collator.apply_collation(serial_state, collation, period_start_prevblock,
+                             mainchain_state=t.chain.state, shard_id=shard_id)
+    state = shard.mk_poststate_of_collation_hash(collation.header.parent_collation_hash)
+    collator.apply_collation(state, collation, period_start_prevblock,
+                             mainchain_state=t.chain.state, shard_id=shard_id,
+                             speculative=True, processes=2)
+
+    assert state.trie.root_hash == serial_state.trie.root_hash == collation.header.post_state_root
+    assert mk_receipt_sha(state.receipts) == mk_receipt_sha(serial_state.receipts) == collation.header.receipts_root
+
+    def get_logs(state):
+        return [(log.address, log.topics, log.data) for receipt in state.receipts for log in receipt.logs]
+    assert get_logs(state) == get_logs(serial_state)
+    logs = [log for receipt in state.receipts for log in receipt.logs]
+    serial_logs = [log for receipt in serial_state.receipts for log in receipt.logs]
+    assert sorted(get_used_receipt_ids(shard_id, logs)) == sorted(receipt_ids)
+    assert get_used_receipt_ids(shard_id, logs) == get_used_receipt_ids(shard_id, serial_logs)
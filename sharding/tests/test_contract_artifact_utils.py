@@ -0,0 +1,65 @@
+import pytest
+
+from sharding import contract_artifact_utils
+from sharding.contract_artifact_utils import (
+    build_artifacts,
+    compile_artifact,
+    get_artifact,
+    get_artifact_path,
+    get_compiler_source_hash,
+    get_compiler_version,
+    get_distribution_version,
+    get_contract_code,
+    get_source_hash,
+    load_artifact,
+    save_artifact,
+)
+
+
+def test_source_hash():
+    code = get_contract_code('used_receipt_store')
+    assert get_source_hash(code) == get_source_hash(code)
+    assert get_source_hash(code) != get_source_hash(code + '\n')
+    assert get_source_hash(code, '0.0.1') != get_source_hash(code, '0.0.2')
+
+
+def test_artifact_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv('SHARDING_ARTIFACTS_DIR', str(tmpdir))
+    monkeypatch.setattr(contract_artifact_utils, '_artifacts', {})
+    monkeypatch.setattr(contract_artifact_utils, 'PACKAGED_ARTIFACTS_DIR', str(tmpdir.join('packaged')))
+
+    code = get_contract_code('used_receipt_store')
+    path = get_artifact_path(str(tmpdir), 'used_receipt_store', get_source_hash(code, get_compiler_version()))
+    artifact = get_artifact('used_receipt_store')
+    assert artifact == compile_artifact(code)
+    assert load_artifact(path) == artifact
+
+    # A fresh process loads it from the disk without compiling
+    def fail(code):
+        raise AssertionError('compiled again')
+    monkeypatch.setattr(contract_artifact_utils, '_artifacts', {})
+    monkeypatch.setattr(contract_artifact_utils, 'compile_artifact', fail)
+    assert get_artifact('used_receipt_store') == artifact
+
+
+def test_save_artifact_to_unwritable_dir(tmpdir):
+    blocker = tmpdir.join('file')
+    blocker.write('')
+    artifact = {'bytecode': b'\x60\x00', 'abi': []}
+    assert not save_artifact(str(blocker.join('sub', 'a.json')), artifact)
+    assert save_artifact(str(tmpdir.join('a.json')), artifact)
+    assert load_artifact(str(tmpdir.join('a.json'))) == artifact
+
+
+def test_build_artifacts_to_unwritable_dir(tmpdir):
+    blocker = tmpdir.join('file')
+    blocker.write('')
+    with pytest.raises(IOError):
+        build_artifacts(str(blocker.join('sub')))
+
+
+def test_compiler_version():
+    # The sources tell apart viper builds which share a version
+    assert get_compiler_version() == get_distribution_version('viper') + '-' + get_compiler_source_hash()
+    with pytest.raises(RuntimeError):
+        get_distribution_version('no-such-distribution-for-sharding')
@@ -0,0 +1,81 @@
+from ethereum import trie
+from ethereum.db import (
+    EphemDB,
+    OverlayDB,
+    RefcountDB,
+)
+from ethereum.utils import sha3
+
+from sharding import parallel_apply_utils
+from sharding.tools import tester
+
+
+def test_overlay_diff():
+    base = EphemDB()
+    node = b'\xc2\x01\x02'
+    RefcountDB(base).put(sha3(node), node)
+
+    overlay = OverlayDB(base)
+    RefcountDB(overlay).put(sha3(node), node)
+    overlay.put(b'changed:', b'abc')
+    node_deltas, raw_writes = parallel_apply_utils.get_overlay_diff(overlay)
+    assert node_deltas == [(sha3(node), 1, node)]
+    assert raw_writes == [(b'changed:', b'abc')]
+
+    # Another shard bumped the refcount in the meantime
+    RefcountDB(base).put(sha3(node), node)
+    parallel_apply_utils.apply_overlay_diff(base, node_deltas, raw_writes)
+    assert RefcountDB(base).get_refcount(sha3(node)) == 3
+    assert base.get(b'changed:') == b'abc'
+
+
+def test_get_rounds():
+    class Job(object):
+        def __init__(self, shard_id):
+            self.header = self
+            self.shard_id = shard_id
+    jobs = [(Job(shard_id), None) for shard_id in [1, 2, 1, 1, 3]]
+    assert parallel_apply_utils.get_rounds(jobs) == [[0, 1, 4], [2], [3]]
+
+
+def mk_collations(shard_ids):
+    t = tester.Chain(env='sharding')
+    for shard_id in shard_ids:
+        t.chain.init_shard(shard_id)
+    t.mine(5)
+    collations = []
+    for shard_id in shard_ids:
+        collation = t.generate_collation(shard_id=shard_id, coinbase=tester.a1, key=tester.k1, txqueue=None)
+        period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+        assert t.chain.shards[shard_id].add_collation(collation, period_start_prevblock)
+        collations.append(collation)
+    return collations
+
+
+def test_add_collations():
+    shard_ids = [1, 2, 3]
+    collations = mk_collations(shard_ids)
+
+    t = tester.Chain(env='sharding')
+    for shard_id in shard_ids:
+        t.chain.init_shard(shard_id)
+    t.mine(5)
+    assert t.chain.add_collations(collations, processes=2) == [True, True, True]
+    for collation in collations:
+        shard = t.chain.shards[collation.header.shard_id]
+        assert shard.get_score(collation) == 1
+        assert shard.mk_poststate_of_collation_hash(collation.header.hash).trie.root_hash == \
+            collation.header.post_state_root
+
+
+def test_add_collations_invalid():
+    shard_ids = [1, 2]
+    collations = mk_collations(shard_ids)
+    collations[0].header.post_state_root = trie.BLANK_ROOT
+
+    t = tester.Chain(env='sharding')
+    for shard_id in shard_ids:
+        t.chain.init_shard(shard_id)
+    t.mine(5)
+    assert t.chain.add_collations(collations, processes=1) == [False, True]
+    assert t.chain.shards[1].get_collation(collations[0].header.hash) is None
@@ -2,11 +2,13 @@ import pytest
 
 from ethereum import utils
 from ethereum.exceptions import InvalidTransaction
+from ethereum.messages import Log
 from ethereum.slogging import configure_logging
 from ethereum.transactions import Transaction
 
 from sharding.tools import tester as t
 from sharding.receipt_consuming_tx_utils import (
+    ReceiptCache,
     apply_shard_transaction,
     validate_receipt_consuming_tx,
 )
@@ -15,6 +17,8 @@ from sharding.used_receipt_store_utils import (
     get_urs_contract,
 )
 from sharding.validator_manager_utils import (
+    TX_TO_SHARD_TOPIC,
+    get_receipt,
     get_valmgr_addr,
     get_valmgr_ct,
 )
@@ -140,3 +144,80 @@ def test_receipt_consuming_transaction(c):
         validate_receipt_consuming_tx(
             c.head_state, shard_state, shard_id, rctx
         )
+
+
+def test_receipt_cache(c):
+    valmgr = t.ABIContract(c, get_valmgr_ct(), get_valmgr_addr())
+    to_addr = utils.privtoaddr(utils.sha3("test_to_addr"))
+    receipt_ids = [
+        valmgr.tx_to_shard(to_addr, 0, 100000, 1, b'123', sender=t.k0, value=500000)
+        for _ in range(3)
+    ]
+    cache = ReceiptCache(max_size=2)
+
+    # A receipt which doesn't exist isn't cached
+    assert cache.get(c.head_state, 100)['value'] == 0
+    assert 100 not in cache
+
+    for receipt_id in receipt_ids:
+        assert cache.get(c.head_state, receipt_id) == get_receipt(c.head_state, receipt_id)
+    # The least recently used one is evicted
+    assert len(cache) == 2 and receipt_ids[0] not in cache
+
+    # The update_gasprice() log drops the cached receipt
+    c.head_state.log_listeners.append(cache.handle_log)
+    assert valmgr.update_gasprice(receipt_ids[2], 2, sender=t.k0)
+    assert receipt_ids[2] not in cache
+    assert cache.get(c.head_state, receipt_ids[2])['tx_gasprice'] == 2
+
+    # A tx_to_shard log drops the receipt id it announces
+    cache.handle_log(Log(
+        get_valmgr_addr(),
+        [utils.big_endian_to_int(TX_TO_SHARD_TOPIC), 0, 0],
+        utils.zpad(utils.encode_int(receipt_ids[1]), 32)
+    ))
+    assert receipt_ids[1] not in cache and receipt_ids[2] in cache
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_receipt_cache_of_main_chain(c):
+    valmgr = t.ABIContract(c, get_valmgr_ct(), get_valmgr_addr())
+    to_addr = utils.privtoaddr(utils.sha3("test_to_addr"))
+    shard_id = 0
+    receipt_id = valmgr.tx_to_shard(to_addr, shard_id, 100000, 1, b'', sender=t.k0, value=1)
+    c.add_test_shard(shard_id)
+    rctx = mk_testing_receipt_consuming_tx(receipt_id, to_addr, 1, 100000, 1)
+    validate_receipt_consuming_tx(
+        c.head_state, c.shard_head_state[shard_id], shard_id, rctx,
+        receipt_cache=c.chain.receipt_cache
+    )
+    assert receipt_id in c.chain.receipt_cache
+
+    # Another main chain has its own cache
+    other = t.Chain(env='sharding', deploy_sharding_contracts=True)
+    assert other.chain.receipt_cache is not c.chain.receipt_cache
+    assert receipt_id not in other.chain.receipt_cache
+
+
+def test_receipt_cache_after_reorg(c):
+    valmgr = t.ABIContract(c, get_valmgr_ct(), get_valmgr_addr())
+    to_addr = utils.privtoaddr(utils.sha3("test_to_addr"))
+    cache = c.chain.receipt_cache
+    fork_point = c.mine(1)
+    receipt_id = valmgr.tx_to_shard(to_addr, 0, 100000, 1, b'', sender=t.k0, value=1)
+    c.mine(1)
+    assert cache.get(c.chain.state, receipt_id)['value'] == 1
+
+    # A longer branch creates the same receipt id with another value
+    c.change_head(fork_point.hash)
+    assert valmgr.tx_to_shard(to_addr, 0, 100000, 1, b'', sender=t.k0, value=2) == receipt_id
+    head = c.mine(3)
+    assert c.chain.head_hash == head.hash
+    assert cache.get(c.chain.state, receipt_id)['value'] == 2
+
+    # The cache still follows the logs of the state of the new head
+    assert valmgr.update_gasprice(receipt_id, 3, sender=t.k0)
+    c.mine(1)
+    assert receipt_id not in cache
+    assert cache.get(c.chain.state, receipt_id)['tx_gasprice'] == 3
@@ -1,6 +1,8 @@
 import pytest
 import logging
 
+import rlp
+
 from ethereum.utils import encode_hex
 from ethereum.slogging import get_logger
 from ethereum.transaction_queue import TransactionQueue
@@ -85,6 +87,177 @@ def test_add_collation_error():
     assert not t.chain.shards[shard_id].add_collation(collation2, period_start_prevblock)
 
 
+def test_score_index():
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+    shard = t.chain.shards[shard_id]
+
+    collations = []
+    parent_collation_hash = None
+    for i in range(3):
+        collation = t.generate_collation(
+            shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None,
+            parent_collation_hash=parent_collation_hash
+        )
+        period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+        assert shard.add_collation(collation, period_start_prevblock)
+        # The score is indexed with the collation
+        assert int(shard.db.get(b'score:' + collation.header.hash)) == collation.header.number == i + 1
+        parent_collation_hash = collation.header.hash
+        collations.append(collation)
+
+    # A db written without the index is migrated by a new ShardChain, which
+    # walks back from the saved head
+    version_key = 'shard_' + str(shard_id) + '_score_index_version'
+    assert not shard.migrate_score_index()
+    for collation in collations:
+        shard.db.delete(b'score:' + collation.header.hash)
+    shard.db.delete(version_key)
+    shard.db.put('shard_' + str(shard_id) + '_head_hash', collations[-1].header.hash)
+    shard.db.commit()
+    assert not any(b'score:' + c.header.hash in shard.db for c in collations)
+    migrated = ShardChain(shard_id, env=shard.env)
+    assert migrated.head_hash == collations[-1].header.hash
+    assert [int(shard.db.get(b'score:' + c.header.hash)) for c in collations] == [1, 2, 3]
+    assert [migrated.get_score(c) for c in collations] == [1, 2, 3]
+    assert not migrated.migrate_score_index()
+
+
+def test_skip_list_ancestors():
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+    shard = t.chain.shards[shard_id]
+    genesis_hash = shard.env.config['GENESIS_PREVHASH']
+
+    def add_collations(parent_collation_hash, count, coinbase):
+        hashes = []
+        for _ in range(count):
+            collation = t.generate_collation(
+                shard_id=1, coinbase=coinbase, key=tester.k1, txqueue=None,
+                parent_collation_hash=parent_collation_hash
+            )
+            period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+            assert shard.add_collation(collation, period_start_prevblock)
+            parent_collation_hash = collation.header.hash
+            hashes.append(parent_collation_hash)
+        return hashes
+
+    main = add_collations(None, 7, tester.a1)
+    fork = add_collations(main[2], 3, tester.a2)
+
+    assert shard.get_skip_pointers(main[6]) == [main[5], main[4], main[2]]
+    assert shard.get_ancestor(main[6], 0) == main[6]
+    assert shard.get_ancestor(main[6], 5) == main[1]
+    assert shard.get_ancestor(main[6], 7) == genesis_hash
+    assert shard.get_ancestor(main[6], 8) is None
+    assert shard.get_ancestor(fork[2], 3) == main[2]
+
+    assert shard.get_common_ancestor(main[6], fork[2]) == main[2]
+    assert shard.get_common_ancestor(fork[0], main[1]) == main[1]
+    assert shard.get_common_ancestor(main[0], main[0]) == main[0]
+
+    assert shard.get_ancestor_distance(main[6], main[0]) == 6
+    assert shard.get_ancestor_distance(fork[2], main[2]) == 3
+    assert shard.get_ancestor_distance(fork[2], main[3]) is None
+    assert shard.get_ancestor_distance(main[0], main[6]) is None
+
+    # Collations stored without pointers get them built from the ancestors
+    for collation_hash in main[3:]:
+        shard.db.delete(b'skip:' + collation_hash)
+    assert shard.get_ancestor(main[6], 6) == main[0]
+    assert shard.get_skip_pointers(main[6]) == [main[5], main[4], main[2]]
+
+
+def test_prune():
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+    shard = t.chain.shards[shard_id]
+    shard.max_history = 2
+
+    hashes = []
+    parent_collation_hash = None
+    for _ in range(5):
+        collation = t.generate_collation(
+            shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None,
+            parent_collation_hash=parent_collation_hash
+        )
+        period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+        assert shard.add_collation(collation, period_start_prevblock)
+        parent_collation_hash = collation.header.hash
+        hashes.append(parent_collation_hash)
+
+    shard.head_hash = hashes[-1]
+    shard.prune(limit=1)
+    assert (b'changed:' + hashes[0]) not in shard.db
+    assert (b'changed:' + hashes[1]) in shard.db
+    # Resumes where the last call stopped, up to max_history below the head
+    shard.mk_poststate_of_collation_hash(hashes[1])
+    shard.mk_poststate_of_collation_hash(hashes[3])
+    assert hashes[1] in shard.post_state_cache and hashes[3] in shard.post_state_cache
+    shard.prune()
+    # The post-states the pruned deletes belong to are dropped from the cache
+    assert hashes[1] not in shard.post_state_cache
+    assert hashes[3] in shard.post_state_cache
+    for collation_hash in hashes[:3]:
+        assert (b'deletes:' + collation_hash) not in shard.db
+        assert (b'changed:' + collation_hash) not in shard.db
+    for collation_hash in hashes[3:]:
+        assert (b'deletes:' + collation_hash) in shard.db
+    assert shard.prune() == 0
+    # The collations and their indices are kept
+    assert shard.get_collation(hashes[0]).header.hash == hashes[0]
+    assert shard.get_ancestor(hashes[-1], 4) == hashes[0]
+    assert shard.mk_poststate_of_collation_hash(hashes[-1]).trie.root_hash == \
+        shard.get_collation_header(hashes[-1]).post_state_root
+
+
+def test_prune_forks():
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+    shard = t.chain.shards[shard_id]
+    shard.max_history = 2
+
+    def add_collation(parent_collation_hash, coinbase):
+        collation = t.generate_collation(
+            shard_id=1, coinbase=coinbase, key=tester.k1, txqueue=None,
+            parent_collation_hash=parent_collation_hash
+        )
+        period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+        assert shard.add_collation(collation, period_start_prevblock)
+        return collation.header.hash
+
+    hashes = []
+    parent_collation_hash = None
+    for _ in range(2):
+        parent_collation_hash = add_collation(parent_collation_hash, tester.a1)
+        hashes.append(parent_collation_hash)
+    # A fork at depth 2
+    fork_hash = add_collation(hashes[0], tester.a2)
+    assert shard.get_collations_at_depth(2) == [hashes[1], fork_hash]
+    for _ in range(3):
+        parent_collation_hash = add_collation(parent_collation_hash, tester.a1)
+        hashes.append(parent_collation_hash)
+
+    shard.head_hash = hashes[-1]
+    shard.prune()
+    for collation_hash in hashes[:3] + [fork_hash]:
+        assert (b'deletes:' + collation_hash) not in shard.db
+        assert (b'changed:' + collation_hash) not in shard.db
+    assert shard.get_collations_at_depth(2) == []
+    assert shard.get_collations_at_depth(4) == [hashes[3]]
+    # The nodes of the fork are kept, so the canonical state is complete
+    assert shard.mk_poststate_of_collation_hash(hashes[-1]).trie.root_hash == \
+        shard.get_collation_header(hashes[-1]).post_state_root
+
+
 def test_handle_ignored_collation():
     """Test handle_ignored_collation(self, collation, period_start_prevblock)
     """
@@ -173,6 +346,78 @@ def test_get_collation():
 
     assert t.chain.shards[shard_id].get_collation(collation.header.hash).header.hash == collation.header.hash
 
+    # The stored collation is served from the collation cache
+    shard = t.chain.shards[shard_id]
+    hits = shard.collation_cache.hits
+    assert shard.get_collation(collation.header.hash) is shard.get_collation(collation.header.hash)
+    assert shard.collation_cache.hits == hits + 2
+
+
+def test_post_state_cache():
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+    shard = t.chain.shards[shard_id]
+
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    shard.add_collation(collation, period_start_prevblock)
+
+    state1 = shard.mk_poststate_of_collation_hash(collation.header.hash)
+    hits = shard.post_state_cache.hits
+    state2 = shard.mk_poststate_of_collation_hash(collation.header.hash)
+    assert shard.post_state_cache.hits == hits + 1
+    assert state1 is not state2
+    assert state2.trie.root_hash == collation.header.post_state_root
+    assert state2.block_coinbase == tester.a1
+    assert state2.txindex == state1.txindex
+
+    # Changes to a handed out state don't reach the cached one
+    state1.delta_balance(tester.a2, 1)
+    state1.commit()
+    assert shard.mk_poststate_of_collation_hash(collation.header.hash).get_balance(tester.a2) == \
+        state2.get_balance(tester.a2)
+
+    # The head state is only rebuilt when the head or the state changed
+    shard.head_hash = collation.header.hash
+    shard.update_head_state()
+    head_state = shard.state
+    shard.update_head_state()
+    assert shard.state is head_state
+    head_state.delta_balance(tester.a2, 1)
+    shard.update_head_state()
+    assert shard.state is not head_state
+    assert shard.state.trie.root_hash == collation.header.post_state_root
+
+
+def test_get_collation_header():
+    """Test get_collation_header(self, collation_hash) and get_parent_header(self, header)
+    """
+    shard_id = 1
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(shard_id)
+    t.mine(5)
+    shard = t.chain.shards[shard_id]
+
+    collation1 = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation1.header.period_start_prevhash)
+    shard.add_collation(collation1, period_start_prevblock)
+    collation2 = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None, parent_collation_hash=collation1.header.hash)
+    shard.add_collation(collation2, period_start_prevblock)
+
+    assert (b'header:' + collation2.header.hash) in shard.db
+    header2 = shard.get_collation_header(collation2.header.hash)
+    assert header2 == collation2.header
+    assert shard.get_parent_header(header2) == collation1.header
+    assert shard.get_parent_header(collation1.header) is None
+    assert shard.get_score(header2) == 2
+    assert shard.get_collation_header(b'\x12' * 32) is None
+
+    # Collations stored without a header record are still readable
+    shard.db.delete(b'header:' + collation2.header.hash)
+    assert shard.get_collation_header(collation2.header.hash) == collation2.header
+
 
 def test_get_parent():
     """Test get_parent(self, collation)
@@ -209,6 +454,7 @@ def test_sync():
     hcb = shard.head_collation_of_block_to_dict()
 
     other_shard = ShardChain(shard_id, env=Env(config=sharding_config), main_chain=t.chain)
+    other_shard.collation_cache.add(h1, rlp.encode(shard.head))
     other_shard.sync(
         state_data=shard.state.to_snapshot(),
         collation=shard.head,
@@ -216,6 +462,8 @@ def test_sync():
         collation_blockhash_lists=cbl,
         head_collation_of_block=hcb
     )
+    # sync drops the collations cached before
+    assert len(other_shard.collation_cache) == 0
     s2 = other_shard.state.trie.root_hash
     h2 = other_shard.head.hash
 
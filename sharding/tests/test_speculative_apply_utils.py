@@ -0,0 +1,57 @@
+import pytest
+
+from ethereum import utils
+from ethereum.common import mk_receipt_sha
+from ethereum.transactions import Transaction
+
+from sharding import speculative_apply_utils
+from sharding.tools import tester
+
+
+def mk_state():
+    t = tester.Chain(env='sharding')
+    t.chain.init_shard(1)
+    t.mine(5)
+    state = t.chain.shards[1].mk_poststate_of_collation_hash(t.chain.shards[1].head_hash)
+    state.block_coinbase = tester.a0
+    return state
+
+
+def mk_txs():
+    value = int(0.01 * utils.denoms.ether)
+    return [
+        Transaction(0, 1, 21000, tester.a4, value, b'').sign(tester.k2),
+        Transaction(0, 1, 21000, tester.a4, value, b'').sign(tester.k3),
+        # Same sender as the first tx: fails with InvalidNonce speculatively
+        Transaction(1, 1, 21000, tester.a5, value, b'').sign(tester.k2),
+        # Pays the sender of the first tx, a blind balance delta
+        Transaction(0, 1, 21000, tester.a2, value, b'').sign(tester.k4),
+    ]
+
+
+def test_tracking_state():
+    state = mk_state()
+    tx = mk_txs()[0]
+    result = speculative_apply_utils.execute_tracked(None, state, None, tx)
+    assert result['error'] is None
+    assert ('account', tester.a2) in result['reads']
+    assert ('account', tester.a4) not in result['reads']
+    assert tester.a2 in result['accounts']
+    assert result['balance_deltas'][tester.a4] == tx.value
+    assert result['balance_deltas'][tester.a0] == 21000
+    # The state is left as is
+    assert state.get_nonce(tester.a2) == 0
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_apply_transactions(processes):
+    serial_state = mk_state()
+    for tx in mk_txs():
+        speculative_apply_utils.apply_shard_transaction(None, serial_state, None, tx)
+
+    state = mk_state()
+    speculative_apply_utils.apply_transactions(None, state, None, mk_txs(), processes=processes)
+    assert state.trie.root_hash == serial_state.trie.root_hash
+    assert [r.state_root for r in state.receipts] == [r.state_root for r in serial_state.receipts]
+    assert mk_receipt_sha(state.receipts) == mk_receipt_sha(serial_state.receipts)
+    assert state.gas_used == serial_state.gas_used
@@ -92,6 +92,33 @@ def test_set_execution_results():
     assert collation.header.post_state_root == state.trie.root_hash
 
 
+def test_collation_roots_builder():
+    """Test CollationRootsBuilder follows add_transactions
+    """
+    t = chain(shard_id)
+    tx1 = t.generate_shard_tx(shard_id, tester.k2, tester.a4, int(0.03 * utils.denoms.ether))
+    tx2 = t.generate_shard_tx(shard_id, tester.k3, tester.a5, int(0.03 * utils.denoms.ether))
+    txqueue = TransactionQueue()
+    txqueue.add_transaction(tx1)
+    txqueue.add_transaction(tx2)
+
+    state = t.chain.shards[shard_id].state.ephemeral_clone()
+    collation = state_transition.mk_collation_from_prevstate(t.chain.shards[shard_id], state, tester.a1)
+    roots = state_transition.CollationRootsBuilder(collation.transactions, state.receipts)
+    state_transition.add_transactions(state, collation, txqueue, shard_id, mainchain_state=t.head_state, roots=roots)
+    assert roots.tx_list.count == 2
+    assert roots.receipts.count == len(state.receipts)
+
+    state_transition.set_execution_results(state, collation, roots)
+    assert collation.header.receipts_root == mk_receipt_sha(state.receipts)
+    assert collation.header.tx_list_root == mk_transaction_sha(collation.transactions)
+    assert state_transition.verify_execution_results(state, collation, roots)
+
+    # A shrunk list is rebuilt from scratch
+    builder = state_transition.TrieRootBuilder(collation.transactions)
+    assert builder.sync(collation.transactions[:1]) == mk_transaction_sha(collation.transactions[:1])
+
+
 def test_validate_transaction_tree():
     """Test validate_transaction_tree(collation)
     """
@@ -97,6 +97,9 @@ def get_plus_one() -> num:
     assert x.get_plus_one() == 101
     assert x.get_hello() == 101
 
+    # constant calls on one state are reverted between each other
+    assert x.multicall([('get_plus_one', []), ('get_plus_one', []), ('get_hello', [])]) == [102, 102, 101]
+
     # deploy on shard chain
     y = t.contract("""
 hello: public(num)
@@ -0,0 +1,100 @@
+from ethereum.consensus_strategy import get_consensus_strategy
+from ethereum.transaction_queue import TransactionQueue
+from ethereum import utils
+
+from sharding import collator
+from sharding import tx_scheduler_utils
+from sharding.tools import tester
+
+# JUMPDEST PUSH1 0 JUMP
+LOOP_INIT_CODE = b'\x5b\x60\x00\x56'
+
+
+def test_build_dependency_dag():
+    access_sets = [
+        ({('account', b'a')}, {('account', b'a'), ('account', b'b')}),
+        # Writes b, written by the tx above
+        ({('account', b'c')}, {('account', b'c'), ('account', b'b')}),
+        # Reads b, written by both txs above
+        ({('account', b'b')}, {('account', b'b')}),
+        ({('storage', b'd', 1)}, {('storage', b'd', 1)}),
+        ({('reset', b'd')}, set()),
+        # Writes c, read by tx 1
+        (set(), {('account', b'c')}),
+        # Resets d, whose storage txs 3 and 4 read
+        (set(), {('reset', b'd')}),
+    ]
+    dag = tx_scheduler_utils.build_dependency_dag(access_sets)
+    assert dag == [[], [0], [0, 1], [], [3], [1], [3, 4]]
+    assert tx_scheduler_utils.get_groups(dag) == [[0, 1, 2, 5], [3, 4, 6]]
+    assert tx_scheduler_utils.get_levels(dag) == [0, 1, 2, 0, 1, 2, 2]
+
+
+def test_create_collation_with_schedule():
+    shard_id = 1
+    t = tester.Chain(env='sharding', deploy_sharding_contracts=True)
+    t.mine(5)
+    t.add_test_shard(shard_id)
+
+    txqueue = TransactionQueue()
+    value = int(0.01 * utils.denoms.ether)
+    # k2 pays k3, then k3 pays k4: the second tx depends on the first one
+    txqueue.add_transaction(t.generate_shard_tx(shard_id, tester.k2, tester.a3, value, gasprice=3))
+    txqueue.add_transaction(t.generate_shard_tx(shard_id, tester.k5, tester.a6, value, gasprice=2))
+    txqueue.add_transaction(t.generate_shard_tx(shard_id, tester.k3, tester.a4, value, gasprice=1))
+
+    schedule = tx_scheduler_utils.TxSchedule()
+    collation = collator.create_collation(
+        t.chain,
+        shard_id,
+        t.chain.shards[shard_id].head_hash,
+        t.chain.get_expected_period_number(),
+        coinbase=tester.a1,
+        key=tester.k1,
+        txqueue=txqueue,
+        schedule=schedule)
+    # The dependent txs are packed together: k3's tx pays less than k5's,
+    # but follows the tx it depends on
+    assert [tx.sender for tx in collation.transactions] == [tester.a2, tester.a3, tester.a5]
+    assert schedule.dependencies == [[], [0], []]
+    assert schedule.groups == [[0, 1], [2]]
+
+
+def test_create_collation_with_schedule_requeues_leftover_txs():
+    shard_id = 1
+    t = tester.Chain(env='sharding', deploy_sharding_contracts=True)
+    t.mine(5)
+    t.add_test_shard(shard_id)
+    shard = t.chain.shards[shard_id]
+    expected_period_number = t.chain.get_expected_period_number()
+
+    state = shard.mk_poststate_of_collation_hash(shard.head_hash)
+    period_start_prevblock = t.chain.get_block(t.chain.get_period_start_prevhash(expected_period_number))
+    get_consensus_strategy(state.config).initialize(state, period_start_prevblock)
+    startgas = state.gas_limit // 2 + 1
+
+    txqueue = TransactionQueue()
+    # A contract creation looping forever burns all its startgas, so the
+    # second big tx doesn't fit any more
+    burn_tx = t.generate_shard_tx(shard_id, tester.k2, b'', data=LOOP_INIT_CODE, startgas=startgas, gasprice=3)
+    cut_off_tx = t.generate_shard_tx(shard_id, tester.k5, b'', data=LOOP_INIT_CODE, startgas=startgas, gasprice=2)
+    small_tx = t.generate_shard_tx(shard_id, tester.k3, tester.a4, 1, gasprice=1)
+    # Rejected by add_transactions
+    invalid_tx = t.generate_shard_tx(shard_id, tester.k6, tester.a7, 10 ** 30, gasprice=1)
+    for tx in (burn_tx, cut_off_tx, small_tx, invalid_tx):
+        txqueue.add_transaction(tx)
+
+    schedule = tx_scheduler_utils.TxSchedule()
+    collation = collator.create_collation(
+        t.chain,
+        shard_id,
+        shard.head_hash,
+        expected_period_number,
+        coinbase=tester.a1,
+        key=tester.k1,
+        txqueue=txqueue,
+        schedule=schedule)
+    assert [tx.hash for tx in collation.transactions] == [burn_tx.hash, small_tx.hash]
+    # The tx cut off by the gas limit is still pending, the invalid one isn't
+    assert len(txqueue) == 1
+    assert txqueue.pop_transaction().hash == cut_off_tx.hash
@@ -1,9 +1,21 @@
+import rlp
+
+from ethereum import utils
+from ethereum.messages import Log
+
 from sharding.tools import tester as t
+from sharding.collation import CollationHeader
 from sharding.contract_utils import call_contract_inconstantly
 from sharding.used_receipt_store_utils import (
+    ADD_USED_RECEIPT_TOPIC,
+    UsedReceiptBitmap,
     call_urs,
+    decode_receipt_ids,
+    encode_receipt_ids,
     get_urs_ct,
     get_urs_contract,
+    get_used_receipt_ids,
+    is_receipt_used,
 )
 
 
@@ -20,6 +32,7 @@ def test_used_receipt_store():
     state = c.shard_head_state[shard_id]
     receipt_id = 1
     assert not call_urs(state, shard_id, 'get_used_receipts', [receipt_id])
+    assert not is_receipt_used(state, shard_id, receipt_id)
     urs_addr = get_urs_contract(shard_id)['addr']
     assert call_contract_inconstantly(
         state, get_urs_ct(shard_id), urs_addr,
@@ -27,3 +40,70 @@ def test_used_receipt_store():
         0, sender_addr=urs_addr
     )
     assert call_urs(state, shard_id, 'get_used_receipts', [receipt_id])
+    assert is_receipt_used(state, shard_id, receipt_id)
+
+
+def test_used_receipt_bitmap():
+    bitmap = UsedReceiptBitmap()
+    bitmap.add(3)
+    bitmap.add(300)
+    bitmap.add(3)
+    assert bitmap.is_used(3) and bitmap.is_used(300) and not bitmap.is_used(4)
+    assert not bitmap.is_used(10 ** 6)
+    assert len(bitmap) == 2 and bitmap.size == 304
+    copied = bitmap.copy()
+    bitmap.remove(3)
+    bitmap.remove(4)
+    bitmap.remove(10 ** 6)
+    assert not bitmap.is_used(3) and copied.is_used(3)
+    assert len(bitmap) == 1 and len(copied) == 2
+    assert len(UsedReceiptBitmap(copied.data)) == 2
+
+    assert decode_receipt_ids(encode_receipt_ids([0, 5, 2 ** 100])) == [0, 5, 2 ** 100]
+
+    urs_addr = get_urs_contract(0)['addr']
+    topic = utils.big_endian_to_int(ADD_USED_RECEIPT_TOPIC)
+    logs = [
+        Log(urs_addr, [topic], utils.zpad(utils.encode_int(7), 32)),
+        Log(t.a1, [topic], utils.zpad(utils.encode_int(8), 32)),
+        Log(urs_addr, [topic + 1], utils.zpad(utils.encode_int(9), 32)),
+    ]
+    assert get_used_receipt_ids(0, logs) == [7]
+
+
+def test_used_receipt_index():
+    shard_id = 0
+    c = chain(shard_id)
+    shard = c.chain.shards[shard_id]
+    index = shard.used_receipt_index
+    assert index.check_consistency(max_receipt_id=10) == []
+
+    # genesis <- h1 (uses 1) <- h2 (uses 2)
+    #         <- h3 (uses 3)
+    def add_header(number, parent_hash, receipt_ids):
+        header = CollationHeader(shard_id=shard_id, parent_collation_hash=parent_hash, number=number)
+        shard.db.put(b'header:' + header.hash, rlp.encode(header))
+        shard.db.put(b'used_receipts:' + header.hash, encode_receipt_ids(receipt_ids))
+        return header.hash
+
+    genesis_hash = shard.head_hash
+    h1 = add_header(1, genesis_hash, [1])
+    h2 = add_header(2, h1, [2])
+    h3 = add_header(1, genesis_hash, [3])
+
+    shard.head_hash = h2
+    assert index.is_used(1) and index.is_used(2) and not index.is_used(3)
+    # The bitmap of another collation leaves the index alone
+    bitmap = index.get_bitmap(h3)
+    assert bitmap.is_used(3) and len(bitmap) == 1
+    assert index.head_hash == h2
+    # Reorg
+    shard.head_hash = h3
+    assert not index.is_used(1) and not index.is_used(2) and index.is_used(3)
+    shard.head_hash = genesis_hash
+    assert len(index.get_bitmap(genesis_hash)) == 0
+
+    # The storage of the head doesn't say receipt 3 is used
+    shard.head_hash = h3
+    state = shard.mk_poststate_of_collation_hash(genesis_hash)
+    assert index.check_consistency(state) == [3]
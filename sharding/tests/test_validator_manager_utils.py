@@ -1,3 +1,5 @@
+import random
+
 import pytest
 import rlp
 
@@ -5,6 +7,7 @@ from ethereum import utils
 
 from sharding.tools import tester as t
 from sharding.contract_utils import (
+    get_bound_call,
     sign,
     create_contract_tx,
 )
@@ -19,9 +22,19 @@ from sharding.validator_manager_utils import (
     call_tx_add_header,
     call_tx_to_shard,
     call_contract_constantly,
+    get_collation_header,
+    get_num_receipts,
+    get_num_validators,
+    get_period_head,
+    get_receipt,
+    get_shard_head,
     get_shard_list,
+    get_validator,
+    get_validators_max_index,
     get_valmgr_addr,
-    get_valmgr_ct
+    get_valmgr_ct,
+    is_valcode_deposited,
+    sample,
 )
 from sharding.config import sharding_config
 
@@ -138,6 +151,25 @@ def test_call_add_header_get_shard_head(chain):
 
     assert colhdr_hash == call_valmgr(chain.head_state, 'get_shard_head', [0])
 
+    # The storage readers agree with the getters
+    state = chain.head_state
+    assert get_shard_head(state, 0) == colhdr_hash
+    assert get_shard_head(state, 1) == call_valmgr(state, 'get_shard_head', [1])
+    assert get_period_head(state, 0) == call_valmgr(state, 'get_period_head', [0]) > 0
+    assert get_collation_header(state, 0, colhdr_hash) == {
+        'parent_collation_hash': call_valmgr(state, 'get_collation_headers__parent_collation_hash', [0, colhdr_hash]),
+        'score': call_valmgr(state, 'get_collation_headers__score', [0, colhdr_hash]),
+    }
+    assert get_num_validators(state) == call_valmgr(state, 'get_num_validators', []) == 2
+    for valcode_addr in (k0_valcode_addr, k1_valcode_addr, t.a9):
+        assert is_valcode_deposited(state, valcode_addr) == \
+            call_valmgr(state, 'get_is_valcode_deposited', [valcode_addr])
+    validator = get_validator(state, 1)
+    assert validator['validation_code_addr'] == k1_valcode_addr
+    assert validator['return_addr'] == t.a1
+    assert validator['deposit'] == call_valmgr(state, 'get_validators__deposit', [1]) == DEPOSIT_SIZE
+    assert validator['cycle'] == call_valmgr(state, 'get_validators__cycle', [1])
+
 
 def test_call_tx_to_shard(chain):
     state = chain.head_state
@@ -146,6 +178,32 @@ def test_call_tx_to_shard(chain):
     assert 0 == utils.big_endian_to_int(output)
 
 
+def test_get_receipt(chain):
+    data = b'\x01' * 40
+    tx = call_tx_to_shard(chain.head_state, t.k0, 10, t.a1, 3, 100000, 2, data)
+    receipt_id = utils.big_endian_to_int(chain.direct_tx(tx))
+    chain.mine(1)
+
+    state = chain.head_state
+    receipt = get_receipt(state, receipt_id)
+    assert receipt == {
+        'shard_id': 3,
+        'tx_startgas': 100000,
+        'tx_gasprice': 2,
+        'value': 10,
+        'sender': t.a0,
+        'to': t.a1,
+        'data': data,
+    }
+    # The same as the getters
+    assert receipt['data'] == call_valmgr(state, 'get_receipts__data', [receipt_id])
+    assert utils.encode_hex(receipt['sender']) == \
+        utils.encode_hex(utils.parse_as_bin(call_valmgr(state, 'get_receipts__sender', [receipt_id])))
+    # Not existing receipt
+    assert get_receipt(state, receipt_id + 1)['value'] == 0
+    assert get_num_receipts(state) == receipt_id + 1
+
+
 # def test_valmgr_addr_in_sharding_config():
 #     assert sharding_config['VALIDATOR_MANAGER_ADDRESS'] == \
 #         utils.checksum_encode(get_valmgr_addr())
@@ -162,6 +220,24 @@ def test_sign():
     assert sign(msg_hash2, privkey) == b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x1b\x10\xcf\xacjd\xa9@\xf44\xd5K[A\xbb\xde&0\xc3V\xe4\x9f\xe9+\xf6\'\x0eVbQtYf"5\x04\x85\xc8\x1dB\x92\xd9\xc9r\xed\x9a\x08\xfet\xce@\xa2\x1bm\x88\xc2\x875\xff\x99\xc5oN\xac\xa4'
 
 
+def test_bound_call():
+    ct = get_valmgr_ct()
+    header = rlp.encode([0, b'\x11' * 32, 1, b'\x22' * 32, t.a1, b'', b'', b''])
+    for func, args in (
+            ('add_header', [header]),
+            ('sample', [3]),
+            ('get_receipts__value', [2]),
+            ('get_is_valcode_deposited', [t.a2]),
+            ('tx_to_shard', [t.a1, 1, 100000, 1, b'\x33' * 40])):
+        bound_call = get_bound_call(ct, func)
+        assert bound_call is get_bound_call(ct, func)
+        assert bound_call.encode(args) == ct.encode_function_call(func, args)
+    result = utils.zpad(t.a3, 32)
+    assert get_bound_call(ct, 'sample').decode(result) == ct.decode('sample', result)
+    with pytest.raises(ValueError):
+        get_bound_call(ct, 'no_such_function')
+
+
 def test_get_validators_max_index(chain):
     k0_valcode = mk_validation_code(t.a0)
     k1_valcode = mk_validation_code(t.a1)
@@ -201,3 +277,81 @@ def test_get_validators_max_index(chain):
         value=0, startgas=10 ** 20, sender_addr=t.a0
     )
     assert validators_max_index == 2
+
+
+def assert_sample_and_get_shard_list_match_contract(state, valcode_addrs):
+    assert get_validators_max_index(state) == call_contract_constantly(
+        state, get_valmgr_ct(), get_valmgr_addr(), 'get_validators_max_index', [],
+        value=0, startgas=10 ** 20, sender_addr=t.a0
+    )
+    for shard_id in range(20):
+        assert utils.big_endian_to_int(sample(state, shard_id)) == \
+            int(call_valmgr(state, 'sample', [shard_id]), 16)
+    for valcode_addr in valcode_addrs:
+        assert get_shard_list(state, valcode_addr) == call_contract_constantly(
+            state, get_valmgr_ct(), get_valmgr_addr(), 'get_shard_list', [valcode_addr],
+            value=0, startgas=10 ** 20, sender_addr=b'\xff' * 20
+        )
+
+
+@pytest.mark.parametrize('seed', [0, 7, 42])
+def test_sample_and_get_shard_list(chain, seed):
+    rng = random.Random(seed)
+    keys = [t.k0, t.k1, t.k2, t.k3, t.k4]
+    valcode_addrs = []
+    for key in keys:
+        tx = create_contract_tx(chain.head_state, key, mk_validation_code(utils.privtoaddr(key)))
+        valcode_addrs.append(chain.direct_tx(tx))
+        chain.head_state.set_balance(utils.privtoaddr(key), DEPOSIT_SIZE * 10)
+    chain.mine(1)
+
+    # A random validator set: deposit some, withdraw one of them, and
+    # deposit again into its empty slot within the next cycle
+    depositors = sorted(rng.sample(range(len(keys)), 4))
+    for i in depositors:
+        chain.direct_tx(call_deposit(chain.head_state, keys[i], DEPOSIT_SIZE, valcode_addrs[i], t.a9))
+    # Within the block of the deposits, i.e. on uncommitted changes
+    assert_sample_and_get_shard_list_match_contract(chain.head_state, [valcode_addrs[depositors[0]]])
+    chain.mine(sharding_config['SHUFFLING_CYCLE_LENGTH'])
+    assert_sample_and_get_shard_list_match_contract(chain.head_state, [valcode_addrs[depositors[0]]])
+
+    withdrawn = rng.choice(range(len(depositors)))
+    chain.direct_tx(call_withdraw(chain.head_state, keys[depositors[withdrawn]], 0, withdrawn,
+                                  sign(WITHDRAW_HASH, keys[depositors[withdrawn]])))
+    # Within the block of the withdraw
+    assert_sample_and_get_shard_list_match_contract(chain.head_state, [valcode_addrs[depositors[withdrawn]]])
+    chain.mine(sharding_config['SHUFFLING_CYCLE_LENGTH'])
+    assert_sample_and_get_shard_list_match_contract(chain.head_state, [valcode_addrs[depositors[withdrawn]]])
+
+    newcomer = [i for i in range(len(keys)) if i not in depositors][0]
+    chain.direct_tx(call_deposit(chain.head_state, keys[newcomer], DEPOSIT_SIZE, valcode_addrs[newcomer], t.a9))
+    chain.mine(1)
+    assert_sample_and_get_shard_list_match_contract(
+        chain.head_state, [valcode_addrs[depositors[0]], valcode_addrs[newcomer]]
+    )
+
+
+def test_get_shard_list_of_withdrawn_validator_and_empty_slot(chain):
+    keys = [t.k0, t.k1, t.k2]
+    valcode_addrs = []
+    for key in keys + [t.k3]:
+        tx = create_contract_tx(chain.head_state, key, mk_validation_code(utils.privtoaddr(key)))
+        valcode_addrs.append(chain.direct_tx(tx))
+        chain.head_state.set_balance(utils.privtoaddr(key), DEPOSIT_SIZE * 10)
+    chain.mine(1)
+    for key, valcode_addr in zip(keys, valcode_addrs):
+        chain.direct_tx(call_deposit(chain.head_state, key, DEPOSIT_SIZE, valcode_addr, t.a9))
+    chain.mine(sharding_config['SHUFFLING_CYCLE_LENGTH'])
+    # Withdraw validator 1, leaving its slot empty
+    chain.direct_tx(call_withdraw(chain.head_state, t.k1, 0, 1, sign(WITHDRAW_HASH, t.k1)))
+    chain.mine(sharding_config['SHUFFLING_CYCLE_LENGTH'])
+
+    state = chain.head_state
+    # The withdrawn validator, the zero address of the empty slot, a
+    # remaining validator and a valcode addr which never deposited
+    for valcode_addr in (valcode_addrs[1], b'\x00' * 20, valcode_addrs[0], valcode_addrs[3]):
+        assert get_shard_list(state, valcode_addr) == call_contract_constantly(
+            state, get_valmgr_ct(), get_valmgr_addr(), 'get_shard_list', [valcode_addr],
+            value=0, startgas=10 ** 20, sender_addr=b'\xff' * 20
+        )
+    assert not any(get_shard_list(state, valcode_addrs[1]))
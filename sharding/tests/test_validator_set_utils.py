@@ -0,0 +1,107 @@
+from ethereum import utils
+
+from sharding.tools import tester
+from sharding.config import sharding_config
+from sharding.validator_manager_utils import (
+    get_cycle,
+    get_shard_list,
+    get_validators_max_index,
+    sample,
+)
+from sharding.validator_set_utils import (
+    DEPOSIT,
+    WITHDRAW,
+    decode_validator_events,
+    encode_validator_events,
+    get_validator_events,
+)
+
+
+def test_encode_validator_events():
+    events = [
+        (DEPOSIT, 0, tester.a1, tester.a2, 3),
+        (WITHDRAW, 0, b'', b'', 0),
+    ]
+    assert decode_validator_events(encode_validator_events(events)) == events
+    assert decode_validator_events(encode_validator_events([])) == []
+
+
+def test_get_validator_events_without_valmgr(monkeypatch):
+    t = tester.Chain(env='sharding', deploy_sharding_contracts=False)
+    t.tx(tester.k0, tester.a1, 1)
+    t.mine(1)
+
+    # Blocks without deposit or withdraw logs never resolve the address
+    def fail():
+        raise AssertionError('the validator manager address was resolved')
+    monkeypatch.setattr('sharding.validator_set_utils.get_valmgr_addr', fail)
+    state = t.chain.state
+    assert get_validator_events(state, state.receipts) == []
+
+
+def test_validator_set_index():
+    t = tester.Chain(env='sharding', deploy_sharding_contracts=True)
+    t.mine(5)
+    index = t.chain.validator_set_index
+    valcode_addrs = [t.sharding_valcode_addr(key) for key in (tester.k0, tester.k1, tester.k2)]
+    t.mine(1)
+
+    t.sharding_deposit(tester.k0, valcode_addrs[0])
+    t.sharding_deposit(tester.k1, valcode_addrs[1])
+    fork_point = t.mine(1)
+    assert index.num_validators == 2
+    assert index.get_validator_index(valcode_addrs[1]) == 1
+    valcode_addr, return_addr, cycle = index.get_validator(0)
+    assert valcode_addr == valcode_addrs[0] and return_addr == tester.a0
+    assert cycle == get_cycle(t.head_state) + 1
+    assert index.get_active_validators(cycle - 1) == {}
+
+    t.mine(sharding_config['SHUFFLING_CYCLE_LENGTH'])
+    state = t.chain.state
+    assert index.get_active_validators(get_cycle(state)) == {0: valcode_addrs[0], 1: valcode_addrs[1]}
+    assert index.get_validators_max_index(get_cycle(state)) == get_validators_max_index(state)
+
+    # Withdraw validator 0, then k2 takes its empty slot
+    t.sharding_withdraw(tester.k0, 0)
+    t.mine(1)
+    assert index.empty_slots_stack == [0]
+    assert index.get_validators_max_index(get_cycle(t.chain.state)) == get_validators_max_index(t.chain.state)
+    t.sharding_deposit(tester.k2, valcode_addrs[2])
+    t.mine(1)
+    assert index.empty_slots_stack == []
+    assert index.get_validator_index(valcode_addrs[2]) == 0
+    assert index.get_validator_index(valcode_addrs[0]) is None
+
+    # A longer fork from the block with the first deposits drops the
+    # withdrawal and the deposit of k2
+    t.change_head(fork_point.header.hash)
+    t.mine(sharding_config['SHUFFLING_CYCLE_LENGTH'] + 5)
+    assert t.chain.head_hash != fork_point.header.hash
+    assert index.empty_slots_stack == []
+    assert index.get_validator_index(valcode_addrs[0]) == 0
+    assert index.get_validator_index(valcode_addrs[2]) is None
+    assert index.num_validators == 2
+    state = t.chain.state
+    assert index.get_validators_max_index(get_cycle(state)) == get_validators_max_index(state)
+    assert utils.normalize_address(index.get_validator(1)[0]) == valcode_addrs[1]
+
+
+def test_sample_and_get_shard_list_from_validator_set_index():
+    t = tester.Chain(env='sharding', deploy_sharding_contracts=True)
+    t.mine(5)
+    index = t.chain.validator_set_index
+    keys = (tester.k0, tester.k1, tester.k2)
+    valcode_addrs = [t.sharding_valcode_addr(key) for key in keys]
+    t.mine(1)
+    for key, valcode_addr in zip(keys, valcode_addrs):
+        t.sharding_deposit(key, valcode_addr)
+    t.mine(sharding_config['SHUFFLING_CYCLE_LENGTH'])
+    t.sharding_withdraw(tester.k1, 1)
+    t.mine(sharding_config['SHUFFLING_CYCLE_LENGTH'])
+
+    state = t.chain.state
+    assert get_validators_max_index(state, validator_set_index=index) == get_validators_max_index(state)
+    for shard_id in range(20):
+        assert sample(state, shard_id, index) == sample(state, shard_id)
+    for valcode_addr in valcode_addrs + [b'\x00' * 20]:
+        assert get_shard_list(state, valcode_addr, index) == get_shard_list(state, valcode_addr)
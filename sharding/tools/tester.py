@@ -35,10 +35,13 @@ from sharding.config import sharding_config
 from sharding.collator import create_collation
 from sharding import state_transition as shard_state_transition
 from sharding.collation import CollationHeader
-from sharding.receipt_consuming_tx_utils import apply_shard_transaction
+from sharding.receipt_consuming_tx_utils import (
+    apply_shard_transaction,
+)
 from sharding.contract_utils import (
     sign,
     create_contract_tx,
+    multicall,
 )
 from sharding.validator_manager_utils import (
     ADD_HEADER_TOPIC,
@@ -53,6 +56,7 @@ from sharding.validator_manager_utils import (
     call_tx_add_header,
 )
 from sharding.visualization import Record
+from sharding.batch_crypto_utils import mk_signed_txs
 from sharding import used_receipt_store_utils
 
 # Initialize accounts
@@ -75,19 +79,25 @@ for i in range(1, 9):
     minimal_alloc[int_to_addr(i)] = {'balance': 1}
 minimal_alloc[accounts[0]] = {'balance': 1 * utils.denoms.ether}
 
-# Initialize languages
+# Initialize languages; the compilers are imported on first use, since
+# importing viper and probing for solc dominate the import of this module
 languages = {}
 
-from ethereum.tools._solidity import get_solidity
-_solidity = get_solidity()
-if _solidity:
-    languages['solidity'] = _solidity
 
-try:
-    from viper import compiler
-    languages['viper'] = compiler
-except ImportError:
-    pass
+def get_language(language):
+    if language not in languages:
+        if language == 'solidity':
+            from ethereum.tools._solidity import get_solidity
+            _solidity = get_solidity()
+            if _solidity:
+                languages['solidity'] = _solidity
+        elif language == 'viper':
+            try:
+                from viper import compiler
+                languages['viper'] = compiler
+            except ImportError:
+                pass
+    return languages[language]
 
 
 class TransactionFailed(Exception):
@@ -106,6 +116,7 @@ GASPRICE = 1
 class ABIContract(object):  # pylint: disable=too-few-public-methods
     def __init__(self, _chain, _abi, address, shard_id=None):
         self.address = address
+        self.test_chain = _chain
 
         if isinstance(_abi, ContractTranslator):
             abi_translator = _abi
@@ -150,7 +161,7 @@ class ABIContract(object):  # pylint: disable=too-few-public-methods
                 return o[0] if len(o) == 1 else o
         return kall
 
-    def handle_constant_call(self, test_chain, function_name, key, args, kwargs):
+    def get_constant_call_state(self, test_chain, key):
         if self.shard_id:
             assert test_chain.chain.has_shard(self.shard_id)
             expected_period_number = test_chain.chain.get_expected_period_number()
@@ -167,7 +178,10 @@ class ABIContract(object):  # pylint: disable=too-few-public-methods
             state = test_chain.chain.mk_poststate_of_blockhash(test_chain.chain.head_hash)
             block = mk_block_from_prevstate(test_chain.chain, state, timestamp=state.timestamp, coinbase=key)
             test_chain.cs.initialize(state, block)
+        return state
 
+    def handle_constant_call(self, test_chain, function_name, key, args, kwargs):
+        state = self.get_constant_call_state(test_chain, key)
         result = call_contract_constantly(
             state,
             self.translator,
@@ -182,6 +196,19 @@ class ABIContract(object):  # pylint: disable=too-few-public-methods
             return None
         return result
 
+    def multicall(self, calls, sender=k0, value=0, startgas=STARTGAS):
+        """Make the constant calls `[(function_name, args), ...]` on one head
+        state, instead of building the state for each call
+        """
+        state = self.get_constant_call_state(self.test_chain, sender)
+        return multicall(
+            state,
+            [(self.translator, self.address, function_name, args) for function_name, args in calls],
+            value=value,
+            startgas=startgas,
+            sender_addr=privtoaddr(sender)
+        )
+
 
 def get_env(env):
     d = {
@@ -245,6 +272,8 @@ class Chain(object):
         else:
             self.shard_last_tx[shard_id], self.shard_last_sender[shard_id] = transaction, None
             assert self.chain.has_shard(shard_id)
+            # The pending head state isn't the one the receipt cache of the
+            # main chain follows
             success, output = apply_shard_transaction(
                 self.head_state, self.shard_head_state[shard_id], shard_id, transaction
             )
@@ -275,7 +304,7 @@ class Chain(object):
             assert len(args) == 0
             return self.tx(sender=sender, to=b'', value=value, data=sourcecode, startgas=startgas, gasprice=gasprice, shard_id=shard_id)
         else:
-            compiler = languages[language]
+            compiler = get_language(language)
             interface = compiler.mk_full_signature(sourcecode)
             ct = ContractTranslator(interface)
             code = compiler.compile(sourcecode) + (ct.encode_constructor_arguments(args) if args else b'')
@@ -403,7 +432,7 @@ class Chain(object):
         collation.header.expected_period_number = expected_period_number
         collation.header.period_start_prevhash = period_start_prevhash
         collation.header.parent_collation_hash = parent_collation_hash
-        collation.header.number = self.chain.shards[shard_id].get_collation(parent_collation_hash).number + 1
+        collation.header.number = self.chain.shards[shard_id].get_collation_header(parent_collation_hash).number + 1
         self.collation[shard_id] = collation
 
     def add_test_shard(self, shard_id, setup_urs_contracts=True, alloc=None):
@@ -435,6 +464,12 @@ class Chain(object):
                                   to, value, data).sign(sender)
         return transaction
 
+    def generate_shard_txs(self, shard_id, tx_params, processes=None):
+        """Generate the txs of shard of `tx_params`, a list of
+        `(sender, to, value, data, startgas, gasprice)`, signed in a process pool
+        """
+        return mk_signed_txs(self.shard_head_state[shard_id], tx_params, processes=processes)
+
     def generate_collation(self, shard_id, coinbase, key, txqueue=None, parent_collation_hash=None, expected_period_number=None):
         """Generate collation
         """
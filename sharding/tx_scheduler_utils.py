@@ -0,0 +1,218 @@
+from collections import defaultdict
+
+from ethereum import utils
+from ethereum.exceptions import InvalidTransaction
+from ethereum.messages import CREATE_CONTRACT_ADDRESS
+from ethereum.transaction_queue import TransactionQueue
+
+from sharding.receipt_consuming_tx_utils import is_receipt_consuming_tx
+from sharding.used_receipt_store_utils import get_urs_contract
+
+# The access set keys are the ones of speculative_apply_utils.TrackingState:
+#     ('account', address), ('storage', address, key) and ('reset', address).
+# A ('reset', address) read stands for reading any storage slot of the account.
+
+
+def get_declared_access_set(state, tx, shard_id=None):
+    """Estimate `(reads, writes)` of a tx from its fields
+
+    The sender and the recipient accounts are accessed; a call to a contract
+    or a contract creation may access any storage of that contract. Other
+    contracts reached by message calls are not known; use an observed access
+    set (see speculative_apply_utils.apply_transactions) for those.
+    """
+    if shard_id is not None and is_receipt_consuming_tx(tx):
+        sender = get_urs_contract(shard_id)['addr']
+        reads = {('account', sender), ('reset', sender)}
+        writes = {('account', sender), ('reset', sender)}
+    else:
+        try:
+            sender = tx.sender
+        except InvalidTransaction:
+            # add_transactions drops it
+            return set(), set()
+        reads = {('account', sender)}
+        writes = {('account', sender)}
+
+    if not tx.to or tx.to == CREATE_CONTRACT_ADDRESS:
+        to = utils.mk_contract_address(sender, tx.nonce)
+        is_contract = True
+    else:
+        to = tx.to
+        is_contract = len(state.get_code(to)) > 0
+    writes.add(('account', to))
+    if is_contract:
+        reads |= {('account', to), ('reset', to)}
+        writes.add(('reset', to))
+    return reads, writes
+
+
+def get_access_set(state, tx, access_sets=None, shard_id=None):
+    """The observed access set of `tx` if there is one, else the declared one
+
+    access_sets: dict of tx hash -> (reads, writes)
+    """
+    if access_sets and tx.hash in access_sets:
+        return access_sets[tx.hash]
+    return get_declared_access_set(state, tx, shard_id)
+
+
+def _mk_access_table():
+    # key -> tx indices, and address -> tx indices of its storage keys
+    return defaultdict(list), defaultdict(list)
+
+
+def _record_access(table, key, index):
+    keys, storage = table
+    keys[key].append(index)
+    if key[0] == 'storage':
+        storage[key[1]].append(index)
+
+
+def _get_overlapping(table, key):
+    """The txs of `table` which accessed the data `key` stands for"""
+    keys, storage = table
+    txs = list(keys[key])
+    if key[0] == 'storage':
+        txs += keys[('reset', key[1])]
+    elif key[0] == 'reset':
+        txs += storage[key[1]]
+    return txs
+
+
+def build_dependency_dag(access_sets):
+    """Build the dependencies between txs from their `(reads, writes)`, in
+    the order of the txs
+
+    Tx j depends on an earlier tx i if j reads something i writes, writes
+    something i writes, or writes something i reads. Txs of the same level
+    (see `get_levels`) or of different groups (see `get_groups`) then never
+    conflict.
+    Return a list with the sorted indices of the dependencies of each tx.
+    """
+    read_table = _mk_access_table()
+    write_table = _mk_access_table()
+    dag = []
+    for j, (reads, writes) in enumerate(access_sets):
+        deps = set()
+        for key in reads:
+            deps.update(_get_overlapping(write_table, key))
+        for key in writes:
+            deps.update(_get_overlapping(write_table, key))
+            deps.update(_get_overlapping(read_table, key))
+        dag.append(sorted(deps))
+        for key in reads:
+            _record_access(read_table, key, j)
+        for key in writes:
+            _record_access(write_table, key, j)
+    return dag
+
+
+def get_groups(dag):
+    """Split the txs into groups with no dependency between the groups,
+    i.e. the connected components of `dag`
+
+    Return the groups as lists of tx indices, ordered by their first tx.
+    """
+    parents = list(range(len(dag)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for j, deps in enumerate(dag):
+        for i in deps:
+            parents[find(i)] = find(j)
+    groups = defaultdict(list)
+    for i in range(len(dag)):
+        groups[find(i)].append(i)
+    return sorted(groups.values())
+
+
+def get_levels(dag):
+    """The level of each tx in `dag`: txs of the same level don't depend on
+    each other, and can be validated in parallel after the lower levels
+    """
+    levels = []
+    for deps in dag:
+        levels.append(max([levels[i] + 1 for i in deps] or [0]))
+    return levels
+
+
+class TxSchedule(object):
+    """Conflict scheduling of the txs of a collation in assembly
+
+    `create_collation` reorders the pending txs with `schedule`, so that
+    non-conflicting groups of txs are packed next to each other, records
+    the dependency DAG of the txs it included with `set_transactions`, and
+    puts the others back into the pending queue with `requeue`.
+
+    access_sets: dict of tx hash -> (reads, writes) observed before
+    """
+
+    def __init__(self, access_sets=None):
+        self.access_sets = {} if access_sets is None else access_sets
+        # The queue `schedule` returned
+        self.scheduled = TransactionQueue()
+        self.transactions = []
+        self.dependencies = []
+        self.groups = []
+
+    def get_access_sets(self, state, txs, shard_id=None):
+        return [get_access_set(state, tx, self.access_sets, shard_id) for tx in txs]
+
+    def schedule(self, state, txqueue, shard_id=None, min_gasprice=0):
+        """Pop the txs which may fit in the collation from `txqueue`, in its
+        gas price order, and return a TransactionQueue of them packed by group
+
+        The groups are ordered by their first tx, and the txs of a group keep
+        their order; so the txs are no longer in gas price order across
+        groups, e.g. a cheap tx follows the tx it depends on, ahead of a
+        better paying tx of a later group.
+        """
+        txs = []
+        while txqueue:
+            tx = txqueue.pop_transaction(
+                max_gas=state.gas_limit - state.gas_used,
+                min_gasprice=min_gasprice
+            )
+            if tx is None:
+                break
+            txs.append(tx)
+        dag = build_dependency_dag(self.get_access_sets(state, txs, shard_id))
+
+        scheduled = TransactionQueue()
+        for group in get_groups(dag):
+            for i in group:
+                # Forced txs are popped in insertion order
+                scheduled.add_transaction(txs[i], force=True)
+        self.scheduled = scheduled
+        return scheduled
+
+    def set_transactions(self, state, txs, shard_id=None):
+        """Record the dependency DAG of the txs included in the collation"""
+        self.transactions = list(txs)
+        self.dependencies = build_dependency_dag(self.get_access_sets(state, self.transactions, shard_id))
+        self.groups = get_groups(self.dependencies)
+        return self.dependencies
+
+    def requeue(self, txqueue):
+        """Put the scheduled txs which are still queued back into `txqueue`,
+        i.e. the ones cut off by the gas limit; the ones `add_transactions`
+        popped and rejected are dropped, as without a schedule
+        """
+        leftover = []
+        while self.scheduled:
+            tx = self.scheduled.pop_transaction()
+            if tx is None:
+                break
+            leftover.append(tx)
+            txqueue.add_transaction(tx)
+        self.scheduled = TransactionQueue()
+        return leftover
+
+    @property
+    def levels(self):
+        return get_levels(self.dependencies)
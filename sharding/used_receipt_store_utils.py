@@ -1,19 +1,25 @@
-import os
-
 from ethereum import (
     abi,
     utils,
 )
 from ethereum.transactions import Transaction
-from viper import compiler
 
 from sharding.config import sharding_config
+from sharding.contract_artifact_utils import (
+    get_artifact,
+    get_contract_code,
+)
 from sharding.contract_utils import (
     GASPRICE,
     call_contract_constantly,
+    get_storage_slot,
     get_tx_rawhash,
 )
 
+# Storage slot of `used_receipts`, the only global of used_receipt_store.v.py
+USED_RECEIPTS_SLOT = 0
+ADD_USED_RECEIPT_TOPIC = utils.sha3("add_used_receipt()")
+
 _urs_contracts = {}
 _urs_ct = None
 _urs_code = None
@@ -36,27 +42,23 @@ def get_urs_contract(shard_id):
 
 
 def get_urs_ct(shard_id):
-    global _urs_ct, _urs_code
+    global _urs_ct
     if not _urs_ct:
-        _urs_ct = abi.ContractTranslator(
-            compiler.mk_full_signature(get_urs_code(shard_id))
-        )
+        _urs_ct = abi.ContractTranslator(get_artifact('used_receipt_store')['abi'])
     return _urs_ct
 
 
 def get_urs_code(shard_id):
     global _urs_code
     if not _urs_code:
-        mydir = os.path.dirname(__file__)
-        urs_path = os.path.join(mydir, 'contracts/used_receipt_store.v.py')
-        _urs_code = open(urs_path).read()
+        _urs_code = get_contract_code('used_receipt_store')
     return _urs_code
 
 
 def get_urs_bytecode(shard_id):
     global _urs_bytecode
     if not _urs_bytecode:
-        _urs_bytecode = compiler.compile(get_urs_code(shard_id))
+        _urs_bytecode = get_artifact('used_receipt_store')['bytecode']
     return _urs_bytecode
 
 
@@ -113,3 +115,165 @@ def call_urs(state, shard_id, func, args, value=0, startgas=None, sender_addr=b'
         state, get_urs_ct(shard_id), get_urs_contract(shard_id)['addr'],
         func, args, value=value, startgas=startgas, sender_addr=sender_addr
     )
+
+
+def is_receipt_used(state, shard_id, receipt_id):
+    """Read `used_receipts[receipt_id]` from the storage of the URS contract,
+    instead of calling `get_used_receipts`
+    """
+    urs_addr = get_urs_contract(shard_id)['addr']
+    return bool(state.get_storage_data(urs_addr, get_storage_slot(USED_RECEIPTS_SLOT, receipt_id)))
+
+
+def get_used_receipt_ids(shard_id, logs):
+    """Get the receipt ids of the `add_used_receipt()` logs of the URS
+    contract of shard `shard_id` in `logs`
+    """
+    urs_addr = get_urs_contract(shard_id)['addr']
+    topic = utils.big_endian_to_int(ADD_USED_RECEIPT_TOPIC)
+    return [
+        utils.big_endian_to_int(log.data) for log in logs
+        if log.address == urs_addr and log.topics and log.topics[0] == topic
+    ]
+
+
+def encode_receipt_ids(receipt_ids):
+    return b''.join(utils.zpad(utils.encode_int(receipt_id), 32) for receipt_id in receipt_ids)
+
+
+def decode_receipt_ids(data):
+    return [utils.big_endian_to_int(data[i: i + 32]) for i in range(0, len(data), 32)]
+
+
+class UsedReceiptBitmap(object):
+    """The used receipt ids of a shard state, bit `receipt_id % 8` of byte
+    `receipt_id // 8` of a bytearray
+
+    The number of used ids is counted on update, so every operation is O(1)
+    apart from growing the bytearray.
+    """
+
+    def __init__(self, data=None, count=None):
+        self.data = bytearray() if data is None else bytearray(data)
+        if count is None:
+            count = sum(bin(byte).count('1') for byte in self.data)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def size(self):
+        """The number of receipt ids the bitmap holds a bit for"""
+        return len(self.data) * 8
+
+    def is_used(self, receipt_id):
+        index = receipt_id >> 3
+        return index < len(self.data) and bool(self.data[index] & (1 << (receipt_id & 7)))
+
+    def add(self, receipt_id):
+        index = receipt_id >> 3
+        if index >= len(self.data):
+            self.data.extend(bytearray(index + 1 - len(self.data)))
+        mask = 1 << (receipt_id & 7)
+        if not self.data[index] & mask:
+            self.data[index] |= mask
+            self.count += 1
+
+    def remove(self, receipt_id):
+        index = receipt_id >> 3
+        mask = 1 << (receipt_id & 7)
+        if index < len(self.data) and self.data[index] & mask:
+            self.data[index] &= ~mask & 0xff
+            self.count -= 1
+
+    def copy(self):
+        return UsedReceiptBitmap(self.data, self.count)
+
+
+class UsedReceiptIndex(object):
+    """A UsedReceiptBitmap of a shard chain which follows its head
+
+    The receipt ids used by each collation come from the `add_used_receipt()`
+    logs in its receipts, stored under `used_receipts:<collation hash>` by
+    `ShardChain.store_collation`. When the head moves, the collations of the
+    old branch are reverted and the ones of the new branch replayed, back to
+    their common ancestor.
+    """
+
+    def __init__(self, shard_chain):
+        self.shard_chain = shard_chain
+        self.bitmap = UsedReceiptBitmap()
+        self.head_hash = self.genesis_hash
+
+    @property
+    def genesis_hash(self):
+        return self.shard_chain.env.config['GENESIS_PREVHASH']
+
+    def get_collation_receipt_ids(self, collation_hash):
+        key = b'used_receipts:' + collation_hash
+        if collation_hash == self.genesis_hash or key not in self.shard_chain.db:
+            return []
+        return decode_receipt_ids(self.shard_chain.db.get(key))
+
+    def _get_number_and_parent(self, collation_hash):
+        if collation_hash == self.genesis_hash:
+            return -1, None
+        header = self.shard_chain.get_collation_header(collation_hash)
+        if header is None:
+            raise KeyError('Collation header %s not found' % utils.encode_hex(collation_hash))
+        return header.number, header.parent_collation_hash
+
+    def move(self, bitmap, from_hash, to_hash):
+        """Turn `bitmap` of collation `from_hash` into the one of `to_hash`
+        """
+        replayed = []
+        from_number, from_parent = self._get_number_and_parent(from_hash)
+        to_number, to_parent = self._get_number_and_parent(to_hash)
+        while from_hash != to_hash:
+            if from_number >= to_number:
+                for receipt_id in self.get_collation_receipt_ids(from_hash):
+                    bitmap.remove(receipt_id)
+                from_hash = from_parent
+                from_number, from_parent = self._get_number_and_parent(from_hash)
+            else:
+                replayed.append(to_hash)
+                to_hash = to_parent
+                to_number, to_parent = self._get_number_and_parent(to_hash)
+        for collation_hash in reversed(replayed):
+            for receipt_id in self.get_collation_receipt_ids(collation_hash):
+                bitmap.add(receipt_id)
+        return bitmap
+
+    def sync(self):
+        """Follow the head of the shard chain"""
+        if self.head_hash != self.shard_chain.head_hash:
+            self.move(self.bitmap, self.head_hash, self.shard_chain.head_hash)
+            self.head_hash = self.shard_chain.head_hash
+
+    def get_bitmap(self, collation_hash):
+        """A copy of the bitmap of the post-state of `collation_hash`"""
+        self.sync()
+        return self.move(self.bitmap.copy(), self.head_hash, collation_hash)
+
+    def is_used(self, receipt_id):
+        """Whether `receipt_id` is used on the head of the shard chain"""
+        self.sync()
+        return self.bitmap.is_used(receipt_id)
+
+    def check_consistency(self, state=None, max_receipt_id=0):
+        """Compare the bitmap of the head with the `used_receipts` storage of
+        the URS contract in `state`, the post-state of the head by default
+
+        Return the sorted receipt ids below `max_receipt_id`, or below the
+        highest used one, on which they disagree.
+        """
+        self.sync()
+        if state is None:
+            state = self.shard_chain.mk_poststate_of_collation_hash(self.head_hash)
+        shard_id = self.shard_chain.shard_id
+        return [
+            receipt_id
+            for receipt_id in range(max(max_receipt_id, self.bitmap.size))
+            if self.bitmap.is_used(receipt_id) != is_receipt_used(state, shard_id, receipt_id)
+        ]
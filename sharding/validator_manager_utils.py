@@ -1,6 +1,6 @@
-import os
+from collections import OrderedDict
+
 import rlp
-from viper import compiler
 
 from ethereum import (
     abi,
@@ -8,20 +8,58 @@ from ethereum import (
     vm,
 )
 from ethereum.messages import apply_message
+from ethereum.state import State
 from ethereum.transactions import Transaction
 
 from sharding.config import sharding_config
+from sharding.contract_artifact_utils import (
+    get_artifact,
+    get_contract_code,
+)
 from sharding.contract_utils import (
     GASPRICE,
     extract_sender_from_tx,
     call_contract_constantly,
     call_tx,
+    get_storage_slot,
+    read_storage_bytes,
 )
 
 
 DEPOSIT_SIZE = sharding_config['DEPOSIT_SIZE']
 WITHDRAW_HASH = utils.sha3("withdraw")
 ADD_HEADER_TOPIC = utils.sha3("add_header()")
+TX_TO_SHARD_TOPIC = utils.sha3("tx_to_shard()")
+UPDATE_GASPRICE_TOPIC = utils.sha3("update_gasprice()")
+DEPOSIT_TOPIC = utils.sha3("deposit()")
+WITHDRAW_TOPIC = utils.sha3("withdraw()")
+
+# Storage layout of validator_manager.v.py: the globals take consecutive
+# slots in the order of declaration, and struct members are sorted by name
+VALIDATORS_SLOT = 0
+COLLATION_HEADERS_SLOT = 1
+RECEIPTS_SLOT = 2
+SHARD_HEAD_SLOT = 3
+NUM_VALIDATORS_SLOT = 4
+NUM_RECEIPTS_SLOT = 5
+EMPTY_SLOTS_STACK_TOP_SLOT = 7
+SHUFFLING_CYCLE_LENGTH_SLOT = 9
+IS_VALCODE_DEPOSITED_SLOT = 11
+PERIOD_LENGTH_SLOT = 12
+NUM_VALIDATORS_PER_CYCLE_SLOT = 13
+PERIOD_HEAD_SLOT = 17
+VALIDATOR_MEMBERS = sorted(['deposit', 'validation_code_addr', 'return_addr', 'cycle'])
+COLLATION_HEADER_MEMBERS = sorted(['parent_collation_hash', 'score'])
+RECEIPT_MEMBERS = sorted(['shard_id', 'tx_startgas', 'tx_gasprice', 'value', 'sender', 'to', 'data'])
+RECEIPT_DATA_MAXLEN = 4096
+
+# The loop bounds of `get_shard_list` and `get_validators_max_index`
+SHARD_LIST_SIZE = 100
+MAX_VALIDATOR_SLOTS = 1024
+# The number of shuffling cycles whose shard tables are kept
+SHARD_TABLE_CACHE_SIZE = 4
+VALIDATORS_MAX_INDEX_CACHE_SIZE = 256
+VALCODE_INDICES_CACHE_SIZE = 16
 
 _valmgr_ct = None
 _valmgr_code = None
@@ -60,27 +98,23 @@ return(~mload(0) == {})
 
 
 def get_valmgr_ct():
-    global _valmgr_ct, _valmgr_code
+    global _valmgr_ct
     if not _valmgr_ct:
-        _valmgr_ct = abi.ContractTranslator(
-            compiler.mk_full_signature(get_valmgr_code())
-        )
+        _valmgr_ct = abi.ContractTranslator(get_artifact('validator_manager')['abi'])
     return _valmgr_ct
 
 
 def get_valmgr_code():
     global _valmgr_code
     if not _valmgr_code:
-        mydir = os.path.dirname(__file__)
-        valmgr_path = os.path.join(mydir, 'contracts/validator_manager.v.py')
-        _valmgr_code = open(valmgr_path).read()
+        _valmgr_code = get_contract_code('validator_manager')
     return _valmgr_code
 
 
 def get_valmgr_bytecode():
     global _valmgr_bytecode
     if not _valmgr_bytecode:
-        _valmgr_bytecode = compiler.compile(get_valmgr_code())
+        _valmgr_bytecode = get_artifact('validator_manager')['bytecode']
     return _valmgr_bytecode
 
 
@@ -135,18 +169,6 @@ def call_withdraw(state, sender_privkey, value, validator_index, signature, gasp
     )
 
 
-def get_shard_list(state, valcode_addr):
-    ct = get_valmgr_ct()
-    dummy_addr = b'\xff' * 20
-    shard_list = call_contract_constantly(
-        state, ct, get_valmgr_addr(), 'get_shard_list', [valcode_addr],
-        value=0, startgas=10 ** 20, sender_addr=dummy_addr
-    )
-    return shard_list
-    # assert len(shard_list) == 100
-    # return abi.decode_abi(['bool[100]'], shard_list)[0]
-
-
 def call_tx_add_header(state, sender_privkey, value, header, gasprice=GASPRICE, startgas=300000, nonce=None):
     return call_tx(
         state, get_valmgr_ct(), 'add_header', [header],
@@ -199,6 +221,323 @@ def call_valmgr(state, func, args, value=0, startgas=None, sender_addr=b'\x00' *
     )
 
 
+def _is_valmgr_committed(state):
+    account = state.cache.get(get_valmgr_addr())
+    return account is None or not (account.touched or account.deleted)
+
+
+def get_valmgr_view(state):
+    """A fresh State on the trie root of `state`, to read the storage of the
+    validator manager without touching the cache of `state`, like
+    `call_valmgr` does with its ephemeral clone
+
+    If the validator manager has uncommitted changes in `state`, e.g. a
+    deposit within the current block, `state` itself is read instead.
+    """
+    if not _is_valmgr_committed(state):
+        return state
+    return State(state.trie.root_hash, state.env)
+
+
+def get_valmgr_storage_root(view):
+    """The storage root of the validator manager in `view`, which the caches
+    of its storage are keyed on, or None if `view` has uncommitted changes
+    of it, which are never cached
+    """
+    if not _is_valmgr_committed(view):
+        return None
+    return view.get_and_cache_account(get_valmgr_addr()).storage
+
+
+def _read_struct(state, slot, member_names, members, addr_members=(), maxlen=None):
+    """Read the `members` of the Viper struct at `slot` from the validator
+    manager storage
+    """
+    valmgr_addr = get_valmgr_addr()
+    values = {}
+    for index, member in enumerate(member_names):
+        if member not in members:
+            continue
+        member_slot = get_storage_slot(slot, index)
+        if member == 'data':
+            values[member] = read_storage_bytes(state, valmgr_addr, member_slot, maxlen)
+        elif member in addr_members:
+            values[member] = utils.int_to_addr(state.get_storage_data(valmgr_addr, member_slot))
+        elif member == 'parent_collation_hash':
+            values[member] = utils.encode_int32(state.get_storage_data(valmgr_addr, member_slot))
+        else:
+            values[member] = utils.to_signed(state.get_storage_data(valmgr_addr, member_slot))
+    return values
+
+
+def get_receipt(state, receipt_id, members=RECEIPT_MEMBERS):
+    """Get the receipt `receipt_id` by reading the storage of the validator
+    manager directly, instead of one `call_valmgr` per member
+
+    Return a dict of shard_id, tx_startgas, tx_gasprice, value, sender, to
+    and data, or only of `members`; the addresses as 20 bytes. A receipt
+    that doesn't exist is all zeros, like the getters return.
+    """
+    return _read_struct(
+        get_valmgr_view(state), get_storage_slot(RECEIPTS_SLOT, receipt_id),
+        RECEIPT_MEMBERS, members, ('sender', 'to'), RECEIPT_DATA_MAXLEN
+    )
+
+
+def get_validator(state, validator_index, members=VALIDATOR_MEMBERS):
+    """Get `validators[validator_index]` as a dict of deposit,
+    validation_code_addr, return_addr and cycle, or only of `members`
+    """
+    return _read_struct(
+        get_valmgr_view(state), get_storage_slot(VALIDATORS_SLOT, validator_index),
+        VALIDATOR_MEMBERS, members, ('validation_code_addr', 'return_addr')
+    )
+
+
+def get_collation_header(state, shard_id, collation_hash):
+    """Get `collation_headers[shard_id][collation_hash]` as a dict of
+    parent_collation_hash and score
+    """
+    slot = get_storage_slot(
+        get_storage_slot(COLLATION_HEADERS_SLOT, shard_id),
+        utils.big_endian_to_int(collation_hash)
+    )
+    return _read_struct(get_valmgr_view(state), slot, COLLATION_HEADER_MEMBERS, COLLATION_HEADER_MEMBERS)
+
+
+def get_shard_head(state, shard_id):
+    """`get_shard_head(shard_id)` of the validator manager, as 32 bytes"""
+    return utils.encode_int32(get_valmgr_view(state).get_storage_data(
+        get_valmgr_addr(), get_storage_slot(SHARD_HEAD_SLOT, shard_id)
+    ))
+
+
+def get_period_head(state, shard_id):
+    """`get_period_head(shard_id)` of the validator manager"""
+    return utils.to_signed(get_valmgr_view(state).get_storage_data(
+        get_valmgr_addr(), get_storage_slot(PERIOD_HEAD_SLOT, shard_id)
+    ))
+
+
+def is_valcode_deposited(state, valcode_addr):
+    """`get_is_valcode_deposited(valcode_addr)` of the validator manager"""
+    return bool(get_valmgr_view(state).get_storage_data(
+        get_valmgr_addr(),
+        get_storage_slot(IS_VALCODE_DEPOSITED_SLOT, utils.big_endian_to_int(utils.normalize_address(valcode_addr)))
+    ))
+
+
+def get_num_validators(state):
+    """`get_num_validators()` of the validator manager"""
+    return utils.to_signed(get_valmgr_view(state).get_storage_data(get_valmgr_addr(), NUM_VALIDATORS_SLOT))
+
+
+def get_num_receipts(state):
+    """The number of receipts created by `tx_to_shard`, i.e. the next
+    receipt id
+    """
+    return utils.to_signed(get_valmgr_view(state).get_storage_data(get_valmgr_addr(), NUM_RECEIPTS_SLOT))
+
+
+def _blockhash(state, number):
+    """`blockhash(number)` in a message call on `state`
+    (refer to ethereum.messages.VMExt.block_hash)
+    """
+    if 1 <= state.block_number - number <= 256 and number <= state.block_number:
+        return state.get_block_hash(state.block_number - number - 1)
+    return b'\x00' * 32
+
+
+def _get_valmgr_storage(view, slot):
+    return view.get_storage_data(get_valmgr_addr(), slot)
+
+
+def _get_validator_index(cycle_seed, shard_id, index_in_subset, validators_max_index):
+    h = utils.big_endian_to_int(utils.sha3(
+        cycle_seed + utils.encode_int32(shard_id) + utils.encode_int32(index_in_subset)
+    ))
+    # num256_mod by 0 is 0, like the EVM MOD
+    return h % validators_max_index if validators_max_index else 0
+
+
+def get_cycle(state, view=None):
+    """The shuffling cycle of the block `state` executes in"""
+    view = view or get_valmgr_view(state)
+    return state.block_number // _get_valmgr_storage(view, SHUFFLING_CYCLE_LENGTH_SLOT)
+
+
+def get_cycle_seed(state, view=None):
+    """`cycle_seed` of `sample` and `get_shard_list`"""
+    view = view or get_valmgr_view(state)
+    cycle_length = _get_valmgr_storage(view, SHUFFLING_CYCLE_LENGTH_SLOT)
+    cycle_start_block_number = max((state.block_number // cycle_length) * cycle_length - 1, 0)
+    return _blockhash(state, cycle_start_block_number)
+
+
+_validators_max_index_cache = {}
+
+
+def get_validators_max_index(state, view=None, validator_set_index=None):
+    """`get_validators_max_index()` of the validator manager, read from its
+    storage, or from `validator_set_index`, a ValidatorSetIndex whose head
+    `state` is the post-state or the next block of
+
+    The result only depends on the storage of the validator manager and on
+    the cycle, so it is cached by its committed storage root and the cycle.
+    """
+    view = view or get_valmgr_view(state)
+    cycle = get_cycle(state, view)
+    if validator_set_index is not None:
+        return validator_set_index.get_validators_max_index(cycle)
+    storage_root = get_valmgr_storage_root(view)
+    key = (storage_root, cycle)
+    if storage_root is not None and key in _validators_max_index_cache:
+        return _validators_max_index_cache[key]
+    stack_top = utils.to_signed(_get_valmgr_storage(view, EMPTY_SLOTS_STACK_TOP_SLOT))
+    all_slots_num = utils.to_signed(_get_valmgr_storage(view, NUM_VALIDATORS_SLOT)) + stack_top
+    active_num = 0
+    for i in range(min(all_slots_num, MAX_VALIDATOR_SLOTS)):
+        validator = _read_struct(
+            view, get_storage_slot(VALIDATORS_SLOT, i), VALIDATOR_MEMBERS,
+            ('validation_code_addr', 'cycle'), ('validation_code_addr',)
+        )
+        if validator['validation_code_addr'] != b'\x00' * 20 and validator['cycle'] <= cycle:
+            active_num += 1
+    if storage_root is not None:
+        if len(_validators_max_index_cache) >= VALIDATORS_MAX_INDEX_CACHE_SIZE:
+            _validators_max_index_cache.clear()
+        _validators_max_index_cache[key] = active_num + stack_top
+    return active_num + stack_top
+
+
+_shard_tables = OrderedDict()
+
+
+def get_shard_table(cycle_seed, validators_max_index):
+    """Precompute the validator indices a cycle can sample
+
+    Return `(table, shard_ids)`:
+        table: table[shard_id][index_in_subset] is the validator index
+               `sample(shard_id)` picks for `index_in_subset`
+        shard_ids: dict of validator index -> the sorted shard ids whose row
+                   contains it, i.e. `get_shard_list` of its valcode addr
+    The tables of the last SHARD_TABLE_CACHE_SIZE cycles are kept.
+    """
+    key = (cycle_seed, validators_max_index)
+    if key in _shard_tables:
+        _shard_tables[key] = _shard_tables.pop(key)
+        return _shard_tables[key]
+    table = []
+    shard_ids = {}
+    for shard_id in range(SHARD_LIST_SIZE):
+        row = [
+            _get_validator_index(cycle_seed, shard_id, index_in_subset, validators_max_index)
+            for index_in_subset in range(SHARD_LIST_SIZE)
+        ]
+        for validator_index in set(row):
+            shard_ids.setdefault(validator_index, []).append(shard_id)
+        table.append(row)
+    _shard_tables[key] = (table, shard_ids)
+    while len(_shard_tables) > SHARD_TABLE_CACHE_SIZE:
+        _shard_tables.popitem(last=False)
+    return _shard_tables[key]
+
+
+def _get_validator_valcode_and_cycle(view, validator_index, validator_set_index=None):
+    if validator_set_index is not None:
+        validator = validator_set_index.get_validator(validator_index)
+        if validator is None:
+            return b'\x00' * 20, 0
+        return utils.normalize_address(validator[0]), validator[2]
+    validator = _read_struct(
+        view, get_storage_slot(VALIDATORS_SLOT, validator_index), VALIDATOR_MEMBERS,
+        ('validation_code_addr', 'cycle'), ('validation_code_addr',)
+    )
+    return validator['validation_code_addr'], validator['cycle']
+
+
+_valcode_indices_cache = OrderedDict()
+
+
+def get_valcode_indices(view, cycle_seed, validators_max_index, validator_set_index=None):
+    """Map the validation code addresses of the validators the shard table
+    of the cycle contains to their validator indices
+
+    Empty slots map from the zero address, like the contract compares them.
+    The map is cached by the committed storage root of the validator
+    manager and the shard table, so `get_shard_list` looks a valcode addr up directly.
+    """
+    storage_root = get_valmgr_storage_root(view)
+    key = (storage_root, cycle_seed, validators_max_index)
+    if storage_root is not None and key in _valcode_indices_cache:
+        _valcode_indices_cache[key] = _valcode_indices_cache.pop(key)
+        return _valcode_indices_cache[key]
+    _, shard_ids = get_shard_table(cycle_seed, validators_max_index)
+    valcode_indices = {}
+    for validator_index in sorted(shard_ids):
+        valcode_addr, _ = _get_validator_valcode_and_cycle(view, validator_index, validator_set_index)
+        valcode_indices.setdefault(valcode_addr, []).append(validator_index)
+    if storage_root is None:
+        return valcode_indices
+    _valcode_indices_cache[key] = valcode_indices
+    while len(_valcode_indices_cache) > VALCODE_INDICES_CACHE_SIZE:
+        _valcode_indices_cache.popitem(last=False)
+    return valcode_indices
+
+
+def sample(state, shard_id, validator_set_index=None):
+    """`sample(shard_id)` of the validator manager, computed off-chain
+
+    Return the sampled validation code address as 20 bytes, or the zero
+    address if the sampled validator is not active yet.
+    validator_set_index: an optional ValidatorSetIndex to read the validators
+                         from, see `get_validators_max_index`
+    """
+    view = get_valmgr_view(state)
+    period_length = _get_valmgr_storage(view, PERIOD_LENGTH_SLOT)
+    if state.block_number < period_length:
+        raise MessageFailed('sample is not available before block %d' % period_length)
+    seed = _blockhash(state, state.block_number - (state.block_number % period_length) - 1)
+    num_validators_per_cycle = _get_valmgr_storage(view, NUM_VALIDATORS_PER_CYCLE_SLOT)
+    h = utils.big_endian_to_int(utils.sha3(seed + utils.encode_int32(shard_id)))
+    index_in_subset = h % num_validators_per_cycle if num_validators_per_cycle else 0
+
+    cycle_seed = get_cycle_seed(state, view)
+    validators_max_index = get_validators_max_index(state, view, validator_set_index)
+    if 0 <= shard_id < SHARD_LIST_SIZE and index_in_subset < SHARD_LIST_SIZE:
+        table, _ = get_shard_table(cycle_seed, validators_max_index)
+        validator_index = table[shard_id][index_in_subset]
+    else:
+        validator_index = _get_validator_index(cycle_seed, shard_id, index_in_subset, validators_max_index)
+    valcode_addr, cycle = _get_validator_valcode_and_cycle(view, validator_index, validator_set_index)
+    if cycle > get_cycle(state, view):
+        return b'\x00' * 20
+    return valcode_addr
+
+
+def get_shard_list(state, valcode_addr, validator_set_index=None):
+    """`get_shard_list(valcode_addr)` of the validator manager, computed
+    off-chain from the shard table of the cycle
+
+    Return a list of SHARD_LIST_SIZE bools.
+    validator_set_index: an optional ValidatorSetIndex to read the validators
+                         from, see `get_validators_max_index`
+    """
+    view = get_valmgr_view(state)
+    valcode_addr = utils.normalize_address(valcode_addr)
+    shard_list = [False] * SHARD_LIST_SIZE
+    if utils.to_signed(_get_valmgr_storage(view, NUM_VALIDATORS_SLOT)) == 0:
+        return shard_list
+    cycle_seed = get_cycle_seed(state, view)
+    validators_max_index = get_validators_max_index(state, view, validator_set_index)
+    _, shard_ids = get_shard_table(cycle_seed, validators_max_index)
+    valcode_indices = get_valcode_indices(view, cycle_seed, validators_max_index, validator_set_index)
+    for validator_index in valcode_indices.get(valcode_addr, ()):
+        for shard_id in shard_ids[validator_index]:
+            shard_list[shard_id] = True
+    return shard_list
+
+
 def is_valmgr_setup(state):
     return not (
         b'' == state.get_code(get_valmgr_addr()) and
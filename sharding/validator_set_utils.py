@@ -0,0 +1,189 @@
+import rlp
+
+from ethereum import utils
+
+from sharding.validator_manager_utils import (
+    DEPOSIT_TOPIC,
+    WITHDRAW_TOPIC,
+    get_validator,
+    get_valmgr_addr,
+)
+
+DEPOSIT = b'deposit'
+WITHDRAW = b'withdraw'
+
+
+def get_validator_events(state, receipts):
+    """Get the `deposit()` and `withdraw()` logs of the validator manager in
+    `receipts`, in order, as `(kind, index, valcode_addr, return_addr, cycle)`
+
+    `state` is the post-state of `receipts`; the return address and the
+    activation cycle of a deposit are read from it, and left empty if the
+    validator withdrew again in the same block.
+
+    The address of the validator manager is only resolved once a log with
+    one of their topics shows up, so the blocks before the validator
+    manager exists don't need its artifact.
+    """
+    deposit_topic = utils.big_endian_to_int(DEPOSIT_TOPIC)
+    withdraw_topic = utils.big_endian_to_int(WITHDRAW_TOPIC)
+    valmgr_addr = None
+    events = []
+    for receipt in receipts:
+        for log in receipt.logs:
+            if not log.topics or log.topics[0] not in (deposit_topic, withdraw_topic):
+                continue
+            if valmgr_addr is None:
+                valmgr_addr = get_valmgr_addr()
+            if log.address != valmgr_addr:
+                continue
+            index = utils.big_endian_to_int(log.data)
+            if log.topics[0] == deposit_topic:
+                valcode_addr = utils.int_to_addr(log.topics[1])
+                validator = get_validator(state, index)
+                if validator['validation_code_addr'] == valcode_addr:
+                    events.append((DEPOSIT, index, valcode_addr, validator['return_addr'], validator['cycle']))
+                else:
+                    events.append((DEPOSIT, index, valcode_addr, b'', 0))
+            elif log.topics[0] == withdraw_topic:
+                events.append((WITHDRAW, index, b'', b'', 0))
+    return events
+
+
+def encode_validator_events(events):
+    return rlp.encode([
+        [kind, utils.encode_int(index), valcode_addr, return_addr, utils.encode_int(cycle)]
+        for kind, index, valcode_addr, return_addr, cycle in events
+    ])
+
+
+def decode_validator_events(data):
+    return [
+        (kind, utils.big_endian_to_int(index), valcode_addr, return_addr, utils.big_endian_to_int(cycle))
+        for kind, index, valcode_addr, return_addr, cycle in rlp.decode(data)
+    ]
+
+
+class ValidatorSetIndex(object):
+    """The validator set of the validator manager on the head of a main
+    chain, replayed from the `deposit()` and `withdraw()` logs
+
+    The events of each block are stored under `validator_events:<hash>` by
+    `MainChain.add_block`. The index follows `MainChain.head_hash` lazily:
+    on a reorg the blocks of the old branch are undone from their journals
+    and the ones of the new branch replayed.
+
+    validators: dict of validator index -> (valcode_addr, return_addr, cycle)
+    empty_slots_stack: the empty slot indices, the top being the last
+    """
+
+    def __init__(self, main_chain):
+        self.main_chain = main_chain
+        self.validators = {}
+        self.valcode_indices = {}
+        self.empty_slots_stack = []
+        # The applied blocks, from genesis, and their undo journals
+        self.block_hashes = []
+        self.block_positions = {}
+        self.journals = []
+        self._active_cache = {}
+
+    def get_block_events(self, block_hash):
+        key = b'validator_events:' + block_hash
+        if key not in self.main_chain.db:
+            return []
+        return decode_validator_events(self.main_chain.db.get(key))
+
+    def _set_validator(self, index, validator):
+        old = self.validators.pop(index, None)
+        if old is not None:
+            del self.valcode_indices[old[0]]
+        if validator is not None:
+            self.validators[index] = validator
+            self.valcode_indices[validator[0]] = index
+        return old
+
+    def apply_event(self, event):
+        """Apply an event the way the contract does, and return its undo entry
+        """
+        kind, index, valcode_addr, return_addr, cycle = event
+        if kind == DEPOSIT:
+            popped = bool(self.empty_slots_stack) and self.empty_slots_stack[-1] == index
+            if popped:
+                self.empty_slots_stack.pop()
+            return (kind, index, self._set_validator(index, (valcode_addr, return_addr, cycle)), popped)
+        else:
+            self.empty_slots_stack.append(index)
+            return (kind, index, self._set_validator(index, None), True)
+
+    def undo_event(self, undo):
+        kind, index, old, popped = undo
+        if kind == DEPOSIT:
+            if popped:
+                self.empty_slots_stack.append(index)
+        else:
+            self.empty_slots_stack.pop()
+        self._set_validator(index, old)
+
+    def _apply_block(self, block_hash):
+        self.block_positions[block_hash] = len(self.block_hashes)
+        self.block_hashes.append(block_hash)
+        self.journals.append([self.apply_event(event) for event in self.get_block_events(block_hash)])
+
+    def _undo_block(self):
+        for undo in reversed(self.journals.pop()):
+            self.undo_event(undo)
+        del self.block_positions[self.block_hashes.pop()]
+
+    def sync(self):
+        """Follow the head of the main chain"""
+        head_hash = self.main_chain.head_hash
+        if self.block_hashes and self.block_hashes[-1] == head_hash:
+            return
+        new_branch = []
+        block_hash = head_hash
+        while block_hash not in self.block_positions and block_hash in self.main_chain.db:
+            new_branch.append(block_hash)
+            block = self.main_chain.get_block(block_hash)
+            if block is None or block.header.number == 0:
+                break
+            block_hash = block.header.prevhash
+        ancestor = self.block_positions.get(block_hash, -1)
+        while len(self.block_hashes) > ancestor + 1:
+            self._undo_block()
+        for block_hash in reversed(new_branch):
+            self._apply_block(block_hash)
+        self._active_cache = {}
+
+    @property
+    def num_validators(self):
+        self.sync()
+        return len(self.validators)
+
+    def get_validator(self, index):
+        """`(valcode_addr, return_addr, cycle)` of validator `index`, or None
+        """
+        self.sync()
+        return self.validators.get(index)
+
+    def get_validator_index(self, valcode_addr):
+        self.sync()
+        return self.valcode_indices.get(utils.normalize_address(valcode_addr))
+
+    def get_active_validators(self, cycle):
+        """The validators active in `cycle`, as a dict of index -> valcode addr
+
+        The set of each cycle is computed once per head.
+        """
+        self.sync()
+        if cycle not in self._active_cache:
+            self._active_cache[cycle] = {
+                index: validator[0]
+                for index, validator in self.validators.items()
+                if validator[2] <= cycle
+            }
+        return self._active_cache[cycle]
+
+    def get_validators_max_index(self, cycle):
+        """`get_validators_max_index()` of the contract in `cycle`"""
+        return len(self.get_active_validators(cycle)) + len(self.empty_slots_stack)